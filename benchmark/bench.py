@@ -0,0 +1,336 @@
+#! /usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+parse、to_json、serialize等热点路径的性能测试
+
+生成指定规模的proto文件及json记录，依次运行各场景，输出吞吐量、p50/p99延迟及峰值RSS，
+结果可保存为json文件，并可比较两次运行的结果:
+
+    python bench.py --messages 10,1000 --fields 1,50 --output base.json
+    python bench.py --compare base.json new.json
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from pb_parser import FileFsm, Message, descriptor_cache
+from pb_encoder import MessageEncoder
+from pb_wire import WireEncoder
+from pb_decoder import MessageDecoder
+from pb_columnar import ColumnarDecoder
+from pb_validate import BatchValidator
+from pb_schema_cache import SchemaCache
+from pb_descriptor import export_descriptor_set, load_descriptor_set
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# 生成字段时使用的类型及对应的随机值
+ScalarValues = {
+    'bool': lambda r: r.random() < 0.5,
+    'double': lambda r: r.uniform(-1e6, 1e6),
+    'float': lambda r: float(r.randint(-1000, 1000)),
+    'int32': lambda r: r.randint(-2 ** 31, 2 ** 31 - 1),
+    'uint32': lambda r: r.randint(0, 2 ** 32 - 1),
+    'int64': lambda r: r.randint(-2 ** 63, 2 ** 63 - 1),
+    'uint64': lambda r: r.randint(0, 2 ** 64 - 1),
+    'sint32': lambda r: r.randint(-2 ** 31, 2 ** 31 - 1),
+    'sint64': lambda r: r.randint(-2 ** 63, 2 ** 63 - 1),
+    'fixed32': lambda r: r.randint(0, 2 ** 32 - 1),
+    'fixed64': lambda r: r.randint(0, 2 ** 64 - 1),
+    'sfixed32': lambda r: r.randint(-2 ** 31, 2 ** 31 - 1),
+    'sfixed64': lambda r: r.randint(-2 ** 63, 2 ** 63 - 1),
+    'string': lambda r: 'value-%d' % r.randint(0, 10 ** 6),
+}
+
+
+def generate_proto(path, message_count, field_count, seed=0):
+    """
+    生成包含message_count个消息、每个消息field_count个字段的proto文件
+    :return: 第一个消息各字段的(名称, 类型)列表
+    """
+    rnd = random.Random(seed)
+    types = sorted(ScalarValues)
+    first_fields = None
+    lines = ['package bench.pkg;', '']
+    for m in range(message_count):
+        fields = [('field_%d' % f, rnd.choice(types)) for f in range(field_count)]
+        if first_fields is None:
+            first_fields = fields
+        lines.append('// message %d' % m)
+        lines.append('message Message%d {' % m)
+        for seq, (name, field_type) in enumerate(fields, 1):
+            lines.append('    optional %s %s = %d; // %s' % (field_type, name, seq, name))
+        lines.append('}')
+        lines.append('')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+    return first_fields
+
+
+def generate_tree_proto(path):
+    """
+    生成包含递归嵌套消息及枚举的proto文件
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('package bench.tree;\n\n'
+                'message Node {\n'
+                '    enum Kind { LEAF = 0; BRANCH = 1; }\n'
+                '    optional string name = 1;\n'
+                '    optional Kind kind = 2;\n'
+                '    repeated Node children = 3;\n'
+                '}\n')
+
+
+def generate_tree(depth, fanout=2):
+    """
+    生成深度为depth的树，除叶子外每个节点有fanout个子节点中的一个继续向下延伸
+    :return: (记录, 节点数)
+    """
+    node = {'name': 'leaf', 'kind': 'LEAF'}
+    count = 1
+    for level in range(depth):
+        children = [node] + [{'name': 'leaf-%d' % i, 'kind': 'LEAF'} for i in range(fanout - 1)]
+        node = {'name': 'node-%d' % level, 'kind': 'BRANCH', 'children': children}
+        count += fanout
+    return node, count
+
+
+def generate_records(fields, count, seed=0):
+    """
+    生成count条json记录，记录为字段名到字段值的字典
+    """
+    rnd = random.Random(seed)
+    return [dict((name, ScalarValues[field_type](rnd)) for name, field_type in fields) for _ in range(count)]
+
+
+def peak_rss_kb():
+    """
+    返回进程的峰值RSS，单位KB；不支持的平台返回None
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS以字节为单位
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def measure(name, func, repeat, items):
+    """
+    运行func共repeat次，每次处理items条数据
+    :return: 场景结果字典，延迟单位为毫秒
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    total = sum(samples)
+    return {
+        'scenario': name,
+        'repeat': repeat,
+        'items_per_op': items,
+        'throughput': (items * repeat / total) if total > 0 else None,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'peak_rss_kb': peak_rss_kb()
+    }
+
+
+def run_case(work_dir, message_count, field_count, records, repeat):
+    """
+    运行一组规模下的全部场景
+    """
+    proto_path = os.path.join(work_dir, 'bench_%d_%d.proto' % (message_count, field_count))
+    fields = generate_proto(proto_path, message_count, field_count)
+    corpus = generate_records(fields, records)
+    results = []
+
+    # 冷启动解析
+    def cold_parse():
+        FileFsm(proto_path).parse()
+    results.append(measure('cold_parse', cold_parse, repeat, message_count))
+
+    # 延迟解析：预扫描后只解析一个消息
+    def lazy_parse():
+        file_fsm = FileFsm(proto_path, lazy=True)
+        file_fsm.parse()
+        file_fsm.message('Message0')
+    results.append(measure('lazy_parse', lazy_parse, repeat, message_count))
+
+    # 磁盘缓存命中时的解析
+    schema_cache = SchemaCache(os.path.join(work_dir, 'cache'))
+    FileFsm(proto_path, schema_cache=schema_cache).parse()
+
+    def warm_parse():
+        FileFsm(proto_path, schema_cache=schema_cache).parse()
+    results.append(measure('warm_parse', warm_parse, repeat, message_count))
+
+    file_fsm = FileFsm(proto_path)
+    file_fsm.parse()
+    message = file_fsm.message('Message0')
+
+    # 从导出的FileDescriptorSet加载，描述符池中已包含全部消息
+    descriptor_data = export_descriptor_set(file_fsm)
+
+    def descriptor_load():
+        load_descriptor_set(descriptor_data)
+    results.append(measure('descriptor_load', descriptor_load, repeat, message_count))
+
+    def to_json():
+        for m in file_fsm.messages():
+            m.to_json()
+    results.append(measure('to_json', to_json, repeat, message_count))
+
+    # 单条编码：每条记录构造一个Message后序列化
+    schema = json.loads(message.to_json())
+    single_strings = []
+    for record in corpus:
+        field_list = [dict(f, field_value=record[f['field_name']]) for f in schema['message_fields']]
+        single_strings.append(json.dumps({'message_name': schema['message_name'], 'message_pkg': 'bench.pkg',
+                                          'field_list': field_list}))
+
+    def encode_single():
+        for string in single_strings:
+            Message(json_string=string).serialize().SerializeToString()
+    results.append(measure('encode_single', encode_single, repeat, records))
+
+    encoder = MessageEncoder(message)
+
+    def encode_bulk():
+        encoder.write_delimited(corpus, io.BytesIO())
+    results.append(measure('encode_bulk', encode_bulk, repeat, records))
+
+    # 先按列校验整批记录，再批量编码校验通过的记录
+    validator = BatchValidator(message)
+
+    def encode_validated():
+        encoder.write_delimited(validator.validate(corpus).records(), io.BytesIO())
+    results.append(measure('encode_validated', encode_validated, repeat, records))
+
+    wire_encoder = WireEncoder(message)
+
+    def encode_wire():
+        wire_encoder.write_delimited(corpus, io.BytesIO())
+    results.append(measure('encode_wire', encode_wire, repeat, records))
+
+    stream = io.BytesIO()
+    encoder.write_delimited(corpus, stream)
+    data = stream.getvalue()
+    decoder = MessageDecoder(message)
+
+    def decode():
+        for _ in decoder.iter_decode(io.BytesIO(data)):
+            pass
+    results.append(measure('decode', decode, repeat, records))
+
+    columnar = ColumnarDecoder(message)
+
+    def decode_columnar():
+        columnar.decode(data)
+    results.append(measure('decode_columnar', decode_columnar, repeat, records))
+
+    for result in results:
+        result.update({'messages': message_count, 'fields': field_count})
+    return results
+
+
+def run_nested(work_dir, depth, records, repeat):
+    """
+    嵌套消息编码：每条记录为深度depth的树，吞吐量以节点数计
+    """
+    proto_path = os.path.join(work_dir, 'bench_tree.proto')
+    generate_tree_proto(proto_path)
+    file_fsm = FileFsm(proto_path)
+    file_fsm.parse()
+    encoder = MessageEncoder(file_fsm.message('Node'))
+    tree, nodes = generate_tree(depth)
+
+    def encode_nested():
+        for _ in range(records):
+            encoder.encode(tree)
+    result = measure('encode_nested', encode_nested, repeat, records * nodes)
+    result.update({'messages': 1, 'fields': depth})
+    return [result]
+
+
+def compare(base_path, new_path):
+    """
+    比较两次运行结果的吞吐量
+    """
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    key = lambda r: (r['scenario'], r['messages'], r['fields'])
+    base_results = dict((key(r), r) for r in base['results'])
+    print('%-14s %8s %6s %14s %14s %8s' % ('scenario', 'messages', 'fields', 'base', 'new', 'change'))
+    for r in new['results']:
+        b = base_results.get(key(r))
+        if b is None or not b['throughput'] or not r['throughput']:
+            continue
+        print('%-14s %8d %6d %14.1f %14.1f %+7.1f%%' % (r['scenario'], r['messages'], r['fields'], b['throughput'],
+                                                         r['throughput'], (r['throughput'] / b['throughput'] - 1) * 100))
+
+
+def parse_sizes(text):
+    return [int(x) for x in text.split(',') if x]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='pb2json benchmark')
+    parser.add_argument('--messages', type=parse_sizes, default=[10, 100, 1000], help='comma separated message counts')
+    parser.add_argument('--fields', type=parse_sizes, default=[1, 20, 100], help='comma separated field counts')
+    parser.add_argument('--records', type=int, default=2000, help='records per encode/decode scenario')
+    parser.add_argument('--depth', type=parse_sizes, default=[4, 32], help='comma separated tree depths for encode_nested')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions per scenario')
+    parser.add_argument('--output', help='save results as json')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='compare two result files')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    work_dir = tempfile.mkdtemp(prefix='pb2json-bench-')
+    results = []
+    try:
+        for message_count in args.messages:
+            for field_count in args.fields:
+                descriptor_cache.invalidate()
+                results.extend(run_case(work_dir, message_count, field_count, args.records, args.repeat))
+        for depth in args.depth:
+            results.extend(run_nested(work_dir, depth, args.records, args.repeat))
+        for result in results:
+            print('%-14s messages=%-6d fields=%-4d %12.1f/s  p50=%.3fms  p99=%.3fms  rss=%sKB' % (
+                result['scenario'], result['messages'], result['fields'], result['throughput'] or 0,
+                result['p50_ms'], result['p99_ms'], result['peak_rss_kb']))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+#! /usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+增量解析与完整解析的差分检查
+
+随机生成包含package、顶层枚举、嵌套枚举及消息引用的proto文件，反复随机修改(字段、消息的增删、注释、
+消息引用、package改名等)。每次修改后分别由增量模式及普通模式的FileFsm调用reparse()，检查两者
+是否同时报错，reparse()返回的差异、各消息的json描述及编码结果是否一致:
+
+    python incremental_diff.py --files 20 --edits 200
+"""
+
+import os
+import sys
+import random
+import shutil
+import argparse
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from pb_parser import FileFsm
+from pb_encoder import MessageEncoder
+from my_exception import FormatError, UndefineError
+
+FieldTypes = ['int32', 'int64', 'string', 'bool']
+Packages = ['demo', 'demo2', 'demo.sub']
+
+
+def random_model(rnd):
+    messages = []
+    for i in range(rnd.randint(2, 8)):
+        fields = [(rnd.choice(FieldTypes), 'f%d' % j) for j in range(rnd.randint(1, 3))]
+        messages.append({'name': 'M%d' % i, 'fields': fields, 'ref': None, 'comment': rnd.random() < 0.5,
+                         'enum': rnd.random() < 0.3})
+    return {'pkg': rnd.choice(Packages), 'top_enum': True, 'mid_enum': None, 'messages': messages}
+
+
+def render(model):
+    lines = ['package %s;' % model['pkg'], '']
+    if model['top_enum']:
+        lines.append('enum Color { RED = 0; BLUE = 1; }')
+    for i, message in enumerate(model['messages']):
+        if model['mid_enum'] == i:
+            lines.append('enum Mid { A = 0; }')
+        if message['comment']:
+            lines.append('// %s' % message['name'])
+        lines.append('message %s {' % message['name'])
+        for seq, (field_type, name) in enumerate(message['fields'], 1):
+            lines.append('    optional %s %s = %d;' % (field_type, name, seq))
+        if message['ref']:
+            lines.append('    optional %s ref = 10;' % message['ref'])
+        if message['enum']:
+            lines.append('    enum E { X = 0; Y = 1; }')
+            lines.append('    optional E e = 11;')
+        lines.append('}')
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def mutate(rnd, model):
+    messages = model['messages']
+    message = rnd.choice(messages)
+    kind = rnd.randrange(9)
+    if kind == 0:
+        field = (rnd.choice(FieldTypes), rnd.choice(['f0', 'f1', 'g']))
+        message['fields'][rnd.randrange(len(message['fields']))] = field
+    elif kind == 1:
+        message['fields'].append((rnd.choice(FieldTypes), 'h%d' % rnd.randrange(100)))
+    elif kind == 2:
+        message['ref'] = rnd.choice([other['name'] for other in messages] + [None, 'Color'])
+    elif kind == 3:
+        message['comment'] = not message['comment']
+    elif kind == 4 and len(messages) > 2:
+        messages.remove(message)
+        for other in messages:
+            if other['ref'] == message['name']:
+                other['ref'] = None
+    elif kind == 5:
+        messages.insert(rnd.randrange(len(messages) + 1),
+                        {'name': 'N%d' % rnd.randrange(1000), 'fields': [('int32', 'a')], 'ref': None,
+                         'comment': False, 'enum': False})
+    elif kind == 6:
+        # package改名，消息区域的内容不变
+        model['pkg'] = rnd.choice(Packages)
+    elif kind == 7:
+        model['mid_enum'] = rnd.choice([None, rnd.randrange(len(messages))])
+    else:
+        message['enum'] = not message['enum']
+    # 去掉同名字段及同名消息
+    names = set()
+    message['fields'] = [field for field in message['fields'] if not (field[1] in names or names.add(field[1]))]
+    names = set()
+    model['messages'] = [m for m in model['messages'] if not (m['name'] in names or names.add(m['name']))]
+
+
+def sample(file_fsm, message, depth=0):
+    record = {}
+    for field in message.fields():
+        if field.type == 'message':
+            if depth < 2:
+                record[field.name] = sample(file_fsm, file_fsm.message(field.type_name.split('.')[-1]), depth + 1)
+        elif field.type == 'enum':
+            record[field.name] = 1
+        elif field.type == 'string':
+            record[field.name] = 'x'
+        elif field.type == 'bool':
+            record[field.name] = True
+        else:
+            record[field.name] = 7
+    return record
+
+
+def snapshot(file_fsm):
+    result = {}
+    for message in file_fsm.messages():
+        result[message.name()] = (message.to_json(), MessageEncoder(message).encode(sample(file_fsm, message)))
+    return file_fsm.package(), result
+
+
+def reparse(file_fsm):
+    try:
+        return file_fsm.reparse(), None
+    except (FormatError, UndefineError) as e:
+        return None, e
+
+
+def check(rnd, path, edits):
+    model = random_model(rnd)
+    with open(path, 'w') as f:
+        f.write(render(model))
+    incremental = FileFsm(path, incremental=True)
+    incremental.parse()
+    full = FileFsm(path)
+    full.parse()
+    for _ in range(edits):
+        mutate(rnd, model)
+        text = render(model)
+        with open(path, 'w') as f:
+            f.write(text)
+        expected, expected_error = reparse(full)
+        actual, actual_error = reparse(incremental)
+        if (expected_error is None) != (actual_error is None):
+            print('error mismatch: %s / %s' % (expected_error, actual_error))
+            print(text)
+            return False
+        if expected_error is not None:
+            # 出错后两者都从当前内容重新开始
+            model = random_model(rnd)
+            with open(path, 'w') as f:
+                f.write(render(model))
+            incremental = FileFsm(path, incremental=True)
+            incremental.parse()
+            full = FileFsm(path)
+            full.parse()
+            continue
+        if expected != actual or snapshot(full) != snapshot(incremental):
+            print('mismatch:\n%s' % text)
+            print(expected)
+            print(actual)
+            return False
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Incremental reparse differential check')
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--edits', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    rnd = random.Random(args.seed)
+    work_dir = tempfile.mkdtemp(prefix='pb2json-incremental-')
+    try:
+        path = os.path.join(work_dir, 'diff.proto')
+        for _ in range(args.files):
+            if not check(rnd, path, args.edits):
+                return 1
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print('%d files, %d edits: ok' % (args.files, args.files * args.edits))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
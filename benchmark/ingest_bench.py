@@ -0,0 +1,118 @@
+#! /usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+json行编码的性能测试，比较各json解析实现及流水线
+
+生成json行文件后依次运行:
+    write_delimited     逐行读取文本，由MessageEncoder用标准库json解析后编码(原有方式)
+    parse:<实现>        只按块读取并解析json，不编码
+    serial:<实现>       JsonLinesPipeline的三个阶段在同一线程中依次执行
+    pipeline:<实现>     读取、解析、编码在不同线程中重叠执行
+各场景的输出须逐字节相同，否则返回1:
+
+    python ingest_bench.py --records 200000 --fields 20
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from pb_parser import FileFsm
+from pb_encoder import MessageEncoder
+from pb_ingest import JsonLinesPipeline, available_backends, decode_lines, get_backend, read_line_chunks, CHUNK_BYTES
+from bench import generate_proto, generate_records, peak_rss_kb
+
+
+class _DigestWriter:
+    """
+    只计算写入内容的哈希，不保存数据
+    """
+
+    def __init__(self):
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data):
+        self.sha1.update(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='JSON lines ingestion benchmark')
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--fields', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions per scenario, the best run is reported')
+    parser.add_argument('--chunk-bytes', type=int, default=CHUNK_BYTES)
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='pb2json-ingest-')
+    try:
+        proto_path = os.path.join(work_dir, 'ingest.proto')
+        fields = generate_proto(proto_path, 1, args.fields)
+        input_path = os.path.join(work_dir, 'records.jsonl')
+        with open(input_path, 'w', encoding='utf-8') as f:
+            for record in generate_records(fields, args.records):
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        size = os.path.getsize(input_path)
+        file_fsm = FileFsm(proto_path)
+        file_fsm.parse()
+        encoder = MessageEncoder(file_fsm.message('Message0'))
+
+        def write_delimited(output):
+            with open(input_path, 'rb') as stream:
+                encoder.write_delimited(io.TextIOWrapper(stream, encoding='utf-8'), output)
+
+        def parse_only(backend):
+            def run(output):
+                with open(input_path, 'rb') as stream:
+                    for chunk in read_line_chunks(stream, args.chunk_bytes):
+                        decode_lines(backend.loads, *chunk)
+            return run
+
+        def pipeline(backend, pipelined):
+            runner = JsonLinesPipeline(encoder, backend, args.chunk_bytes, pipelined=pipelined)
+
+            def run(output):
+                with open(input_path, 'rb') as stream:
+                    runner.run(stream, output)
+            return run
+
+        scenarios = [('write_delimited', write_delimited)]
+        for name in available_backends():
+            backend = get_backend(name)
+            scenarios.append(('parse:%s' % name, parse_only(backend)))
+            scenarios.append(('serial:%s' % name, pipeline(backend, False)))
+            scenarios.append(('pipeline:%s' % name, pipeline(backend, True)))
+
+        print('%d records, %d fields, %.1f MB' % (args.records, args.fields, size / 1e6))
+        digests = dict()
+        for name, func in scenarios:
+            best = None
+            for _ in range(args.repeat):
+                output = _DigestWriter()
+                start = time.perf_counter()
+                func(output)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            if not name.startswith('parse:'):
+                digests[name] = output.sha1.hexdigest()
+            print('%-18s %12.1f records/s %8.1f MB/s  rss=%sKB'
+                  % (name, args.records / best, size / best / 1e6, peak_rss_kb()))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if len(set(digests.values())) != 1:
+        for name, digest in sorted(digests.items()):
+            print('%s %s' % (digest, name))
+        print('outputs differ')
+        return 1
+    print('outputs identical: %s' % next(iter(digests.values())))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
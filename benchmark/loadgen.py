@@ -0,0 +1,183 @@
+#! /usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+pb_server的压力测试
+
+启动服务(或连接已启动的服务)，用多个连接并发发送请求，每个连接同时保持--pipeline个未完成的请求，
+输出吞吐量及p50/p99/p999延迟:
+
+    python loadgen.py --workers 4 --connections 64 --pipeline 8 --requests 100000
+    python loadgen.py --unix /tmp/pb.sock --proto a.proto --message pkg.Test --record '{"id": 1}'
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from pb_server import ConversionClient, OP_ENCODE, OP_DECODE
+from pb_encoder import MessageEncoder
+from pb_parser import FileFsm
+from bench import generate_proto, generate_records, percentile
+
+
+# 等待服务退出的时间，单位秒
+SERVER_STOP_TIMEOUT = 30
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'pb_server.py')
+
+
+async def _connect(args):
+    if args.unix:
+        return await ConversionClient.connect_unix(args.unix)
+    host, _, port = args.tcp.rpartition(':')
+    return await ConversionClient.connect_tcp(host or '127.0.0.1', int(port))
+
+
+async def _wait_server(args, process, timeout=30):
+    """
+    等待服务开始监听
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            client = await _connect(args)
+            await client.close()
+            return
+        except OSError:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError('server exited with code %d' % process.returncode)
+            if time.time() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def _run_connection(args, op, payload, count, latencies):
+    """
+    在一个连接上发送count个请求，同时保持args.pipeline个未完成的请求
+    """
+    client = await _connect(args)
+    errors = 0
+    window = asyncio.Semaphore(args.pipeline)
+
+    async def one():
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            await client.request(op, args.message, payload)
+        except Exception:
+            errors += 1
+        finally:
+            latencies.append(time.perf_counter() - start)
+            window.release()
+
+    tasks = []
+    for _ in range(count):
+        await window.acquire()
+        tasks.append(asyncio.ensure_future(one()))
+    await asyncio.gather(*tasks)
+    await client.close()
+    return errors
+
+
+async def _load(args, op, payload):
+    await _wait_server(args, args.process)
+    # 预热：每个工作进程首次处理某消息时需要构造编解码器
+    client = await _connect(args)
+    for _ in range(32):
+        await client.request(op, args.message, payload)
+    await client.close()
+
+    latencies = []
+    per_connection = [args.requests // args.connections] * args.connections
+    per_connection[0] += args.requests % args.connections
+    start = time.perf_counter()
+    errors = await asyncio.gather(*(_run_connection(args, op, payload, n, latencies) for n in per_connection))
+    elapsed = time.perf_counter() - start
+    return {
+        'operation': args.operation,
+        'connections': args.connections,
+        'pipeline': args.pipeline,
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'p999_ms': percentile(latencies, 99.9) * 1000
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='pb_server load generator')
+    parser.add_argument('--tcp', help='server address [host:]port')
+    parser.add_argument('--unix', help='server unix socket path')
+    parser.add_argument('--proto', help='.proto file, a synthetic schema is generated when omitted')
+    parser.add_argument('--message', help='full message name')
+    parser.add_argument('--record', help='json record to send')
+    parser.add_argument('--fields', type=int, default=20, help='fields of the synthetic message')
+    parser.add_argument('--operation', choices=['encode', 'decode'], default='encode')
+    parser.add_argument('--workers', type=int, default=None, help='start a server with this many workers')
+    parser.add_argument('--connections', type=int, default=32)
+    parser.add_argument('--pipeline', type=int, default=8, help='in-flight requests per connection')
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--output', help='save result as json')
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='pb2json-loadgen-')
+    process = None
+    try:
+        if args.proto is None:
+            args.proto = os.path.join(work_dir, 'loadgen.proto')
+            fields = generate_proto(args.proto, 1, args.fields)
+            args.message = 'bench.pkg.Message0'
+            args.record = json.dumps(generate_records(fields, 1)[0])
+        if not args.message or not args.record:
+            parser.error('--message and --record are required with --proto')
+
+        # 未指定服务地址或指定了进程数时，启动一个服务
+        if args.workers is not None or not (args.tcp or args.unix):
+            if not (args.tcp or args.unix):
+                args.unix = os.path.join(work_dir, 'pb.sock')
+            command = [sys.executable, SERVER_SCRIPT, args.proto]
+            command += ['--unix', args.unix] if args.unix else ['--tcp', args.tcp]
+            if args.workers is not None:
+                command += ['--workers', str(args.workers)]
+            process = subprocess.Popen(command)
+        args.process = process
+
+        payload = args.record.encode('utf-8')
+        op = OP_ENCODE
+        if args.operation == 'decode':
+            file_fsm = FileFsm(args.proto)
+            file_fsm.parse()
+            name = args.message[len(file_fsm.package()) + 1:] if file_fsm.package() else args.message
+            payload = MessageEncoder(file_fsm.message(name)).encode(args.record)
+            op = OP_DECODE
+
+        result = asyncio.run(_load(args, op, payload))
+        print('%-7s connections=%-4d pipeline=%-4d %10.1f req/s  p50=%.3fms  p99=%.3fms  p999=%.3fms  errors=%d' % (
+            result['operation'], result['connections'], result['pipeline'], result['throughput'],
+            result['p50_ms'], result['p99_ms'], result['p999_ms'], result['errors']))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(result, f, indent=2)
+    finally:
+        if process is not None:
+            # pb_server收到SIGTERM后关闭进程池再退出，超时未退出时强制结束
+            process.terminate()
+            try:
+                process.wait(timeout=SERVER_STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
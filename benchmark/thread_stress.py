@@ -0,0 +1,187 @@
+#! /usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+多线程共享同一组解析器、编解码器的压力测试
+
+多个线程同时:
+    从同一个延迟模式的FileFsm获取消息(触发消息的按需解析)，与完整解析的结果比较
+    使用共享的MessageEncoder、WireEncoder、MessageDecoder、BatchValidator编解码，与单线程的结果逐字节比较
+    调用serialize_many，并不时清空descriptor_cache
+线程切换间隔设为1微秒以增加交错的机会，统计计数须与实际操作数一致，任一结果不一致时返回1:
+
+    python thread_stress.py --threads 16 --iterations 2000
+"""
+
+import os
+import sys
+import random
+import argparse
+import tempfile
+import threading
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import pb_metrics
+from pb_parser import FileFsm, descriptor_cache
+from pb_encoder import MessageEncoder
+from pb_decoder import MessageDecoder
+from pb_wire import WireEncoder
+from pb_validate import BatchValidator
+from concurrent.futures import ThreadPoolExecutor
+from bench import ScalarValues
+
+
+def generate_proto(path, message_count):
+    """
+    生成相互引用的消息，MessageN引用MessageN-1及其嵌套枚举，Message0只有标量字段
+    :return: 各消息的标量字段[(字段名, 类型)]
+    """
+    types = sorted(ScalarValues)
+    fields = []
+    lines = ['package stress.pkg;']
+    for i in range(message_count):
+        lines.append('// message %d' % i)
+        lines.append('message Message%d {' % i)
+        lines.append('    enum Kind { A = 0; B = 1; }')
+        scalars = [('f%d' % j, types[(i + j) % len(types)]) for j in range(1, 6)]
+        for j, (name, field_type) in enumerate(scalars, 1):
+            lines.append('    optional %s %s = %d;' % (field_type, name, j))
+        if i > 0:
+            lines.append('    optional Kind kind = 10;')
+            lines.append('    optional Message%d prev = 11;' % (i - 1))
+            lines.append('    repeated Message%d.Kind kinds = 12;' % (i - 1))
+        lines.append('}')
+        fields.append(scalars)
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return fields
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='thread-safety stress test')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--iterations', type=int, default=2000, help='operations per thread')
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    sys.setswitchinterval(1e-6)
+    metrics = pb_metrics.enable()
+
+    work_dir = tempfile.mkdtemp(prefix='pb2json-stress-')
+    proto_path = os.path.join(work_dir, 'stress.proto')
+    fields = generate_proto(proto_path, args.messages)
+    reference_fsm = FileFsm(proto_path)
+    reference_fsm.parse()
+    expected_json = dict((m.name(), m.to_json()) for m in reference_fsm.messages())
+    lazy_fsm = FileFsm(proto_path, lazy=True)
+    lazy_fsm.parse()
+
+    # 共享的编解码器及单线程计算的参照结果
+    rnd = random.Random(args.seed)
+    scalar_message = reference_fsm.message('Message0')
+    records = [dict((name, ScalarValues[field_type](rnd)) for name, field_type in fields[0]) for _ in range(500)]
+    nested_message = reference_fsm.message('Message3')
+    nested_records = [{'f1': ScalarValues[fields[3][0][1]](rnd), 'kind': 'B', 'kinds': ['A', 'B'],
+                       'prev': {'kind': 1, 'prev': {'prev': {'f2': ScalarValues[fields[0][1][1]](rnd)}}}}
+                      for _ in range(200)]
+    encoder = MessageEncoder(scalar_message)
+    wire_encoder = WireEncoder(scalar_message)
+    decoder = MessageDecoder(scalar_message)
+    nested_encoder = MessageEncoder(nested_message)
+    nested_decoder = MessageDecoder(nested_message)
+    validator = BatchValidator(nested_message)
+    expected = [encoder.encode(record) for record in records]
+    expected_nested = [nested_encoder.encode(record) for record in nested_records]
+    expected_decoded = [decoder.decode(data) for data in expected]
+    metrics.reset()
+
+    executor = ThreadPoolExecutor(max_workers=4)
+    failures = []
+    counts = {'encode': 0, 'encode_wire': 0, 'decode': 0}
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(args.threads)
+
+    def fail(message):
+        with lock:
+            failures.append(message)
+
+    def worker(index):
+        local = random.Random(args.seed * 1000 + index)
+        local_counts = {'encode': 0, 'encode_wire': 0, 'decode': 0}
+        start_barrier.wait()
+        for step in range(args.iterations):
+            op = local.randrange(8)
+            try:
+                if op == 0:
+                    name = 'Message%d' % local.randrange(args.messages)
+                    message = lazy_fsm.message(name)
+                    if message.to_json() != expected_json[name]:
+                        fail('lazy message %s differs' % name)
+                    message.message_class_entry()
+                elif op == 1:
+                    i = local.randrange(len(records))
+                    if encoder.encode(records[i]) != expected[i]:
+                        fail('MessageEncoder output differs for record %d' % i)
+                    local_counts['encode'] += 1
+                elif op == 2:
+                    i = local.randrange(len(records))
+                    if wire_encoder.encode(records[i]) != expected[i]:
+                        fail('WireEncoder output differs for record %d' % i)
+                    local_counts['encode_wire'] += 1
+                elif op == 3:
+                    i = local.randrange(len(records))
+                    if decoder.decode(expected[i]) != expected_decoded[i]:
+                        fail('MessageDecoder output differs for record %d' % i)
+                    local_counts['decode'] += 1
+                elif op == 4:
+                    i = local.randrange(len(nested_records))
+                    if nested_encoder.encode(nested_records[i]) != expected_nested[i]:
+                        fail('nested encode differs for record %d' % i)
+                    if nested_encoder.encode(nested_decoder.decode(expected_nested[i])) != expected_nested[i]:
+                        fail('nested round trip differs for record %d' % i)
+                    local_counts['encode'] += 2
+                    local_counts['decode'] += 1
+                elif op == 5:
+                    result = validator.validate(nested_records[:20])
+                    if result.errors or nested_encoder.encode_many(result.records()) != expected_nested[:20]:
+                        fail('validated batch differs')
+                    local_counts['encode'] += 1
+                elif op == 6 and step % 50 == 0:
+                    output = encoder.serialize_many(records, chunk_records=50, executor=executor)
+                    if output != expected:
+                        fail('serialize_many output differs')
+                    local_counts['encode'] += len(records) // 50
+                elif op == 7 and step % 200 == 0:
+                    # 已构造的编解码器持有自己的消息类，清空缓存不影响它们
+                    descriptor_cache.invalidate()
+            except Exception as e:
+                fail('%s: %r' % (type(e).__name__, e))
+        with lock:
+            for key, value in local_counts.items():
+                counts[key] += value
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    executor.shutdown()
+    pb_metrics.disable()
+
+    stats = metrics.stats()
+    for stage, count in counts.items():
+        observed = stats.get(stage, {}).get('count', 0)
+        if observed != count:
+            failures.append('metrics %s count %d, expected %d' % (stage, observed, count))
+    os.remove(proto_path)
+    os.rmdir(work_dir)
+    if failures:
+        for message in failures[:20]:
+            print(message)
+        print('%d failures' % len(failures))
+        return 1
+    print('%d threads x %d operations: ok, %s' % (args.threads, args.iterations,
+                                                  ', '.join('%s=%d' % item for item in sorted(counts.items()))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#! /usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+BatchValidator与MessageEncoder的差分检查
+
+随机生成包含全部标量类型、枚举及嵌套消息的记录(含类型错误、越界、缺失required字段等错误值)，
+检查MessageEncoder不能编码的记录都不能通过校验，校验通过的记录转换后与原记录的编码结果逐字节一致:
+
+    python validate_diff.py --schemas 200 --records 200
+"""
+
+import os
+import sys
+import random
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from pb_parser import FileFsm, Message, Field
+from pb_encoder import MessageEncoder
+from pb_validate import BatchValidator
+from pb_wire import WireTypes
+from wire_diff import random_value
+
+# 嵌套消息及枚举的测试文件
+TREE_PROTO = '''package t.n;
+enum Color { RED = 0; GREEN = 1; BLUE = 2; }
+message Node {
+    enum Kind { LEAF = 0; BRANCH = 1; }
+    message Meta { required string tag = 1; repeated Color colors = 2; }
+    optional string name = 1;
+    optional Kind kind = 2;
+    repeated Node children = 3;
+    optional Meta meta = 4;
+    optional bytes blob = 5;
+}
+'''
+
+# 与字段类型不符或无法编码的值
+BadValues = [None, True, 1, -1, 2 ** 31, 2 ** 32, 2 ** 64, -2 ** 63 - 1, 1.5, float('nan'), 10 ** 400, '1', 'true',
+             'YWJj', 'a!', 'YW!Jj', '\ud800', b'abc', b'\xff', bytearray(b'a'), [], [1], {}, {'x': 1}]
+
+
+def mutate(rnd, value):
+    return rnd.choice(BadValues) if rnd.random() < 0.1 else value
+
+
+def random_record(rnd, fields):
+    record = {}
+    for field in fields:
+        if field.property == 'repeated':
+            record[field.name] = [mutate(rnd, random_value(rnd, field.type)) for _ in range(rnd.choice([0, 1, 3]))]
+            if rnd.random() < 0.05:
+                record[field.name] = rnd.choice(BadValues)
+        elif field.property == 'required' or rnd.random() < 0.7:
+            record[field.name] = mutate(rnd, random_value(rnd, field.type))
+    if rnd.random() < 0.02:
+        record['unknown'] = 1
+    return record
+
+
+def random_node(rnd, depth=0):
+    node = {}
+    for name, values in (('name', ['a', '中文', b'b', 1]), ('kind', ['LEAF', 'BRANCH', 0, 1, 5, 'X', True]),
+                         ('blob', ['YWJj', b'x', 'a!', 3])):
+        if rnd.random() < 0.6:
+            node[name] = rnd.choice(values) if rnd.random() < 0.2 else values[0]
+    if rnd.random() < 0.5:
+        node['meta'] = rnd.choice([{'tag': 't', 'colors': ['RED', 2]}, {'tag': 't', 'colors': ['RED', 'PINK']},
+                                   {'colors': [1]}, {'tag': 't'}, [], {'tag': 't', 'colors': 'RED'}])
+    if depth < 3 and rnd.random() < 0.5:
+        node['children'] = [random_node(rnd, depth + 1) for _ in range(rnd.randint(0, 3))]
+    return node
+
+
+def check_batch(encoder, validator, records):
+    result = validator.validate(records)
+    for row, (record, coerced) in enumerate(zip(records, result.iter_records())):
+        try:
+            expected = encoder.encode(record)
+        except Exception as e:
+            expected = e
+        if coerced is None:
+            # repeated字段只接受list/tuple，比MessageEncoder严格(后者接受任意可迭代对象)
+            if not isinstance(expected, Exception) and 'expected list' not in result.errors[row]:
+                print('rejected a valid record: %r, %s' % (record, result.errors[row]))
+                return False
+            continue
+        if isinstance(expected, Exception):
+            print('accepted an invalid record: %r, %s' % (record, expected))
+            return False
+        actual = encoder.encode(coerced)
+        if actual != expected:
+            print('mismatch: %r\n%r\n%r' % (record, expected, actual))
+            return False
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='BatchValidator differential check')
+    parser.add_argument('--schemas', type=int, default=200)
+    parser.add_argument('--records', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    rnd = random.Random(args.seed)
+    for index in range(args.schemas):
+        fields = []
+        for seq in rnd.sample(range(1, 100), rnd.randint(1, 8)):
+            field_type = rnd.choice(sorted(WireTypes))
+            fields.append(Field('f%d' % seq, field_type, rnd.choice(['required', 'optional', 'repeated']), seq, '', ''))
+        message = Message('Check%d' % index, 'validate.diff', '', fields)
+        records = [random_record(rnd, fields) for _ in range(args.records)]
+        if not check_batch(MessageEncoder(message), BatchValidator(message), records):
+            return 1
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'validate_diff_tree.proto')
+    with open(path, 'w') as f:
+        f.write(TREE_PROTO)
+    try:
+        file_fsm = FileFsm(path)
+        file_fsm.parse()
+    finally:
+        os.remove(path)
+    node = file_fsm.message('Node')
+    for _ in range(args.schemas):
+        if not check_batch(MessageEncoder(node), BatchValidator(node),
+                           [random_node(rnd) for _ in range(args.records // 10 + 1)]):
+            return 1
+    print('%d schemas, %d records: ok' % (args.schemas, args.schemas * args.records))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#! /usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+WireEncoder与protobuf SerializeToString()的差分检查
+
+随机生成包含全部标量类型、required/optional/repeated字段的消息及记录(含边界值)，
+分别用WireEncoder及protobuf编码并逐字节比较，packed编码时以设置了[packed=true]的描述符作为参照。
+部分记录混入与字段类型不符的值(整数字段中的bool、string字段中非法utf-8的bytes等)，检查两者拒绝的记录相同:
+
+    python wire_diff.py --schemas 200 --records 50
+"""
+
+import os
+import sys
+import random
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from pb_parser import Message, Field, compile_plan, fill_message, get_message_class
+from pb_wire import WireEncoder, WireTypes
+from my_exception import FormatError
+from google.protobuf import descriptor_pool
+from google.protobuf.descriptor_pb2 import FileDescriptorProto
+from bench import ScalarValues
+
+# 各整数类型的边界值
+Bounds = {
+    'int32': (-2 ** 31, 2 ** 31 - 1), 'sint32': (-2 ** 31, 2 ** 31 - 1), 'sfixed32': (-2 ** 31, 2 ** 31 - 1),
+    'int64': (-2 ** 63, 2 ** 63 - 1), 'sint64': (-2 ** 63, 2 ** 63 - 1), 'sfixed64': (-2 ** 63, 2 ** 63 - 1),
+    'uint32': (0, 2 ** 32 - 1), 'fixed32': (0, 2 ** 32 - 1), 'uint64': (0, 2 ** 64 - 1), 'fixed64': (0, 2 ** 64 - 1),
+}
+
+# float的边界值：超出float范围的值(包括整数)按同号的无穷大编码，过小的值下溢为0
+FloatBounds = (3.4028234663852886e38, -3.4028234663852886e38, 3.4028235e38, 3.4028236e38, -3.4028236e38, 1e39, -1e39,
+               10 ** 39, -10 ** 39, 1.7976931348623157e308, float('inf'), float('-inf'), float('nan'), 1e-46, -1e-46)
+
+Values = dict(ScalarValues, bytes=lambda r: bytes(r.randrange(256) for _ in range(r.randint(0, 300))),
+              string=lambda r: ''.join(r.choice('ab中文é') for _ in range(r.choice([0, 3, 200]))))
+
+# 与字段类型不符或无法编码的值
+BadValues = [True, False, 1.5, float('nan'), 2 ** 64, -2 ** 63 - 1, '1', 'YWJj', '!!', '\ud800', b'abc', b'\xff',
+             bytearray(b'a'), None, [], {}]
+
+
+def random_value(rnd, field_type):
+    if field_type in Bounds and rnd.random() < 0.3:
+        return rnd.choice(Bounds[field_type] + (0, -1 if Bounds[field_type][0] else 1, 127, 128))
+    if field_type == 'float' and rnd.random() < 0.3:
+        return rnd.choice(FloatBounds)
+    return Values[field_type](rnd)
+
+
+def reference_class(message, packed):
+    """
+    构造作为参照的消息类，packed时给repeated数值字段加上[packed=true]
+    """
+    file_proto = FileDescriptorProto(name='wire_diff_%s.proto' % message.name(), package=message.package())
+    message.fill_file_proto(file_proto)
+    if packed:
+        for fd in file_proto.message_type[0].field:
+            if fd.label == fd.LABEL_REPEATED and fd.type not in (fd.TYPE_STRING, fd.TYPE_BYTES):
+                fd.options.packed = True
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    descriptor = pool.FindMessageTypeByName(message.full_name())
+    return get_message_class(descriptor), compile_plan(descriptor)
+
+
+def check(rnd, index, records):
+    fields = []
+    for seq in rnd.sample(range(1, 3000), rnd.randint(1, 12)):
+        field_type = rnd.choice(sorted(WireTypes))
+        fields.append(Field('f%d' % seq, field_type, rnd.choice(['required', 'optional', 'repeated']), seq, '', ''))
+    message = Message('Diff%d' % index, 'wire.diff', '', fields)
+    packed = rnd.random() < 0.5
+    message_class, plan = reference_class(message, packed)
+    encoder = WireEncoder(message, packed=packed)
+    for _ in range(records):
+        record = {}
+        invalid = rnd.random() < 0.2
+        for field in fields:
+            if field.property == 'repeated':
+                record[field.name] = [random_value(rnd, field.type) for _ in range(rnd.choice([0, 1, 5]))]
+                if invalid and record[field.name] and rnd.random() < 0.3:
+                    record[field.name][-1] = rnd.choice(BadValues)
+            elif field.property == 'required' or rnd.random() < 0.7:
+                record[field.name] = random_value(rnd, field.type)
+                if invalid and rnd.random() < 0.3:
+                    record[field.name] = rnd.choice(BadValues)
+        try:
+            msg = message_class()
+            fill_message(msg, record, plan)
+            expected = msg.SerializeToString()
+        except Exception as e:
+            expected = e
+        try:
+            actual = encoder.encode(record)
+        except FormatError as e:
+            actual = e
+        if isinstance(expected, Exception) or isinstance(actual, Exception):
+            if isinstance(expected, Exception) != isinstance(actual, Exception):
+                print('rejected by one encoder only, packed=%s' % packed)
+                print(message.to_json())
+                print(record)
+                print(expected)
+                print(actual)
+                return False
+        elif actual != expected:
+            print('mismatch, packed=%s' % packed)
+            print(message.to_json())
+            print(record)
+            print(expected)
+            print(actual)
+            return False
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='WireEncoder differential check')
+    parser.add_argument('--schemas', type=int, default=200)
+    parser.add_argument('--records', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    rnd = random.Random(args.seed)
+    for index in range(args.schemas):
+        if not check(rnd, index, args.records):
+            return 1
+    print('%d schemas, %d records: ok' % (args.schemas, args.schemas * args.records))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -22,5 +22,13 @@ class UndefineError(Exception):
     def __init__(self, value):
         self.value = value
 
+    def __str__(self):
+        return repr(self.value)
+
+
+class ParseError(Exception):
+    def __init__(self, value):
+        self.value = value
+
     def __str__(self):
         return repr(self.value)
\ No newline at end of file
@@ -0,0 +1,205 @@
+#! /usr/bin/env python3
+# coding=utf-8
+
+import sys
+import json
+import argparse
+from itertools import chain
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pb_metrics
+from my_exception import ParamError, FormatError, UndefineError, ParseError
+from pb_registry import SchemaRegistry, full_message_name
+from pb_descriptor import read_descriptor_set
+from pb_ingest import JsonLinesPipeline, decode_lines, encode_records, get_backend, read_line_chunks
+from pb_encoder import MessageEncoder
+from pb_decoder import MessageDecoder, iter_delimited
+from google.protobuf.message import DecodeError
+
+
+# 每个任务包含的记录数
+CHUNK_RECORDS = 10000
+
+# 工作进程内的编解码器，由_init_worker初始化
+_encoder = None
+_decoder = None
+# 工作进程内的统计，指定了--metrics时由_init_worker开启
+_metrics = None
+# 工作进程内的json解析实现
+_json_loads = None
+
+
+def _load_message(proto_path, message_name, include_paths, descriptor_set=False):
+    """
+    解析proto文件及其import的文件，消息名可以是全限定名，也可以是相对于文件pkg的名称
+    descriptor_set为True时proto_path为pb_descriptor导出的FileDescriptorSet，不再解析proto文本，
+    消息名为全限定名，或者只有一个消息与之匹配的名称后缀
+    """
+    if descriptor_set:
+        bundle = read_descriptor_set(proto_path)
+        if message_name in bundle:
+            return bundle.message(message_name)
+        matches = [m for m in bundle.messages() if m.full_name().endswith('.' + message_name)]
+        if len(matches) == 1:
+            return matches[0]
+        raise ParamError('message %s not found in %s' % (message_name, proto_path))
+    registry = SchemaRegistry(include_paths)
+    registry.load([proto_path])
+    for full_name in (message_name, full_message_name(registry.file_package(proto_path), message_name)):
+        if full_name in registry:
+            return registry.message(full_name)
+    raise ParamError('message %s not found in %s' % (message_name, proto_path))
+
+
+def _init_worker(proto_path, message_name, include_paths, descriptor_set=False, json_backend='json', metrics=False):
+    """
+    初始化工作进程，每个进程只解析一次proto文件
+    """
+    global _encoder, _decoder, _metrics, _json_loads
+    if metrics and _metrics is None:
+        _metrics = pb_metrics.enable()
+    message = _load_message(proto_path, message_name, include_paths, descriptor_set)
+    _encoder = MessageEncoder(message)
+    _decoder = MessageDecoder(message)
+    _json_loads = get_backend(json_backend).loads
+
+
+def _encode_chunk(task):
+    """
+    将一批json行编码为以varint长度为前缀的二进制数据
+    :param task: (首行行号, json行列表)
+    """
+    records, numbers, error = decode_lines(_json_loads, *task)
+    output = encode_records(_encoder, records, numbers)
+    if error is not None:
+        raise error
+    return bytes(output)
+
+
+def _decode_chunk(task):
+    """
+    将一批二进制记录解码为json行
+    :param task: (首条记录序号, 记录列表)
+    """
+    record_number, records = task
+    lines = []
+    for data in records:
+        try:
+            lines.append(json.dumps(_decoder.decode(data), ensure_ascii=False))
+        except DecodeError as e:
+            raise FormatError('record %d: %s' % (record_number, e))
+        record_number += 1
+    lines.append('')
+    return '\n'.join(lines).encode('utf-8')
+
+
+def _run_chunk(worker, task):
+    """
+    在工作进程中执行任务，同时取出本进程的统计交给主进程合并
+    :return: (结果, 统计)
+    """
+    output = worker(task)
+    return output, (_metrics.drain() if _metrics is not None else None)
+
+
+def _chunks(items, chunk_records):
+    """
+    将输入按chunk_records条分组，附带每组首条的序号(从1开始)
+    """
+    chunk = []
+    number = 1
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_records:
+            yield number, chunk
+            number += len(chunk)
+            chunk = []
+    if chunk:
+        yield number, chunk
+
+
+def _run(tasks, worker, output, workers, initargs, metrics=None):
+    """
+    执行任务并按输入顺序写出结果
+    进程池中同时存在的任务数有上限，内存占用与输入总量无关
+    :param metrics  主进程的pb_metrics.Metrics，为None时不统计
+    """
+    if workers == 1:
+        # 单进程时直接使用主进程已开启的统计
+        _init_worker(*initargs)
+        for task in tasks:
+            output.write(worker(task))
+        return
+
+    def write(future):
+        data, stats = future.result()
+        if stats is not None:
+            metrics.merge(stats)
+        output.write(data)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=initargs + (metrics is not None,)) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(_run_chunk, worker, task))
+            if len(pending) >= workers * 2:
+                write(pending.popleft())
+        while pending:
+            write(pending.popleft())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pb2json', description='convert between JSON lines and length-delimited protobuf')
+    parser.add_argument('command', choices=['encode', 'decode'],
+                        help='encode: JSON lines to protobuf; decode: protobuf to JSON lines')
+    parser.add_argument('proto', help='.proto file, or a descriptor set exported by pb_descriptor with --descriptor-set')
+    parser.add_argument('message', help='message name, nested messages as Outer.Inner')
+    parser.add_argument('-I', '--include', action='append', default=[], help='directory to search for imports')
+    parser.add_argument('-i', '--input', default='-', help='input file, default stdin')
+    parser.add_argument('-o', '--output', default='-', help='output file, default stdout')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--chunk-records', type=int, default=CHUNK_RECORDS, help='records per worker task')
+    parser.add_argument('--descriptor-set', action='store_true', help='PROTO is an exported FileDescriptorSet')
+    parser.add_argument('--json-backend', choices=['auto', 'json', 'orjson'], default='json',
+                        help='JSON parser for encode, auto picks the fastest installed; output is identical')
+    parser.add_argument('--metrics', help='write per-stage metrics in Prometheus text format to this file')
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.chunk_records < 1:
+        parser.error('--workers and --chunk-records must be positive')
+
+    initargs = (args.proto, args.message, args.include, args.descriptor_set, args.json_backend)
+    metrics = pb_metrics.enable() if args.metrics else None
+    stream = output = None
+    try:
+        # 在主进程中先解析一次，尽早报告proto文件错误
+        _load_message(args.proto, args.message, args.include, args.descriptor_set)
+        stream = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+        output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+        if args.command == 'encode':
+            if args.workers == 1:
+                # 读取、json解析及编码在不同线程中重叠执行
+                _init_worker(*initargs)
+                JsonLinesPipeline(_encoder, args.json_backend).run(stream, output)
+            else:
+                lines = chain.from_iterable(chunk for line_number, chunk in read_line_chunks(stream))
+                _run(_chunks(lines, args.chunk_records), _encode_chunk, output, args.workers, initargs, metrics)
+        else:
+            _run(_chunks(iter_delimited(stream), args.chunk_records), _decode_chunk, output, args.workers, initargs,
+                 metrics)
+        output.flush()
+        if metrics is not None:
+            metrics.write_prometheus(args.metrics)
+    except (ParamError, FormatError, UndefineError, ParseError, OSError) as e:
+        sys.stderr.write('pb2json: %s\n' % e)
+        return 1
+    finally:
+        if metrics is not None:
+            pb_metrics.disable()
+        for f in (stream, output):
+            if f is not None and f not in (sys.stdin.buffer, sys.stdout.buffer):
+                f.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+# coding=utf-8
+
+import threading
+from collections import OrderedDict
+from my_exception import ParamError
+
+
+class DescriptorCache:
+    """
+    进程内共享的描述符/消息类缓存
+    以(pkg, 消息名, 字段指纹)为键，容量有限，超出后按LRU淘汰；所有操作线程安全
+    条目在锁外构造，同一条目同一时间只由一个线程构造，其他线程等待构造完成，不同条目可以同时构造
+    """
+
+    def __init__(self, max_size=256):
+        """
+        :param max_size     最大缓存条目数
+        """
+        if not isinstance(max_size, int) or max_size <= 0:
+            raise ParamError('Invalid Parameter max_size:[%s]' % str(max_size))
+        self.__max_size = max_size
+        self.__entries = OrderedDict()
+        # 正在构造的条目: 键 -> 构造完成时设置的threading.Event
+        self.__pending = dict()
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__entries
+
+    def get_or_create(self, key, creator):
+        """
+        查找缓存条目，未命中时调用creator()构造并放入缓存
+        :param key      (pkg, 消息名, 字段指纹)
+        :param creator  无参可调用对象，返回需要缓存的内容
+        :return:
+        """
+        while True:
+            with self.__lock:
+                try:
+                    entry = self.__entries[key]
+                except KeyError:
+                    pass
+                else:
+                    self.__entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                event = self.__pending.get(key)
+                if event is None:
+                    event = self.__pending[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # 其他线程正在构造同一条目，完成后重新查找；构造失败时由本线程重新构造
+            event.wait()
+
+        try:
+            entry = creator()
+        except BaseException:
+            with self.__lock:
+                del self.__pending[key]
+            event.set()
+            raise
+        with self.__lock:
+            del self.__pending[key]
+            self.__entries[key] = entry
+            if len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+        event.set()
+        return entry
+
+    def invalidate(self, pkg=None, message_name=None):
+        """
+        使缓存失效
+        不带参数时清空全部缓存；否则只删除与pkg/message_name匹配的条目
+        :param pkg:
+        :param message_name:
+        :return: 删除的条目数
+        """
+        with self.__lock:
+            if pkg is None and message_name is None:
+                count = len(self.__entries)
+                self.__entries.clear()
+                return count
+            keys = [key for key in self.__entries
+                    if (pkg is None or key[0] == pkg) and (message_name is None or key[1] == message_name)]
+            for key in keys:
+                del self.__entries[key]
+            return len(keys)
+
+    def stats(self):
+        """
+        返回缓存统计信息
+        :return:
+        """
+        with self.__lock:
+            return {'size': len(self.__entries),
+                    'max_size': self.__max_size,
+                    'hits': self.hits,
+                    'misses': self.misses}
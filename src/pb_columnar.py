@@ -0,0 +1,295 @@
+#! /usr/bin/env python3
+# coding=utf-8
+"""
+按列批量解码
+
+把以varint长度为前缀的PB数据直接解码为按列存放的小端字节缓冲区，不为每条记录构造字典:
+    数值字段(含枚举、bool)   values为定长数组，缺失的记录填0，validity为1字节/记录的有效标记
+    string/bytes字段         offsets为n+1个int64偏移，第i条记录的内容为data[offsets[i]:offsets[i+1]]
+    repeated字段             offsets为n+1个int64偏移，第i条记录的元素为values[offsets[i]:offsets[i+1]]，
+                             repeated string/bytes的元素再由value_offsets定位到data中
+安装了numpy时，各缓冲区以numpy.frombuffer零拷贝转换为numpy数组，否则为array.array/bytes
+"""
+
+import sys
+import time
+import struct
+import pb_metrics
+from array import array
+from my_exception import ParamError, FormatError
+from pb_parser import Message, is_repeated
+from pb_decoder import decode_varint
+from google.protobuf.descriptor import FieldDescriptor
+from google.protobuf.message import DecodeError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# 字段类型 -> 值的struct格式，string/bytes为None
+ColumnFormats = {
+    FieldDescriptor.TYPE_DOUBLE: '<d',
+    FieldDescriptor.TYPE_FLOAT: '<f',
+    FieldDescriptor.TYPE_INT64: '<q',
+    FieldDescriptor.TYPE_UINT64: '<Q',
+    FieldDescriptor.TYPE_INT32: '<i',
+    FieldDescriptor.TYPE_FIXED64: '<Q',
+    FieldDescriptor.TYPE_FIXED32: '<I',
+    FieldDescriptor.TYPE_BOOL: '<B',
+    FieldDescriptor.TYPE_STRING: None,
+    FieldDescriptor.TYPE_BYTES: None,
+    FieldDescriptor.TYPE_UINT32: '<I',
+    FieldDescriptor.TYPE_ENUM: '<i',
+    FieldDescriptor.TYPE_SFIXED32: '<i',
+    FieldDescriptor.TYPE_SFIXED64: '<q',
+    FieldDescriptor.TYPE_SINT32: '<i',
+    FieldDescriptor.TYPE_SINT64: '<q',
+}
+
+# struct格式 -> array.array类型码
+ArrayTypes = {'<d': 'd', '<f': 'f', '<q': 'q', '<Q': 'Q', '<i': 'i', '<I': 'I', '<B': 'B'}
+
+
+def _to_array(raw, fmt):
+    """
+    将小端字节缓冲区转换为数组，numpy可用时不复制数据
+    """
+    if numpy is not None:
+        return numpy.frombuffer(raw, dtype=numpy.bool_ if fmt == '<B' else numpy.dtype(fmt))
+    values = array(ArrayTypes[fmt])
+    values.frombytes(bytes(raw))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _to_offsets(offsets):
+    if numpy is None:
+        return offsets
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    return numpy.frombuffer(offsets, dtype='<i8')
+
+
+def _to_bytes(data):
+    return numpy.frombuffer(data, dtype=numpy.uint8) if numpy is not None else bytes(data)
+
+
+class Column:
+    """
+    一列数据，各属性的含义见模块说明，不适用的属性为None
+    """
+
+    __slots__ = ('name', 'type', 'repeated', 'values', 'validity', 'offsets', 'value_offsets', 'data')
+
+    def __init__(self, name, field_type, repeated, values=None, validity=None, offsets=None, value_offsets=None,
+                 data=None):
+        self.name = name
+        self.type = field_type
+        self.repeated = repeated
+        self.values = values
+        self.validity = validity
+        self.offsets = offsets
+        self.value_offsets = value_offsets
+        self.data = data
+
+    def to_list(self):
+        """
+        转换为每条记录一个值的列表，缺失的值为None，用于调试及核对
+        :return:
+        """
+        data = bytes(self.data) if self.data is not None else None
+        if self.repeated:
+            offsets = [int(v) for v in self.offsets]
+            if data is None:
+                values = [self.__value(v) for v in self.values]
+                return [values[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+            value_offsets = [int(v) for v in self.value_offsets]
+            items = [self.__item(data, value_offsets[j], value_offsets[j + 1]) for j in range(len(value_offsets) - 1)]
+            return [items[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        if data is None:
+            return [self.__value(v) if valid else None for v, valid in zip(self.values, self.validity)]
+        offsets = [int(v) for v in self.offsets]
+        return [self.__item(data, offsets[i], offsets[i + 1]) if self.validity[i] else None
+                for i in range(len(offsets) - 1)]
+
+    def __value(self, value):
+        value = value.item() if hasattr(value, 'item') else value
+        return bool(value) if self.type == 'bool' else value
+
+    def __item(self, data, start, end):
+        return data[start:end].decode('utf-8') if self.type == 'string' else data[start:end]
+
+
+class _ColumnBuilder:
+    """
+    解码过程中的一列
+    """
+
+    __slots__ = ('name', 'type', 'repeated', 'fmt', 'size', 'string', 'pack_into', 'raw', 'validity', 'offsets',
+                 'value_offsets', 'data')
+
+    def __init__(self, fd, field_type, num_rows):
+        self.name = fd.name
+        self.type = field_type
+        self.repeated = is_repeated(fd)
+        self.fmt = ColumnFormats[fd.type]
+        self.size = struct.calcsize(self.fmt) if self.fmt else 0
+        self.string = fd.type == FieldDescriptor.TYPE_STRING
+        self.pack_into = struct.Struct(self.fmt).pack_into if self.fmt else None
+        # 非repeated数值列预先分配，按记录序号写入；其余列按顺序追加
+        self.raw = bytearray(self.size * num_rows) if (self.fmt and not self.repeated) else bytearray()
+        self.validity = None if self.repeated else bytearray(num_rows)
+        self.offsets = array('q', [0]) if (self.repeated or not self.fmt) else None
+        self.value_offsets = array('q', [0]) if (self.repeated and not self.fmt) else None
+        self.data = bytearray() if not self.fmt else None
+
+    def put(self, index, value):
+        """
+        写入第index条记录的值
+        """
+        if self.fmt is None:
+            self.data += value.encode('utf-8') if self.string else value
+            self.validity[index] = 1
+        elif self.repeated:
+            self.raw += struct.pack('<%d%s' % (len(value), self.fmt[1]), *value)
+        else:
+            self.pack_into(self.raw, index * self.size, value)
+            self.validity[index] = 1
+
+    def put_strings(self, values):
+        """
+        写入一条记录的repeated string/bytes字段
+        """
+        data = self.data
+        value_offsets = self.value_offsets
+        for value in values:
+            data += value.encode('utf-8') if self.string else value
+            value_offsets.append(len(data))
+
+    def end_row(self):
+        """
+        一条记录结束，补齐变长列的偏移
+        """
+        if self.repeated:
+            self.offsets.append(len(self.raw) // self.size if self.fmt else len(self.value_offsets) - 1)
+        elif self.fmt is None:
+            self.offsets.append(len(self.data))
+
+    def build(self):
+        return Column(self.name, self.type, self.repeated,
+                      _to_array(self.raw, self.fmt) if self.fmt else None,
+                      None if self.validity is None else _to_array(self.validity, '<B'),
+                      None if self.offsets is None else _to_offsets(self.offsets),
+                      None if self.value_offsets is None else _to_offsets(self.value_offsets),
+                      None if self.data is None else _to_bytes(self.data))
+
+
+class ColumnarDecoder:
+    """
+    按列批量解码器
+    消息结构只编译一次；解码时复用同一个消息对象，逐条解析后把已设置字段的值直接写入所在列的缓冲区
+    消息对象及各列的缓冲区在每次decode()时创建，可在多个线程中同时使用
+    """
+
+    def __init__(self, message=None, json_string=None, fields=None):
+        """
+        :param message      Message实例，如FileFsm.message()的返回值
+        :param json_string  描述消息的json字符串，格式同Message
+        :param fields       需要解码的字段名列表，默认为全部非消息类型的字段
+        """
+        if message is None:
+            if json_string is None:
+                raise ParamError('Invalid Parameter, message or json_string is required')
+            message = Message(json_string=json_string)
+        if not isinstance(message, Message):
+            raise ParamError('Invalid Parameter message:[%s]' % str(message))
+        self.__message = message
+        self.__entry = message.message_class_entry()
+        self.__field_types = dict((field.name, field.type) for field in message.fields())
+        self.__fields = []
+        for fd in self.__entry.descriptor.fields:
+            if fields is not None and fd.name not in fields:
+                continue
+            if fd.type not in ColumnFormats:
+                if fields is not None:
+                    raise FormatError('field %s: type %s not support for columnar decode'
+                                      % (fd.name, self.__field_types[fd.name]))
+                continue
+            self.__fields.append(fd)
+        if fields is not None:
+            unknown = set(fields) - set(fd.name for fd in self.__fields)
+            if unknown:
+                raise FormatError('unknown field %s for message %s' % (', '.join(sorted(unknown)), message.name()))
+
+    def message(self):
+        """
+        返回解码器使用的消息结构
+        :return:
+        """
+        return self.__message
+
+    def decode(self, buffer):
+        """
+        解码以varint长度为前缀的数据
+        :param buffer   bytes/bytearray/mmap/memoryview
+        :return: 字段名到Column的字典，按字段声明顺序排列
+        """
+        hook = pb_metrics.hook
+        start = time.perf_counter() if hook is not None else 0
+        buffer = memoryview(buffer).cast('B')
+        spans = []
+        pos = 0
+        size = len(buffer)
+        while pos < size:
+            header = decode_varint(buffer, pos)
+            if header is None or header[0] + header[1] > size:
+                raise FormatError('truncated record at offset %d' % pos)
+            length, pos = header
+            spans.append((pos, pos + length))
+            pos += length
+        columns = self.__decode((buffer[begin:end] for begin, end in spans), len(spans))
+        if hook is not None:
+            hook('decode_columnar', time.perf_counter() - start, len(spans), size)
+        return columns
+
+    def decode_records(self, records):
+        """
+        解码多条记录
+        :param records  每条记录的二进制数据，如RecordReader.raw()的返回值
+        :return: 同decode
+        """
+        hook = pb_metrics.hook
+        start = time.perf_counter() if hook is not None else 0
+        records = list(records)
+        columns = self.__decode(records, len(records))
+        if hook is not None:
+            hook('decode_columnar', time.perf_counter() - start, len(records), sum(len(record) for record in records))
+        return columns
+
+    def __decode(self, records, num_rows):
+        """
+        :param records  每条记录的二进制数据
+        :param num_rows 记录数
+        """
+        builders = dict((fd, _ColumnBuilder(fd, self.__field_types[fd.name], num_rows)) for fd in self.__fields)
+        row_builders = [builder for builder in builders.values() if builder.repeated or builder.fmt is None]
+        msg = self.__entry.message_class()
+        for index, record in enumerate(records):
+            try:
+                msg.ParseFromString(record)
+            except DecodeError as e:
+                raise FormatError('record %d: %s' % (index, e))
+            for fd, value in msg.ListFields():
+                builder = builders.get(fd)
+                if builder is None:
+                    continue
+                if builder.repeated and builder.fmt is None:
+                    builder.put_strings(value)
+                else:
+                    builder.put(index, value)
+            for builder in row_builders:
+                builder.end_row()
+        return dict((builder.name, builder.build()) for builder in builders.values())
@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+# coding=utf-8
+
+import json
+import time
+import base64
+import pb_metrics
+from my_exception import ParamError, FormatError
+from pb_parser import Message, is_repeated
+from google.protobuf.descriptor import FieldDescriptor
+
+
+# 每次从流中读取的字节数
+CHUNK_SIZE = 64 * 1024
+# 单条记录的最大长度，防止错误数据导致内存无限增长
+MAX_RECORD_SIZE = 64 * 1024 * 1024
+
+
+def decode_varint(buffer, pos):
+    """
+    从buffer的pos位置解码varint
+    :param buffer:
+    :param pos:
+    :return: (值, 结束位置)，数据不完整时返回None
+    """
+    value = 0
+    shift = 0
+    end = len(buffer)
+    while pos < end:
+        byte = buffer[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+        if shift >= 64:
+            raise FormatError('invalid varint, too many bytes')
+    return None
+
+
+def iter_delimited(stream, chunk_size=CHUNK_SIZE, max_record_size=MAX_RECORD_SIZE):
+    """
+    从以varint长度为前缀的数据流中逐条读取记录
+    按块读取，内存占用与单条记录长度相关，与流的总长度无关
+    :param stream           文件对象(read)或socket对象(recv)
+    :param chunk_size       每次读取的字节数
+    :param max_record_size  单条记录的最大长度
+    :return: 每条记录的二进制数据
+    """
+    read = getattr(stream, 'read', None) or getattr(stream, 'recv', None)
+    if read is None:
+        raise ParamError('Invalid Parameter stream, read() or recv() is required')
+    buffer = bytearray()
+    pos = 0
+    eof = False
+    while True:
+        header = decode_varint(buffer, pos)
+        if header is not None:
+            length, start = header
+            if length > max_record_size:
+                raise FormatError('record length %d exceeds limit %d' % (length, max_record_size))
+            if len(buffer) >= start + length:
+                yield bytes(buffer[start:start + length])
+                pos = start + length
+                continue
+        if eof:
+            if pos < len(buffer):
+                raise FormatError('truncated record at end of stream')
+            return
+        # 丢弃已处理的数据后继续读取
+        del buffer[:pos]
+        pos = 0
+        chunk = read(chunk_size)
+        if not chunk:
+            eof = True
+        else:
+            buffer += chunk
+
+
+def _to_json_value(field_descriptor, value):
+    # bytes字段以base64字符串表示，枚举以枚举值名称表示，与MessageEncoder一致
+    if field_descriptor.type == FieldDescriptor.TYPE_BYTES:
+        return base64.b64encode(value).decode('ascii')
+    if field_descriptor.type == FieldDescriptor.TYPE_MESSAGE:
+        return message_to_dict(value)
+    if field_descriptor.type == FieldDescriptor.TYPE_ENUM:
+        enum_value = field_descriptor.enum_type.values_by_number.get(value)
+        return value if enum_value is None else enum_value.name
+    return value
+
+
+def message_to_dict(msg):
+    """
+    将消息对象转换为字段名到字段值的字典，只包含已设置的字段，子消息转换为字典
+    :param msg:
+    :return:
+    """
+    record = {}
+    for fd, value in msg.ListFields():
+        if is_repeated(fd):
+            record[fd.name] = [_to_json_value(fd, v) for v in value]
+        else:
+            record[fd.name] = _to_json_value(fd, value)
+    return record
+
+
+class MessageDecoder:
+    """
+    PB二进制数据解码器
+    使用FileFsm解析得到的消息结构，将二进制数据还原为字段名到字段值的字典
+    每次解码使用新的消息对象，可在多个线程中同时使用
+    """
+
+    def __init__(self, message=None, json_string=None):
+        """
+        :param message      Message实例，如FileFsm.message()的返回值
+        :param json_string  描述消息的json字符串，格式同Message
+        """
+        if message is None:
+            if json_string is None:
+                raise ParamError('Invalid Parameter, message or json_string is required')
+            message = Message(json_string=json_string)
+        if not isinstance(message, Message):
+            raise ParamError('Invalid Parameter message:[%s]' % str(message))
+        self.__message = message
+        self.__entry = message.message_class_entry()
+
+    def message(self):
+        """
+        返回解码器使用的消息结构
+        :return:
+        """
+        return self.__message
+
+    def decode(self, data):
+        """
+        解码一条记录，只返回已设置的字段
+        :param data:
+        :return: 字段名到字段值的字典
+        """
+        hook = pb_metrics.hook
+        if hook is None:
+            msg = self.__entry.message_class()
+            msg.ParseFromString(data)
+            return message_to_dict(msg)
+        start = time.perf_counter()
+        msg = self.__entry.message_class()
+        msg.ParseFromString(data)
+        record = message_to_dict(msg)
+        hook('decode', time.perf_counter() - start, 1, len(data))
+        return record
+
+    def iter_decode(self, stream, chunk_size=CHUNK_SIZE, max_record_size=MAX_RECORD_SIZE):
+        """
+        逐条解码以varint长度为前缀的数据流
+        :param stream:
+        :return: 每条记录的字典
+        """
+        for data in iter_delimited(stream, chunk_size, max_record_size):
+            yield self.decode(data)
+
+    def write_json_lines(self, stream, output, chunk_size=CHUNK_SIZE, max_record_size=MAX_RECORD_SIZE):
+        """
+        将数据流逐条解码，每条记录以一行json字符串写入output
+        :param stream   输入的二进制流
+        :param output   可写的文本流
+        :return: 写入的记录数
+        """
+        count = 0
+        for record in self.iter_decode(stream, chunk_size, max_record_size):
+            output.write(json.dumps(record, ensure_ascii=False))
+            output.write('\n')
+            count += 1
+        return count
@@ -0,0 +1,423 @@
+#! /usr/bin/env python3
+# coding=utf-8
+"""
+解析结果导出为FileDescriptorSet及结构指纹
+
+导出的FileDescriptorSet可直接添加到DescriptorPool，启动时不再解析.proto文本:
+
+    data = export_descriptor_set(registry)          # 或FileFsm、DescriptorSet
+    bundle = load_descriptor_set(data)
+    encoder = MessageEncoder(bundle.message('t.n.Node'))
+
+每个消息的指纹为其自身及直接或间接引用的消息、枚举结构的哈希，包括全限定名、字段名、序号、类型、属性及枚举项，
+不包括注释、声明顺序、文件名及未被引用的类型，生产方与消费方可比较指纹发现结构不一致:
+
+    python pb_descriptor.py export test.proto -I include -o test.desc
+    python pb_descriptor.py fingerprint test.desc
+    python pb_descriptor.py diff old.desc new.proto
+"""
+
+import os
+import sys
+import hashlib
+import argparse
+from my_exception import ParamError, FormatError, ParseError
+from pb_parser import FileFsm, Field, Message, EnumType, DescriptorSet, FieldType2PbType, is_repeated, is_required
+from pb_registry import SchemaRegistry
+from google.protobuf.descriptor_pb2 import FieldDescriptorProto, FileDescriptorProto, FileDescriptorSet
+from google.protobuf.message import DecodeError
+from google.protobuf import descriptor_pool
+
+
+# FieldDescriptorProto中的类型编号 -> 字段类型
+PbType2FieldType = dict((pb_type, field_type) for field_type, pb_type in FieldType2PbType.items())
+
+
+def export_descriptor_set(source, paths=None, root=None):
+    """
+    导出为序列化的FileDescriptorSet，文件按依赖顺序排列，相同的结构总是得到相同的字节
+    :param source   FileFsm(不能有import)、SchemaRegistry或DescriptorSet
+    :param paths    source为SchemaRegistry时导出的文件路径列表(及其依赖的文件)，默认为全部完成类型解析的文件
+    :param root     source为SchemaRegistry时，文件名为相对于root的路径，默认为全部文件所在目录的公共上级目录
+    :return: bytes
+    """
+    descriptor_set = FileDescriptorSet()
+    descriptor_set.file.extend(_dependency_order(_file_protos(source, paths, root)))
+    return descriptor_set.SerializeToString(deterministic=True)
+
+
+def _file_protos(source, paths, root):
+    """
+    返回source中的文件描述列表
+    """
+    if isinstance(source, FileFsm):
+        if source.imports():
+            raise ParamError('file with imports can not be exported alone, load it with SchemaRegistry')
+        return [source.to_file_proto()]
+    if isinstance(source, DescriptorSet):
+        return list(source.file_protos())
+    if not isinstance(source, SchemaRegistry):
+        raise ParamError('Invalid Parameter source:[%s]' % str(source))
+
+    linked = dict()
+    for path in source.files():
+        try:
+            linked[path] = source.file_proto(path)
+        except KeyError:
+            continue
+    if paths is None:
+        selected = list(linked)
+    else:
+        selected = []
+        pending = [os.path.abspath(path) for path in paths]
+        while pending:
+            path = pending.pop()
+            if path in selected:
+                continue
+            if path not in linked:
+                raise ParamError('file %s is not loaded' % path)
+            selected.append(path)
+            pending.extend(linked[path].dependency)
+    if not selected:
+        return []
+    if root is None:
+        root = os.path.commonpath([os.path.dirname(path) for path in selected])
+    names = dict((path, os.path.relpath(path, root).replace(os.sep, '/')) for path in selected)
+    file_protos = []
+    for path in selected:
+        file_proto = FileDescriptorProto()
+        file_proto.CopyFrom(linked[path])
+        file_proto.name = names[path]
+        file_proto.dependency[:] = [names[dependency] for dependency in linked[path].dependency]
+        file_protos.append(file_proto)
+    return file_protos
+
+
+def _dependency_order(file_protos):
+    """
+    按依赖顺序排列文件描述，被导入的文件在前；结果与输入顺序无关
+    """
+    by_name = dict((file_proto.name, file_proto) for file_proto in file_protos)
+    order = []
+    done = set()
+    for name in sorted(by_name):
+        visiting = [name]
+        stack = [(name, iter(by_name[name].dependency))]
+        while stack:
+            current, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                visiting.pop()
+                if current not in done:
+                    done.add(current)
+                    order.append(by_name[current])
+            elif child in visiting:
+                raise FormatError('import cycle %s' % ' -> '.join(visiting[visiting.index(child):] + [child]))
+            elif child not in done:
+                if child not in by_name:
+                    raise FormatError('%s: import %s not found in descriptor set' % (current, child))
+                visiting.append(child)
+                stack.append((child, iter(by_name[child].dependency)))
+    return order
+
+
+def load_descriptor_set(data, pool=None):
+    """
+    加载序列化的FileDescriptorSet
+    :param data     export_descriptor_set()的结果，或protoc --include_imports生成的proto2描述
+    :param pool     添加到的描述符池，为None时新建
+    :return: SchemaBundle
+    """
+    try:
+        descriptor_set = FileDescriptorSet.FromString(data)
+    except DecodeError as e:
+        raise FormatError('invalid descriptor set: %s' % e)
+    return SchemaBundle(_dependency_order(descriptor_set.file), pool)
+
+
+def read_descriptor_set(path, pool=None):
+    """
+    从文件加载FileDescriptorSet
+    :param path:
+    :param pool:
+    :return: SchemaBundle
+    """
+    with open(path, 'rb') as f:
+        return load_descriptor_set(f.read(), pool)
+
+
+class SchemaBundle:
+    """
+    从FileDescriptorSet加载的消息及枚举
+    全部文件添加到同一个描述符池，其中的消息都关联同一个DescriptorSet，消息类直接从该描述符池获取；
+    FileDescriptorSet不含注释，消息及字段的注释为空。加载完成后不再修改，可在多个线程中同时使用
+    """
+
+    def __init__(self, file_protos, pool=None):
+        """
+        :param file_protos  FileDescriptorProto列表，每个文件依赖的文件必须排在它之前
+        :param pool         添加到的描述符池，为None时新建；指定时消息类从该描述符池获取，不与其他描述符池共用缓存
+        """
+        # 调用方提供的描述符池以id()区分缓存条目，缓存条目引用描述符池，条目存在期间id不会被复用
+        pool_token = None if pool is None else id(pool)
+        if pool is None:
+            pool = descriptor_pool.DescriptorPool()
+        for file_proto in file_protos:
+            if file_proto.syntax not in ('', 'proto2'):
+                raise FormatError('%s: syntax %s is not supported' % (file_proto.name, file_proto.syntax))
+            try:
+                pool.Add(file_proto)
+            except (TypeError, KeyError, ValueError) as e:
+                raise FormatError('%s: %s' % (file_proto.name, e))
+        self.__pool = pool
+        self.__descriptor_set = DescriptorSet(file_protos, pool, pool_token)
+        # 全限定名 -> 消息，包括嵌套消息
+        self.__messages = dict()
+        # 全限定名 -> 枚举，包括嵌套枚举
+        self.__enums = dict()
+        # 文件名 -> 顶层消息列表
+        self.__files = dict()
+        for file_proto in file_protos:
+            messages = [self.__load_message(proto, file_proto.package, '') for proto in file_proto.message_type]
+            for enum_proto in file_proto.enum_type:
+                self.__load_enum(enum_proto, file_proto.package, '')
+            self.__files[file_proto.name] = messages
+        self.__fingerprints = dict()
+
+    def __len__(self):
+        return len(self.__messages)
+
+    def __contains__(self, full_name):
+        return full_name in self.__messages
+
+    def __load_message(self, message_proto, pkg, scope):
+        message = Message(message_name=message_proto.name, message_pkg=pkg, message_fields=[], message_scope=scope)
+        for field_proto in message_proto.field:
+            if field_proto.type not in PbType2FieldType:
+                raise FormatError('field %s.%s: type %d is not supported'
+                                  % (message.full_name(), field_proto.name, field_proto.type))
+            field_type = PbType2FieldType[field_proto.type]
+            message.add_field(Field(field_proto.name, field_type, _label_name(field_proto.label), field_proto.number,
+                                    '', '', field_type_name=field_proto.type_name or None))
+        nested_scope = '%s.%s' % (scope, message_proto.name) if scope else message_proto.name
+        for nested_proto in message_proto.nested_type:
+            message.add_nested_message(self.__load_message(nested_proto, pkg, nested_scope))
+        for enum_proto in message_proto.enum_type:
+            message.add_enum(self.__load_enum(enum_proto, pkg, nested_scope))
+        message.set_descriptor_set(self.__descriptor_set)
+        self.__messages[message.full_name()] = message
+        return message
+
+    def __load_enum(self, enum_proto, pkg, scope):
+        enum = EnumType(enum_proto.name, pkg, None, [(value.name, value.number) for value in enum_proto.value], scope)
+        self.__enums[enum.full_name()] = enum
+        return enum
+
+    def pool(self):
+        """
+        返回包含全部文件的描述符池
+        :return:
+        """
+        return self.__pool
+
+    def descriptor_set(self):
+        """
+        返回全部消息关联的DescriptorSet
+        :return:
+        """
+        return self.__descriptor_set
+
+    def message(self, full_name):
+        """
+        按全限定名查找消息
+        :param full_name:
+        :return:
+        """
+        return self.__messages[full_name]
+
+    def messages(self):
+        """
+        返回全部消息(包括嵌套消息)，按文件的依赖顺序及声明顺序排列
+        :return:
+        """
+        return list(self.__messages.values())
+
+    def enum(self, full_name):
+        """
+        按全限定名查找枚举
+        :param full_name:
+        :return:
+        """
+        return self.__enums[full_name]
+
+    def files(self):
+        """
+        返回文件名列表，按依赖顺序排列
+        :return:
+        """
+        return list(self.__files.keys())
+
+    def file_messages(self, name):
+        """
+        返回指定文件中的顶层消息列表
+        :param name:
+        :return:
+        """
+        return self.__files[name]
+
+    def fingerprint(self, full_name):
+        """
+        返回消息的结构指纹，见message_fingerprint()
+        :param full_name:
+        :return:
+        """
+        fingerprint = self.__fingerprints.get(full_name)
+        if fingerprint is None:
+            if full_name not in self.__messages:
+                raise KeyError(full_name)
+            fingerprint = message_fingerprint(self.__pool.FindMessageTypeByName(full_name))
+            self.__fingerprints[full_name] = fingerprint
+        return fingerprint
+
+    def fingerprints(self):
+        """
+        返回全部消息的结构指纹
+        :return: 全限定名 -> 指纹
+        """
+        return dict((full_name, self.fingerprint(full_name)) for full_name in self.__messages)
+
+
+def _label_name(label):
+    if label == FieldDescriptorProto.LABEL_REPEATED:
+        return 'repeated'
+    if label == FieldDescriptorProto.LABEL_REQUIRED:
+        return 'required'
+    return 'optional'
+
+
+def _type_text(descriptor, kind):
+    """
+    返回单个消息或枚举的规范文本，字段按序号排列，枚举项按数值及名称排列
+    """
+    if kind == 'enum':
+        values = sorted((value.number, value.name) for value in descriptor.values)
+        return 'enum %s {%s}' % (descriptor.full_name, ' '.join('%s=%d' % (name, number) for number, name in values))
+    fields = []
+    for field in sorted(descriptor.fields, key=lambda f: f.number):
+        label = 'repeated' if is_repeated(field) else ('required' if is_required(field) else 'optional')
+        if field.message_type is not None:
+            type_name = '.' + field.message_type.full_name
+        elif field.enum_type is not None:
+            type_name = '.' + field.enum_type.full_name
+        else:
+            type_name = ''
+        fields.append('%d %s %s %d%s' % (field.number, field.name, label, field.type, type_name))
+    return 'message %s {%s}' % (descriptor.full_name, '; '.join(fields))
+
+
+def message_fingerprint(descriptor):
+    """
+    计算消息的结构指纹
+    结构包括消息自身及其直接或间接引用的消息、枚举，各类型按全限定名排列，循环引用的类型只计入一次
+    :param descriptor   消息描述符(Descriptor)
+    :return: sha1十六进制字符串
+    """
+    types = dict()
+    pending = [(descriptor, 'message')]
+    while pending:
+        item, kind = pending.pop()
+        if item.full_name in types:
+            continue
+        types[item.full_name] = _type_text(item, kind)
+        if kind == 'message':
+            for field in item.fields:
+                if field.message_type is not None:
+                    pending.append((field.message_type, 'message'))
+                elif field.enum_type is not None:
+                    pending.append((field.enum_type, 'enum'))
+    sha1 = hashlib.sha1()
+    for full_name in sorted(types):
+        sha1.update(types[full_name].encode('utf-8'))
+        sha1.update(b'\n')
+    return sha1.hexdigest()
+
+
+def schema_fingerprints(source, paths=None):
+    """
+    计算全部消息的结构指纹，不必先导出
+    :param source   FileFsm、SchemaRegistry、DescriptorSet或SchemaBundle
+    :param paths    source为SchemaRegistry时计算的文件路径列表(及其依赖的文件)
+    :return: 全限定名 -> 指纹
+    """
+    if isinstance(source, SchemaBundle):
+        return source.fingerprints()
+    return load_descriptor_set(export_descriptor_set(source, paths)).fingerprints()
+
+
+def diff_fingerprints(old, new):
+    """
+    比较两组指纹
+    :param old  全限定名 -> 指纹
+    :param new  全限定名 -> 指纹
+    :return: (新增的消息, 删除的消息, 结构变化的消息)，均按全限定名排列
+    """
+    added = sorted(name for name in new if name not in old)
+    removed = sorted(name for name in old if name not in new)
+    changed = sorted(name for name in new if name in old and new[name] != old[name])
+    return added, removed, changed
+
+
+def _load_source(path, include_paths):
+    """
+    命令行使用：.proto文件用SchemaRegistry解析，其他文件按FileDescriptorSet加载
+    """
+    if path.endswith('.proto'):
+        registry = SchemaRegistry(include_paths)
+        registry.load([path])
+        return registry, [path]
+    return read_descriptor_set(path), None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='export parsed schema as FileDescriptorSet and compare fingerprints')
+    parser.add_argument('command', choices=['export', 'fingerprint', 'diff'],
+                        help='export: write FileDescriptorSet; fingerprint: print message fingerprints; '
+                             'diff: compare fingerprints of two schemas')
+    parser.add_argument('schema', nargs='+', help='.proto files or exported descriptor sets')
+    parser.add_argument('-I', '--include', action='append', default=[], help='directory to search for imports')
+    parser.add_argument('-o', '--output', help='export: output file')
+    parser.add_argument('--root', help='export: file names are relative to this directory')
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'export':
+            if not args.output or not all(path.endswith('.proto') for path in args.schema):
+                parser.error('export needs .proto files and --output')
+            registry = SchemaRegistry(args.include)
+            paths = registry.load(args.schema)
+            data = export_descriptor_set(registry, paths, args.root)
+            with open(args.output, 'wb') as f:
+                f.write(data)
+            print('%d bytes written to %s' % (len(data), args.output))
+        elif args.command == 'fingerprint':
+            for path in args.schema:
+                source, paths = _load_source(path, args.include)
+                for full_name, fingerprint in sorted(schema_fingerprints(source, paths).items()):
+                    print('%s %s' % (fingerprint, full_name))
+        else:
+            if len(args.schema) != 2:
+                parser.error('diff needs two schemas')
+            old, new = [schema_fingerprints(*_load_source(path, args.include)) for path in args.schema]
+            added, removed, changed = diff_fingerprints(old, new)
+            for mark, names in (('+', added), ('-', removed), ('~', changed)):
+                for name in names:
+                    print('%s %s' % (mark, name))
+            return 1 if added or removed or changed else 0
+    except (ParamError, FormatError, ParseError, OSError) as e:
+        sys.stderr.write('pb_descriptor: %s\n' % e)
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+#! /usr/bin/env python3
+# coding=utf-8
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pb_metrics
+from my_exception import ParamError, FormatError
+from pb_parser import Message, fill_message
+from google.protobuf.message import EncodeError
+
+
+def write_varint(out, value):
+    """
+    将非负整数编码为varint并追加到bytearray中
+    :param out:
+    :param value:
+    :return:
+    """
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_varint(value):
+    """
+    将非负整数编码为varint
+    :param value:
+    :return:
+    """
+    data = bytearray()
+    write_varint(data, value)
+    return bytes(data)
+
+
+def _missing_required(msg):
+    """
+    SerializeToString因缺少required字段失败时，转换为列出缺少字段的FormatError
+    :param msg  序列化失败的消息对象
+    :return: FormatError
+    """
+    return FormatError('missing required field %s' % ', '.join(msg.FindInitializationErrors()))
+
+
+class EncodeContext:
+    """
+    可复用的编码上下文，持有一个预先构造的消息对象，每条记录编码前Clear()后重新填充
+    同一上下文不能同时用于多个线程，由MessageEncoder按需分配
+    """
+
+    __slots__ = ('msg', 'plan')
+
+    def __init__(self, entry):
+        """
+        :param entry    MessageClassEntry
+        """
+        self.msg = entry.message_class()
+        self.plan = entry.plan
+
+    def fill(self, record):
+        """
+        清空消息对象并填充记录
+        :param record   字段名到字段值的字典
+        :return: 填充后的消息对象，下次调用fill前有效
+        """
+        msg = self.msg
+        msg.Clear()
+        try:
+            fill_message(msg, record, self.plan)
+        except BaseException:
+            # 填充了一部分的消息对象不能留给下一条记录
+            msg.Clear()
+            raise
+        return msg
+
+
+class MessageEncoder:
+    """
+    批量编码器
+    同一消息结构只编译一次，之后每条记录只需填充字段值；记录为字段名到字段值的字典或json字符串
+    编码时从池中取出EncodeContext复用消息对象，稳定运行时每条记录只分配输出数据；
+    编译后的消息类及填充计划不再修改，同一个编码器可在多个线程中同时使用
+    """
+
+    def __init__(self, message=None, json_string=None):
+        """
+        :param message      Message实例，如FileFsm.message()的返回值
+        :param json_string  描述消息的json字符串，格式同Message
+        """
+        if message is None:
+            if json_string is None:
+                raise ParamError('Invalid Parameter, message or json_string is required')
+            message = Message(json_string=json_string)
+        if not isinstance(message, Message):
+            raise ParamError('Invalid Parameter message:[%s]' % str(message))
+        self.__message = message
+        self.__entry = message.message_class_entry()
+        # 字段名 -> 字段填充计划，嵌套消息的计划在消息编译时一并生成
+        self.__plan = self.__entry.plan
+        for field in message.fields():
+            if field.name not in self.__plan:
+                raise FormatError('field %s: type %s not support yet' % (field.name, field.type))
+        # 空闲的编码上下文，list的append/pop是原子操作，多个线程可同时取用
+        self.__contexts = []
+
+    def message(self):
+        """
+        返回编码器使用的消息结构
+        :return:
+        """
+        return self.__message
+
+    def build(self, record):
+        """
+        根据记录构造PB消息对象
+        :param record   字段名到字段值的字典或json字符串，值为None的字段不设置；
+                        消息字段的值为字典，枚举字段的值为枚举值名称或整数
+        :return:
+        """
+        if isinstance(record, (str, bytes)):
+            record = json.loads(record)
+        msg = self.__entry.message_class()
+        fill_message(msg, record, self.__plan)
+        return msg
+
+    def context(self):
+        """
+        取出一个空闲的编码上下文，没有时新建；用完后应调用release()归还
+        :return: EncodeContext
+        """
+        try:
+            return self.__contexts.pop()
+        except IndexError:
+            return EncodeContext(self.__entry)
+
+    def release(self, context):
+        """
+        归还context()取出的编码上下文
+        :param context:
+        :return:
+        """
+        self.__contexts.append(context)
+
+    def encode(self, record):
+        """
+        将一条记录编码为PB二进制数据
+        :param record:
+        :return:
+        """
+        if isinstance(record, (str, bytes)):
+            record = json.loads(record)
+        hook = pb_metrics.hook
+        start = time.perf_counter() if hook is not None else 0
+        context = self.context()
+        try:
+            data = context.fill(record).SerializeToString()
+        except EncodeError:
+            raise _missing_required(context.msg)
+        finally:
+            self.release(context)
+        if hook is not None:
+            hook('encode', time.perf_counter() - start, 1, 0, len(data))
+        return data
+
+    def encode_into(self, record, out):
+        """
+        将一条记录编码后追加到调用方提供的bytearray中
+        :param record:
+        :param out      bytearray
+        :return: 写入的字节数
+        """
+        data = self.encode(record)
+        out += data
+        return len(data)
+
+    def encode_many(self, records):
+        """
+        批量编码
+        :param records  记录的可迭代对象
+        :return: 二进制数据列表
+        """
+        hook = pb_metrics.hook
+        start = time.perf_counter() if hook is not None else 0
+        context = self.context()
+        try:
+            result = [context.fill(json.loads(record) if isinstance(record, (str, bytes)) else record).SerializeToString()
+                      for record in records]
+        except EncodeError:
+            # 出错时上下文中的消息对象即为出错的记录
+            raise _missing_required(context.msg)
+        finally:
+            self.release(context)
+        if hook is not None:
+            hook('encode', time.perf_counter() - start, len(result), 0, sum(len(data) for data in result))
+        return result
+
+    def serialize_many(self, records, workers=4, chunk_records=1000, executor=None):
+        """
+        使用线程池并行编码，记录按chunk_records条分块，每块由一个线程使用独立的编码上下文编码
+        在有GIL的解释器上主要用于与其他释放GIL的工作重叠，在无GIL的解释器上可以利用多个核
+        :param records          记录的可迭代对象
+        :param workers          线程数，指定executor时忽略
+        :param chunk_records    每块的记录数
+        :param executor         已有的concurrent.futures.Executor，为None时临时创建线程池
+        :return: 二进制数据列表，顺序与records一致；任一记录编码失败时抛出第一个出错块的异常
+        """
+        if workers < 1 or chunk_records < 1:
+            raise ParamError('Invalid Parameter workers/chunk_records')
+        records = records if isinstance(records, list) else list(records)
+        chunks = [records[start:start + chunk_records] for start in range(0, len(records), chunk_records)]
+        if executor is None:
+            if workers == 1 or len(chunks) <= 1:
+                return self.encode_many(records)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(self.encode_many, chunks))
+        else:
+            results = list(executor.map(self.encode_many, chunks))
+        output = []
+        for result in results:
+            output.extend(result)
+        return output
+
+    def write_delimited(self, records, stream):
+        """
+        批量编码，每条数据以varint长度为前缀写入stream
+        :param records  记录的可迭代对象
+        :param stream   可写的二进制流
+        :return: 写入的记录数
+        """
+        hook = pb_metrics.hook
+        start = time.perf_counter() if hook is not None else 0
+        context = self.context()
+        count = 0
+        size = 0
+        try:
+            for record in records:
+                if isinstance(record, (str, bytes)):
+                    record = json.loads(record)
+                data = context.fill(record).SerializeToString()
+                header = encode_varint(len(data))
+                stream.write(header)
+                stream.write(data)
+                count += 1
+                size += len(header) + len(data)
+        except EncodeError:
+            raise _missing_required(context.msg)
+        finally:
+            self.release(context)
+        if hook is not None:
+            hook('encode', time.perf_counter() - start, count, 0, size)
+        return count
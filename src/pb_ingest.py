@@ -0,0 +1,315 @@
+#! /usr/bin/env python3
+# coding=utf-8
+"""
+json行的流水线编码
+
+按块读取输入、解析json、编码PB三个阶段通过有界队列衔接，在不同线程中重叠执行，内存占用与输入总量无关:
+
+    encoder = MessageEncoder(file_fsm.message('Test'))
+    JsonLinesPipeline(encoder, backend='auto').run(open('records.jsonl', 'rb'), open('records.bin', 'wb'))
+
+json解析的实现可以替换，默认使用标准库json；安装了orjson时可选用orjson，'auto'选择可用的最快实现。
+各实现的结果与标准库完全一致：orjson不能解析的行(NaN、超出64位的整数、单独的代理字符等)及可能被转换为
+浮点数的长数字，改用标准库解析，因此输出及错误信息与选用的实现无关
+"""
+
+import json
+import time
+import queue
+import threading
+from collections import namedtuple
+import pb_metrics
+from my_exception import ParamError, FormatError
+from pb_encoder import encode_varint
+from google.protobuf.message import EncodeError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# 每次读取的字节数
+CHUNK_BYTES = 1 << 20
+# 各阶段之间的队列最多缓存的块数
+QUEUE_CHUNKS = 4
+# 等待队列时检查停止标志的间隔，单位秒
+POLL_INTERVAL = 0.1
+
+# json解析实现，loads接受一行utf-8编码的bytes
+JsonBackend = namedtuple('JsonBackend', ['name', 'loads'])
+
+# orjson会把超出[-2**63, 2**64-1]的整数转换为绝对值不小于2**63的浮点数，结果中有这样的浮点数时改用标准库解析
+_LARGE_FLOAT = float(2 ** 63)
+
+
+def _stdlib_loads(line):
+    return json.loads(line.decode('utf-8'))
+
+
+def _has_large_float(value):
+    """
+    检查解析结果中是否有绝对值不小于2**63的浮点数
+    """
+    pending = [[value]]
+    while pending:
+        container = pending.pop()
+        for item in (container.values() if type(container) is dict else container):
+            item_type = type(item)
+            if item_type is float:
+                if not -_LARGE_FLOAT < item < _LARGE_FLOAT:
+                    return True
+            elif item_type is dict or item_type is list:
+                pending.append(item)
+    return False
+
+
+def _orjson_loads(line):
+    try:
+        value = orjson.loads(line)
+        if not _has_large_float(value):
+            return value
+    except orjson.JSONDecodeError:
+        pass
+    # 解析失败时由标准库给出相同的结果或错误信息
+    return _stdlib_loads(line)
+
+
+# 按速度由快到慢排列，'json'始终可用
+_BACKENDS = [('orjson', _orjson_loads if orjson is not None else None),
+             ('json', _stdlib_loads)]
+
+
+def available_backends():
+    """
+    返回已安装的json解析实现名称，按速度由快到慢排列
+    :return:
+    """
+    return [name for name, loads in _BACKENDS if loads is not None]
+
+
+def get_backend(name='json'):
+    """
+    获取json解析实现
+    :param name     'json'、'orjson'，或'auto'表示可用的最快实现
+    :return: JsonBackend
+    """
+    if name == 'auto':
+        name = available_backends()[0]
+    for backend_name, loads in _BACKENDS:
+        if backend_name == name:
+            if loads is None:
+                raise ParamError('json backend %s is not installed' % name)
+            return JsonBackend(name, loads)
+    raise ParamError('Invalid Parameter backend:[%s]' % str(name))
+
+
+def read_line_chunks(stream, chunk_bytes=CHUNK_BYTES):
+    """
+    按块读取二进制流并切分为行，块边界处不完整的行留到下一块
+    :param stream       可读的二进制流
+    :param chunk_bytes  每次读取的字节数
+    :return: (首行行号(从1开始), 行列表)的迭代器，行不含换行符
+    """
+    line_number = 1
+    rest = b''
+    while True:
+        data = stream.read(chunk_bytes)
+        if not data:
+            break
+        lines = (rest + data).split(b'\n')
+        rest = lines.pop()
+        if lines:
+            yield line_number, lines
+            line_number += len(lines)
+    if rest:
+        yield line_number, [rest]
+
+
+def decode_lines(loads, line_number, lines):
+    """
+    解析一块json行，空行跳过
+    :param loads        JsonBackend.loads
+    :param line_number  首行行号
+    :param lines        行列表
+    :return: (记录列表, 各记录的行号序列, 错误)；遇到无法解析的行时停止，错误为FormatError，否则为None
+    """
+    hook = pb_metrics.hook
+    start = time.perf_counter() if hook is not None else 0
+    error = None
+    try:
+        # 空行及无法解析的行都会抛出ValueError，没有异常时各行都是记录
+        records = list(map(loads, lines))
+        numbers = range(line_number, line_number + len(lines))
+    except ValueError:
+        records = []
+        numbers = []
+        for line in lines:
+            if line.strip():
+                try:
+                    records.append(loads(line))
+                except ValueError as e:
+                    error = FormatError('line %d: %s' % (line_number, e))
+                    break
+                numbers.append(line_number)
+            line_number += 1
+    if hook is not None:
+        hook('json_decode', time.perf_counter() - start, len(records), sum(len(line) for line in lines))
+    return records, numbers, error
+
+
+def encode_records(encoder, records, numbers):
+    """
+    批量编码一块记录，每条数据以varint长度为前缀
+    :param encoder  MessageEncoder或WireEncoder
+    :param records  记录列表
+    :param numbers  各记录的行号序列，用于错误信息
+    :return: bytearray
+    """
+    try:
+        data_list = encoder.encode_many(records)
+    except (ValueError, TypeError, AttributeError, FormatError, EncodeError):
+        # 逐条重新编码，找出第一条出错的记录
+        for record, number in zip(records, numbers):
+            try:
+                encoder.encode(record)
+            except (ValueError, TypeError, AttributeError, FormatError, EncodeError) as e:
+                raise FormatError('line %d: %s' % (number, e))
+        raise
+    output = bytearray()
+    for data in data_list:
+        output += encode_varint(len(data))
+        output += data
+    return output
+
+
+class _Failure:
+    """
+    上游阶段的异常，随队列传给下游，按输入顺序抛出
+    """
+
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(target, item, stop):
+    """
+    放入有界队列，队列满时等待；下游已停止时放弃
+    :return: 是否放入
+    """
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class JsonLinesPipeline:
+    """
+    json行到以varint长度为前缀的PB数据的流水线
+    读取线程按块读取并切分行，解析线程解析json，调用run()的线程编码并写出；各阶段之间为有界队列。
+    有GIL的解释器上，读写等待I/O时其他阶段可以继续执行；输出与逐行编码的结果逐字节相同。
+    run()可以多次调用，但不能在多个线程中同时调用同一个实例
+    """
+
+    def __init__(self, encoder, backend='json', chunk_bytes=CHUNK_BYTES, queue_chunks=QUEUE_CHUNKS, pipelined=True):
+        """
+        :param encoder      MessageEncoder或WireEncoder
+        :param backend      json解析实现的名称或JsonBackend，见get_backend()
+        :param chunk_bytes  每次读取的字节数
+        :param queue_chunks 各阶段之间的队列最多缓存的块数
+        :param pipelined    为False时三个阶段在调用线程中依次执行，用于比较
+        """
+        if chunk_bytes < 1 or queue_chunks < 1:
+            raise ParamError('Invalid Parameter chunk_bytes/queue_chunks')
+        self.__encoder = encoder
+        self.__backend = backend if isinstance(backend, JsonBackend) else get_backend(backend)
+        self.__chunk_bytes = chunk_bytes
+        self.__queue_chunks = queue_chunks
+        self.__pipelined = pipelined
+
+    def backend(self):
+        """
+        返回使用的json解析实现
+        :return: JsonBackend
+        """
+        return self.__backend
+
+    def run(self, stream, output):
+        """
+        读取stream中的json行，编码后写入output
+        :param stream   可读的二进制流
+        :param output   可写的二进制流
+        :return: 写入的记录数；任一行解析或编码失败时抛出FormatError，出错的块不写出，此前各块已写入output
+        """
+        if not self.__pipelined:
+            count = 0
+            for line_number, lines in read_line_chunks(stream, self.__chunk_bytes):
+                count += self.__write(self.__decode(line_number, lines), output)
+            return count
+
+        lines_queue = queue.Queue(self.__queue_chunks)
+        records_queue = queue.Queue(self.__queue_chunks)
+        stop = threading.Event()
+        reader = threading.Thread(target=self.__read_stage, args=(stream, lines_queue, stop), daemon=True)
+        decoder = threading.Thread(target=self.__decode_stage, args=(lines_queue, records_queue, stop), daemon=True)
+        reader.start()
+        decoder.start()
+        count = 0
+        try:
+            while True:
+                item = records_queue.get()
+                if item is None:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+                count += self.__write(item, output)
+        finally:
+            stop.set()
+        reader.join()
+        decoder.join()
+        return count
+
+    def __decode(self, line_number, lines):
+        return decode_lines(self.__backend.loads, line_number, lines)
+
+    def __write(self, decoded, output):
+        """
+        编码并写出一块记录，该块中有无法解析或编码的行时不写出，直接抛出异常
+        """
+        records, numbers, error = decoded
+        data = encode_records(self.__encoder, records, numbers)
+        if error is not None:
+            raise error
+        output.write(data)
+        return len(records)
+
+    def __read_stage(self, stream, lines_queue, stop):
+        try:
+            for chunk in read_line_chunks(stream, self.__chunk_bytes):
+                if not _put(lines_queue, chunk, stop):
+                    return
+            _put(lines_queue, None, stop)
+        except BaseException as e:
+            _put(lines_queue, _Failure(e), stop)
+
+    def __decode_stage(self, lines_queue, records_queue, stop):
+        while not stop.is_set():
+            try:
+                item = lines_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is None or isinstance(item, _Failure):
+                _put(records_queue, item, stop)
+                return
+            try:
+                decoded = self.__decode(*item)
+            except BaseException as e:
+                decoded = _Failure(e)
+            if not _put(records_queue, decoded, stop) or isinstance(decoded, _Failure) or decoded[2] is not None:
+                # 出错之后的行不再解析，调用线程处理到出错的块时抛出异常
+                return
@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+# coding=utf-8
+
+import re
+from collections import namedtuple
+from enum import Enum, unique
+from my_exception import FormatError
+
+
+# 定义词法单元类型枚举
+@unique
+class TokenType(Enum):
+    token_identifier = 0
+    token_number = 1
+    token_string = 2
+    token_punctuation = 3
+    token_comment = 4
+
+
+# 词法单元：类型、内容、行号(从1开始)、列号(从1开始)、在文件内容中的偏移
+Token = namedtuple('Token', ['type', 'value', 'line', 'column', 'offset'])
+
+# 词法规则，按顺序匹配，词法单元前的空白一并跳过；标识符允许包含'.'，以支持包名及带包名的类型名
+_TOKEN_PATTERN = re.compile(r'''
+  [ \t\r\f\v]*
+  (?:
+    (?P<newline>\n)
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<identifier>\.?[A-Za-z_][A-Za-z0-9_.]*)
+  | (?P<number>[-+]?(?:0[xX][0-9a-fA-F]+|[0-9]+(?:\.[0-9]*)?(?:[eE][-+]?[0-9]+)?|\.[0-9]+(?:[eE][-+]?[0-9]+)?))
+  | (?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+  | (?P<punctuation>[{}\[\]()<>;,=])
+  | (?P<error>[^ \t\r\f\v])
+  )?
+''', re.VERBOSE | re.DOTALL)
+
+_TOKEN_TYPES = {
+    'comment': TokenType.token_comment,
+    'identifier': TokenType.token_identifier,
+    'number': TokenType.token_number,
+    'string': TokenType.token_string,
+    'punctuation': TokenType.token_punctuation
+}
+
+
+def tokenize(text, offset=0, line=1, line_start=0, endpos=None):
+    """
+    对proto文件内容做词法分析，逐个产生词法单元
+    整个文件只扫描一遍，空白与换行不产生词法单元
+    :param text         文件内容
+    :param offset       开始扫描的位置
+    :param line         offset所在的行号
+    :param line_start   offset所在行的行首位置
+    :param endpos       结束扫描的位置，默认为文件末尾
+    :return:
+    """
+    for match in _TOKEN_PATTERN.finditer(text, offset, len(text) if endpos is None else endpos):
+        kind = match.lastgroup
+        if kind is None:
+            # 文件末尾的空白
+            continue
+        if kind == 'newline':
+            line += 1
+            line_start = match.end()
+            continue
+        start = match.start(kind)
+        value = match.group(kind)
+        if kind == 'error':
+            raise FormatError('invalid syntax. line:%d, column:%d, unexpected character %r'
+                              % (line, start - line_start + 1, value))
+        yield Token(_TOKEN_TYPES[kind], value, line, start - line_start + 1, start)
+        # 块注释可能跨越多行
+        if kind == 'comment' and '\n' in value:
+            line += value.count('\n')
+            line_start = start + value.rindex('\n') + 1
+
+
+def comment_text(token):
+    """
+    返回注释词法单元去掉注释符号后的内容
+    :param token:
+    :return:
+    """
+    if token.value.startswith('/*'):
+        return token.value[2:-2].strip()
+    return token.value[2:].strip()
+
+
+# 预扫描规则：只识别注释、字符串、花括号及message/enum定义的开头，其余内容由正则跳过
+# 开头的前瞻用于让正则引擎快速跳过不可能匹配的字符
+_SCAN_PATTERN = re.compile(r'''
+  (?=[/"'{}me])
+  (?:
+    //[^\n]*|/\*.*?\*/
+  | "(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'
+  | (?P<brace>[{}])
+  | (?<![A-Za-z0-9_.])(?P<keyword>message|enum)\s+(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  )
+''', re.VERBOSE | re.DOTALL)
+
+
+def scan_blocks(text):
+    """
+    快速预扫描proto文件内容，找出顶层的message及enum定义，不做完整的词法分析
+    花括号不配对时不报错，由后续的完整解析报告语法错误
+    :param text     文件内容
+    :return: ('message'或'enum', 名称, 关键字的偏移, '}'之后的偏移)
+    """
+    depth = 0
+    current = None
+    for match in _SCAN_PATTERN.finditer(text):
+        brace = match.group('brace')
+        if brace == '{':
+            depth += 1
+        elif brace == '}':
+            depth -= 1
+            if depth == 0 and current is not None:
+                yield current[0], current[1], current[2], match.end()
+                current = None
+            elif depth < 0:
+                return
+        elif depth == 0 and match.group('keyword'):
+            current = (match.group('keyword'), match.group('name'), match.start())
@@ -0,0 +1,237 @@
+#! /usr/bin/env python3
+# coding=utf-8
+"""
+解析及编解码热点路径的统计
+
+各阶段结束时调用hook(stage, seconds, records, bytes_in, bytes_out)，hook为None时不统计，
+热点路径上只多一次模块属性的读取。enable()可以安装内置的Metrics，也可以安装任意回调:
+
+    metrics = pb_metrics.enable()
+    ...
+    metrics.write_prometheus('/var/lib/node_exporter/pb2json.prom')
+
+阶段名:
+    parse               FileFsm.parse，records为消息数，bytes_in为文件大小
+    parse_text          词法分析及消息、字段的构造
+    link                解析字段引用的类型
+    schema_cache_load   从磁盘缓存加载
+    create_class        构造描述符池及动态消息类(描述符缓存未命中时)
+    serialize           Message.serialize填充消息对象
+    encode              MessageEncoder编码，bytes_out为输出字节数
+    encode_wire         WireEncoder编码
+    decode              MessageDecoder解码，bytes_in为输入字节数
+    decode_columnar     ColumnarDecoder按列解码
+    json_decode         pb_ingest解析一块json行，bytes_in为输入字节数
+    request_batch       pb_server一批请求的转换，含进程间传递的耗时
+"""
+
+import os
+import bisect
+import tempfile
+import threading
+from my_exception import ParamError
+
+
+# 当前安装的统计回调，为None时不统计
+hook = None
+
+# 默认的耗时分桶上限，单位秒
+DEFAULT_BUCKETS = (0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# 导出时读取的外部计数，如描述符缓存的命中数: (指标名, 说明, 无参函数)
+_sources = []
+
+
+def enable(target=None):
+    """
+    开启统计
+    :param target   Metrics实例、带observe方法的对象或可调用对象，为None时新建Metrics
+    :return: target
+    """
+    global hook
+    if target is None:
+        target = Metrics()
+    observe = getattr(target, 'observe', target)
+    if not callable(observe):
+        raise ParamError('Invalid Parameter target:[%s]' % str(target))
+    hook = observe
+    return target
+
+
+def disable():
+    """
+    关闭统计
+    """
+    global hook
+    hook = None
+
+
+def register_source(name, help_text, func):
+    """
+    登记导出时读取的计数
+    :param name         指标名，不含前缀
+    :param help_text    说明
+    :param func         返回当前计数的无参函数
+    """
+    _sources.append((name, help_text, func))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _StageStats:
+    """
+    单个阶段的统计
+    """
+
+    __slots__ = ('count', 'seconds', 'buckets', 'records', 'bytes_in', 'bytes_out')
+
+    def __init__(self, bucket_count):
+        self.count = 0
+        self.seconds = 0.0
+        self.buckets = [0] * bucket_count
+        self.records = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+class Metrics:
+    """
+    内置的统计实现，按阶段累计调用次数、耗时分布、记录数及输入输出字节数；所有操作线程安全
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets  耗时分桶的上限，单位秒，须递增
+        """
+        if not buckets or list(buckets) != sorted(buckets):
+            raise ParamError('Invalid Parameter buckets:[%s]' % str(buckets))
+        self.__buckets = tuple(buckets)
+        self.__stages = dict()
+        self.__lock = threading.Lock()
+
+    def observe(self, stage, seconds, records=0, bytes_in=0, bytes_out=0):
+        """
+        记录一次阶段耗时
+        :param stage        阶段名
+        :param seconds      耗时，单位秒
+        :param records      处理的记录数
+        :param bytes_in     输入字节数
+        :param bytes_out    输出字节数
+        """
+        index = bisect.bisect_left(self.__buckets, seconds)
+        with self.__lock:
+            stats = self.__stages.get(stage)
+            if stats is None:
+                stats = self.__stages[stage] = _StageStats(len(self.__buckets) + 1)
+            stats.count += 1
+            stats.seconds += seconds
+            stats.buckets[index] += 1
+            stats.records += records
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+
+    def stats(self):
+        """
+        返回各阶段的统计
+        :return: {阶段名: {'count', 'seconds', 'records', 'bytes_in', 'bytes_out', 'records_per_second'}}
+        """
+        with self.__lock:
+            return dict((stage, {'count': s.count,
+                                 'seconds': s.seconds,
+                                 'records': s.records,
+                                 'bytes_in': s.bytes_in,
+                                 'bytes_out': s.bytes_out,
+                                 'records_per_second': s.records / s.seconds if s.seconds > 0 else 0.0})
+                        for stage, s in self.__stages.items())
+
+    def drain(self):
+        """
+        取出并清空当前的统计，用于从工作进程汇总到主进程
+        :return: 可pickle的统计数据，交给merge()使用
+        """
+        with self.__lock:
+            stages = self.__stages
+            self.__stages = dict()
+        return dict((stage, (s.count, s.seconds, s.buckets, s.records, s.bytes_in, s.bytes_out))
+                    for stage, s in stages.items())
+
+    def merge(self, data):
+        """
+        合并drain()取出的统计，分桶须相同
+        :param data:
+        """
+        with self.__lock:
+            for stage, (count, seconds, buckets, records, bytes_in, bytes_out) in data.items():
+                stats = self.__stages.get(stage)
+                if stats is None:
+                    stats = self.__stages[stage] = _StageStats(len(self.__buckets) + 1)
+                stats.count += count
+                stats.seconds += seconds
+                stats.buckets = [a + b for a, b in zip(stats.buckets, buckets)]
+                stats.records += records
+                stats.bytes_in += bytes_in
+                stats.bytes_out += bytes_out
+
+    def reset(self):
+        with self.__lock:
+            self.__stages = dict()
+
+    def to_prometheus(self, prefix='pb2json'):
+        """
+        以Prometheus文本格式导出
+        :param prefix   指标名前缀
+        :return:
+        """
+        with self.__lock:
+            stages = sorted((stage, s.count, s.seconds, list(s.buckets), s.records, s.bytes_in, s.bytes_out)
+                            for stage, s in self.__stages.items())
+        lines = ['# HELP %s_stage_seconds Time spent in each stage.' % prefix,
+                 '# TYPE %s_stage_seconds histogram' % prefix]
+        for stage, count, seconds, buckets, records, bytes_in, bytes_out in stages:
+            label = 'stage="%s"' % _escape(stage)
+            total = 0
+            for bound, value in zip(self.__buckets, buckets):
+                total += value
+                lines.append('%s_stage_seconds_bucket{%s,le="%r"} %d' % (prefix, label, bound, total))
+            lines.append('%s_stage_seconds_bucket{%s,le="+Inf"} %d' % (prefix, label, count))
+            lines.append('%s_stage_seconds_sum{%s} %r' % (prefix, label, seconds))
+            lines.append('%s_stage_seconds_count{%s} %d' % (prefix, label, count))
+        for name, index, help_text in (('records_total', 4, 'Records processed in each stage.'),
+                                       ('bytes_in_total', 5, 'Input bytes of each stage.'),
+                                       ('bytes_out_total', 6, 'Output bytes of each stage.')):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help_text))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for item in stages:
+                lines.append('%s_%s{stage="%s"} %d' % (prefix, name, _escape(item[0]), item[index]))
+        lines.append('# HELP %s_records_per_second Records per second of time spent in each stage.' % prefix)
+        lines.append('# TYPE %s_records_per_second gauge' % prefix)
+        for stage, count, seconds, buckets, records, bytes_in, bytes_out in stages:
+            lines.append('%s_records_per_second{stage="%s"} %r'
+                         % (prefix, _escape(stage), records / seconds if seconds > 0 else 0.0))
+        for name, help_text, func in _sources:
+            lines.append('# HELP %s_%s %s' % (prefix, name, help_text))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            lines.append('%s_%s %r' % (prefix, name, func()))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def write_prometheus(self, path, prefix='pb2json'):
+        """
+        以Prometheus文本格式写入文件(如node_exporter的textfile目录)，采用临时文件+原子重命名
+        :param path:
+        :param prefix:
+        """
+        text = self.to_prometheus(prefix)
+        fd, temp_path = tempfile.mkstemp(prefix='.pb2json-metrics-', dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
@@ -1,12 +1,22 @@
 #! /usr/bin/env python3
 # coding=utf-8
 
+import os
 import sys
 import json
-from enum import Enum, unique
+import time
+import base64
+import bisect
+import hashlib
+import threading
+from collections import namedtuple
 from my_exception import ParamError, FormatError, UndefineError
+import pb_metrics
+from pb_cache import DescriptorCache
+from pb_lexer import TokenType, tokenize, comment_text, scan_blocks
 from google.protobuf.descriptor_pb2 import FieldDescriptorProto
 from google.protobuf.descriptor_pb2 import FileDescriptorProto
+from google.protobuf import descriptor_pool
 from google.protobuf import message_factory
 
 
@@ -38,15 +48,11 @@ FieldProperty = {
     'repeated'
 }
 
-# 定义消息行的首字符串集合
-LineStatusMessage = {
-    'message',
-    'required',
-    'optional',
-    'repeated',
-    '{',
-    '}'
-}
+# 字段类型及属性的编号，Field内部以编号保存，节省内存
+FieldTypeNames = tuple(sys.intern(t) for t in sorted(FieldTypes))
+FieldTypeCode = dict((t, i) for i, t in enumerate(FieldTypeNames))
+FieldPropertyNames = tuple(sys.intern(p) for p in sorted(FieldProperty))
+FieldPropertyCode = dict((p, i) for i, p in enumerate(FieldPropertyNames))
 
 FieldType2PbType = {
     'bool'      : FieldDescriptorProto.TYPE_BOOL,
@@ -74,22 +80,423 @@ FieldProperty2PbProperty = {
     'repeated': FieldDescriptorProto.LABEL_REPEATED
 }
 
-# 定义行状态枚举
-@unique
-class LineStatus(Enum):
-    line_status_undefine = 0
-    line_status_import = 1
-    line_status_package = 2
-    line_status_message = 3
-    line_status_comment = 4
-    line_status_empty = 5
-    line_status_others = 6
-    line_status_eof = 7
+# 全局共享的描述符缓存，相同结构的消息只构造一次消息类
+descriptor_cache = DescriptorCache()
+pb_metrics.register_source('descriptor_cache_hits_total', 'Descriptor cache hits.', lambda: descriptor_cache.hits)
+pb_metrics.register_source('descriptor_cache_misses_total', 'Descriptor cache misses.', lambda: descriptor_cache.misses)
+
+# 描述符缓存条目，plan为与消息字段一一对应的填充计划
+MessageClassEntry = namedtuple('MessageClassEntry', ['pool', 'descriptor', 'message_class', 'plan'])
+
+# 消息在文件中占据的区域：从上一个消息或package/import语句、顶层枚举结束处到本消息的'}'之后，包含消息前的注释
+# start_line为区域开始处的行号，end_line为'}'所在行号，digest为区域内容的哈希，pkg为消息所在的pkg，
+# header表示区域内是否有package/import语句(语句前有注释时，注释归属于消息，区域从注释之前开始)
+MessageSpan = namedtuple('MessageSpan', ['name', 'start', 'end', 'start_line', 'end_line', 'digest', 'pkg', 'header'])
+
+# 字段填充计划：字段名、是否repeated、值转换函数(为None时直接使用原值)、子消息的填充计划(非消息字段为None)
+FieldPlan = namedtuple('FieldPlan', ['name', 'repeated', 'coerce', 'message_plan'])
+
+
+def _to_bool(value):
+    # 兼容以字符串'true'/'false'表示的写法，其他值不能转换为bool
+    if isinstance(value, bool):
+        return value
+    if value == 'true':
+        return True
+    if value == 'false':
+        return False
+    raise FormatError("expected bool or 'true'/'false', got %s"
+                      % (repr(value) if isinstance(value, str) else type(value).__name__))
+
+
+def _to_bytes(value):
+    # json中bytes字段以base64字符串表示
+    return base64.b64decode(value, validate=True) if isinstance(value, str) else value
+
+
+# 字段值转换函数，以PB字段类型为键，未列出的类型直接使用原值
+FieldCoercion = {
+    FieldDescriptorProto.TYPE_BOOL: _to_bool,
+    FieldDescriptorProto.TYPE_BYTES: _to_bytes
+}
+
+
+def get_message_class(descriptor):
+    """
+    根据描述符获取消息类，兼容新旧版本的protobuf
+    :param descriptor:
+    :return:
+    """
+    if hasattr(message_factory, 'GetMessageClass'):
+        return message_factory.GetMessageClass(descriptor)
+    return message_factory.MessageFactory(descriptor.file.pool).GetPrototype(descriptor)
+
+
+def is_repeated(field_descriptor):
+    """
+    判断字段是否为repeated，兼容新旧版本的protobuf
+    :param field_descriptor:
+    :return:
+    """
+    try:
+        return field_descriptor.is_repeated
+    except AttributeError:
+        return field_descriptor.label == FieldDescriptorProto.LABEL_REPEATED
+
+
+def is_required(field_descriptor):
+    """
+    判断字段是否为required，兼容新旧版本的protobuf
+    :param field_descriptor:
+    :return:
+    """
+    try:
+        return field_descriptor.is_required
+    except AttributeError:
+        return field_descriptor.label == FieldDescriptorProto.LABEL_REQUIRED
+
+
+def _timed(stage, hook, func):
+    """
+    包装无参函数，调用结束后把耗时报告给hook
+    """
+    def wrapper():
+        start = time.perf_counter()
+        result = func()
+        hook(stage, time.perf_counter() - start, 1)
+        return result
+    return wrapper
+
+
+def _enum_coercion(enum_descriptor):
+    """
+    生成枚举字段的值转换函数，值可以是枚举值名称或整数
+    :param enum_descriptor:
+    :return:
+    """
+    numbers = dict((value.name, value.number) for value in enum_descriptor.values)
+
+    def coerce(value):
+        if not isinstance(value, str):
+            return value
+        try:
+            return numbers[value]
+        except KeyError:
+            raise FormatError('invalid value %s for enum %s' % (value, enum_descriptor.full_name))
+    return coerce
+
+
+def compile_plan(descriptor, plans=None):
+    """
+    根据消息描述符生成字段填充计划
+    子消息的计划按消息全名共享，每种消息只生成一次，递归引用的消息也只生成一次
+    :param descriptor   消息描述符
+    :param plans        消息全名到填充计划的字典，同一描述符池中的消息应共用
+    :return: 字段名到FieldPlan的字典
+    """
+    if plans is None:
+        plans = dict()
+    plan = plans.get(descriptor.full_name)
+    if plan is not None:
+        return plan
+    plan = dict()
+    # 先登记再处理字段，递归引用时直接使用同一个字典
+    plans[descriptor.full_name] = plan
+    for fd in descriptor.fields:
+        if fd.type == FieldDescriptorProto.TYPE_MESSAGE:
+            plan[fd.name] = FieldPlan(fd.name, is_repeated(fd), None, compile_plan(fd.message_type, plans))
+        elif fd.type == FieldDescriptorProto.TYPE_ENUM:
+            plan[fd.name] = FieldPlan(fd.name, is_repeated(fd), _enum_coercion(fd.enum_type), None)
+        else:
+            plan[fd.name] = FieldPlan(fd.name, is_repeated(fd), FieldCoercion.get(fd.type), None)
+    return plan
+
+
+def fill_message(msg, record, plan):
+    """
+    按填充计划将记录写入消息对象，只使用公开的赋值接口
+    子消息直接写入父消息持有的子消息对象，不构造中间对象，每个值只处理一次
+    :param msg      消息对象
+    :param record   字段名到字段值的字典，子消息的值为字典，值为None的字段不设置
+    :param plan     compile_plan的返回值
+    :return:
+    """
+    for name, value in record.items():
+        if value is None:
+            continue
+        field_plan = plan.get(name)
+        if field_plan is None:
+            raise FormatError('unknown field %s for message %s' % (name, msg.DESCRIPTOR.full_name))
+        # protobuf赋值接口对类型不符、越界及非法utf-8的值抛出TypeError/ValueError，统一转换为FormatError
+        try:
+            if field_plan.message_plan is not None:
+                if field_plan.repeated:
+                    container = getattr(msg, name)
+                    for item in value:
+                        fill_message(container.add(), item, field_plan.message_plan)
+                else:
+                    sub_msg = getattr(msg, name)
+                    # 值为空字典时也要标记子消息已设置
+                    sub_msg.SetInParent()
+                    fill_message(sub_msg, value, field_plan.message_plan)
+            elif field_plan.repeated:
+                getattr(msg, name).extend(value if field_plan.coerce is None else [field_plan.coerce(v) for v in value])
+            else:
+                setattr(msg, name, value if field_plan.coerce is None else field_plan.coerce(value))
+        except (TypeError, ValueError) as e:
+            raise FormatError('invalid value for field %s of message %s, %s' % (name, msg.DESCRIPTOR.full_name, e))
+
+
+def build_file_proto(name, pkg, imports, messages, enums):
+    """
+    构造描述整个文件的FileDescriptorProto
+    :param name         文件名，须与导入方dependency中的名称一致
+    :param pkg:
+    :param imports      被导入的文件名列表
+    :param messages     顶层消息列表
+    :param enums        顶层枚举列表
+    :return:
+    """
+    file_proto = FileDescriptorProto(name=name, package=pkg)
+    file_proto.dependency.extend(imports)
+    for message in messages:
+        message.fill_file_proto(file_proto)
+    for enum in enums:
+        enum.fill_proto(file_proto.enum_type)
+    return file_proto
+
+
+def iter_types(messages, enums=()):
+    """
+    遍历消息及枚举，包括嵌套定义的
+    :param messages     顶层消息列表
+    :param enums        顶层枚举列表
+    :return: (全限定名, 'message'或'enum', 消息或枚举)
+    """
+    for enum in enums:
+        yield enum.full_name(), 'enum', enum
+    for message in messages:
+        yield message.full_name(), 'message', message
+        for item in iter_types(message.nested_messages(), message.enums()):
+            yield item
+
+
+def resolve_types(messages, lookup):
+    """
+    解析消息字段引用的消息/枚举类型，按proto的作用域规则由内向外查找
+    解析成功的字段，type设为'message'或'enum'，type_name设为以'.'开头的全限定名
+    :param messages     顶层消息列表
+    :param lookup       全限定名 -> 'message'/'enum'，不存在时返回None
+    :return: 未能解析的(消息全限定名, 字段名, 类型名)列表
+    """
+    unresolved = []
+    for scope, kind, message in iter_types(messages):
+        if kind != 'message':
+            continue
+        for field in message.fields():
+            if field.type_name is None:
+                continue
+            if field.type_name.startswith('.'):
+                candidates = [field.type_name[1:]]
+            else:
+                parts = scope.split('.')
+                candidates = ['.'.join(parts[:i] + [field.type_name]) for i in range(len(parts), -1, -1)]
+            for candidate in candidates:
+                field_kind = lookup(candidate)
+                if field_kind is not None:
+                    field.type = field_kind
+                    field.type_name = '.' + candidate
+                    break
+            else:
+                unresolved.append((scope, field.name, field.type_name))
+    return unresolved
+
+
+class DescriptorSet:
+    """
+    一组相互依赖的proto文件描述，按依赖顺序排列，被导入的文件在前
+    整组描述只构造一个描述符池，其中的消息共用消息类及填充计划
+    """
+
+    __slots__ = ('__file_protos', '__digest', '__cache_token', '__pool', '__plans', '__lock')
+
+    def __init__(self, file_protos, pool=None, pool_token=None):
+        """
+        :param file_protos  FileDescriptorProto列表，每个文件依赖的文件必须排在它之前
+        :param pool         已添加了全部文件的描述符池，为None时首次使用时构造
+        :param pool_token   区分描述符池的标记，如调用方提供的描述符池的id()；为None时结构相同的DescriptorSet
+                            共用描述符缓存中的消息类，否则只有标记也相同时才共用
+        """
+        self.__file_protos = tuple(file_protos)
+        sha1 = hashlib.sha1()
+        for file_proto in self.__file_protos:
+            data = file_proto.SerializeToString(deterministic=True)
+            sha1.update(b'%d:' % len(data))
+            sha1.update(data)
+        self.__digest = sha1.hexdigest()
+        self.__cache_token = self.__digest if pool_token is None else '%s@%s' % (self.__digest, pool_token)
+        self.__pool = pool
+        # 消息全名 -> 填充计划
+        self.__plans = dict()
+        self.__lock = threading.Lock()
+
+    def __reduce__(self):
+        # 描述符池不能pickle，在其他进程中使用时重新构造
+        return DescriptorSet, (list(self.__file_protos),)
+
+    def digest(self):
+        """
+        返回全部文件描述的哈希，任一文件的结构变化都会导致哈希变化
+        :return:
+        """
+        return self.__digest
+
+    def cache_token(self):
+        """
+        返回描述符缓存的键中使用的标记，为digest及构造时指定的pool_token
+        :return:
+        """
+        return self.__cache_token
+
+    def file_protos(self):
+        """
+        返回文件描述列表
+        :return:
+        """
+        return self.__file_protos
+
+    def pool(self):
+        """
+        返回描述符池，首次调用时按顺序添加全部文件
+        :return:
+        """
+        if self.__pool is None:
+            with self.__lock:
+                if self.__pool is None:
+                    pool = descriptor_pool.DescriptorPool()
+                    for file_proto in self.__file_protos:
+                        pool.Add(file_proto)
+                    self.__pool = pool
+        return self.__pool
+
+    def create_entry(self, full_name):
+        """
+        构造指定消息的缓存条目，通常由descriptor_cache调用，不同消息可能在多个线程中同时构造
+        :param full_name    消息全限定名
+        :return: MessageClassEntry
+        """
+        pool = self.pool()
+        descriptor = pool.FindMessageTypeByName(full_name)
+        with self.__lock:
+            plan = compile_plan(descriptor, self.__plans)
+        return MessageClassEntry(pool, descriptor, get_message_class(descriptor), plan)
+
+
+class EnumType:
+    """
+    pb枚举
+    """
+
+    __slots__ = ('__name', '__pkg', '__scope', '__comment', '__values')
+
+    def __init__(self, enum_name, enum_pkg=None, enum_comment=None, enum_values=None, enum_scope=''):
+        """
+        :param enum_name    枚举名
+        :param enum_pkg     枚举所在的pkg
+        :param enum_comment 枚举注释
+        :param enum_values  (名称, 数值)列表
+        :param enum_scope   外层消息名，以'.'分隔，顶层枚举为''
+        """
+        if enum_name.strip() == '':
+            raise ParamError('Invalid Parameter enum_name:[%s]' % str(enum_name))
+        self.__name = enum_name
+        self.__pkg = enum_pkg
+        self.__scope = enum_scope
+        self.__comment = enum_comment
+        self.__values = [] if enum_values is None else list(enum_values)
+
+    def add_value(self, value_name, value_number):
+        """
+        增加枚举值
+        :param value_name:
+        :param value_number:
+        :return:
+        """
+        if not isinstance(value_number, int):
+            raise ParamError('Invalid Parameter value_number[%s]' % str(value_number))
+        self.__values.append((value_name, value_number))
+
+    def add_comment(self, comment):
+        """
+        增加枚举注释信息
+        :param comment:
+        :return:
+        """
+        if self.__comment is None:
+            self.__comment = comment
+        else:
+            self.__comment += ('\n' + comment)
+
+    def name(self):
+        return self.__name
+
+    def package(self):
+        return self.__pkg
+
+    def comment(self):
+        return self.__comment
+
+    def values(self):
+        """
+        返回(名称, 数值)列表，按声明顺序排列
+        :return:
+        """
+        return self.__values
+
+    def full_name(self):
+        """
+        返回枚举的全限定名
+        :return:
+        """
+        return '.'.join(part for part in (self.__pkg, self.__scope, self.__name) if part)
+
+    def to_dict(self):
+        """
+        将枚举转换为字典
+        :return:
+        """
+        return {
+            'enum_name': self.__name,
+            'enum_comment': self.__comment,
+            'enum_values': [{'value_name': name, 'value_number': number} for name, number in self.__values]
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+    def fill_proto(self, enum_protos):
+        """
+        将枚举描述添加到FileDescriptorProto.enum_type或DescriptorProto.enum_type中
+        :param enum_protos:
+        :return:
+        """
+        enum_proto = enum_protos.add(name=self.__name)
+        for name, number in self.__values:
+            enum_proto.value.add(name=name, number=number)
+        # 存在同值的枚举项时需要allow_alias
+        if len(set(number for name, number in self.__values)) < len(self.__values):
+            enum_proto.options.allow_alias = True
 
 
 class Field:
+    """
+    消息字段
+    使用__slots__保存属性，类型及属性以编号保存，type/property以字符串形式读写
+    """
+
+    __slots__ = ('name', 'type_code', 'property_code', 'sequence', 'default', 'comment', 'value', 'type_name')
 
-    def __init__(self, field_name=None, field_type=None, field_property=None, field_sequence=None, field_default=None, field_comment=None, field_value=None, json_string=None):
+    def __init__(self, field_name=None, field_type=None, field_property=None, field_sequence=None, field_default=None, field_comment=None, field_value=None, json_string=None, field_dict=None, field_type_name=None):
         """
         :param field_name       字段名，字符串
         :param field_type       见FieldTypes定义
@@ -98,11 +505,16 @@ class Field:
         :param field_default    默认值
         :param field_comment    字段说明
         :param json_string      描述字段的json字符串，优先使用json字符串构造字段
+        :param field_dict       描述字段的字典，格式同json字符串解析后的结果
+        :param field_type_name  message/enum字段引用的类型名，解析后为以'.'开头的全限定名；其他类型为None
         :return
         """
         # 若json_string不为空，直接使用json字符串进行构造
         if json_string is not None:
-            self.__parse_from_json(json_string)
+            self.__parse_from_dict(json.loads(json_string))
+            return
+        if field_dict is not None:
+            self.__parse_from_dict(field_dict)
             return
 
         # 检查参数
@@ -114,13 +526,14 @@ class Field:
             raise ParamError('Invalid Parameter field_property[%s]' % str(field_property))
         if not isinstance(field_sequence, int):
             raise ParamError('Invalid Parameter field_sequence[%s]' % str(field_sequence))
-        self.name = field_name
-        self.type = field_type
-        self.property = field_property
+        self.name = sys.intern(field_name)
+        self.type_code = FieldTypeCode[field_type]
+        self.property_code = FieldPropertyCode[field_property]
         self.sequence = field_sequence
         self.default = field_default
         self.comment = field_comment
         self.value = field_value
+        self.type_name = field_type_name
 
     def __str__(self):
         """
@@ -129,59 +542,97 @@ class Field:
         return  '  field_name: %s\n  field_type: %s\n  field_property: %s\n  field_sequence: %d\n  filed_default: %s\n  field_comment: %s\n  field_value: %s\n' % (
             self.name, self.type, self.property, self.sequence, self.default, self.comment, str(self.value))
 
-    def __parse_from_json(self, json_string):
+    def __parse_from_dict(self, l_dict):
         """
-        根据json字符串构造
-        :param json_string:
+        根据字典构造
+        :param l_dict:
         """
         # 检查消息必要字段
-        l_dict = json.loads(json_string)
         if 'field_name' not in l_dict or \
             'field_type' not in l_dict or l_dict['field_type'] not in FieldTypes or \
             'field_property' not in l_dict  or l_dict['field_property'] not in FieldProperty or \
             'field_sequence' not in l_dict or not isinstance(l_dict['field_sequence'], int):
             raise FormatError('Invlaid Json string for serialize to Field')
 
-        self.name = l_dict['field_name']
-        self.type = l_dict['field_type']
-        self.property = l_dict['field_property']
+        self.name = sys.intern(l_dict['field_name'])
+        self.type_code = FieldTypeCode[l_dict['field_type']]
+        self.property_code = FieldPropertyCode[l_dict['field_property']]
         self.sequence = l_dict['field_sequence']
         self.default = None if ('field_default' not in l_dict) else l_dict['field_default']
         self.comment = '' if ('field_comment' not in l_dict) else l_dict['field_comment']
         self.value = None if ('field_value' not in l_dict) else l_dict['field_value']
+        self.type_name = l_dict.get('field_type_name')
+
+    @property
+    def type(self):
+        return FieldTypeNames[self.type_code]
+
+    @type.setter
+    def type(self, field_type):
+        if field_type not in FieldTypeCode:
+            raise ParamError('Invalid Parameter field_type:[%s]' % str(field_type))
+        self.type_code = FieldTypeCode[field_type]
+
+    @property
+    def property(self):
+        return FieldPropertyNames[self.property_code]
+
+    @property.setter
+    def property(self, field_property):
+        if field_property not in FieldPropertyCode:
+            raise ParamError('Invalid Parameter field_property[%s]' % str(field_property))
+        self.property_code = FieldPropertyCode[field_property]
+
+    def to_dict(self):
+        """
+        将内容以字典形式返回
+        """
+        field_dict = {'field_name': self.name,
+                      'field_type': self.type,
+                      'field_property': self.property,
+                      'field_sequence': self.sequence,
+                      'field_default': self.default,
+                      'field_comment': self.comment,
+                      'field_value': self.value}
+        if self.type_name is not None:
+            field_dict['field_type_name'] = self.type_name
+        return field_dict
 
     def to_json(self):
         """
         将内容以格式化json字符串
         """
-        l_dict = {'field_name': self.name,
-                  'field_type': self.type,
-                  'field_property': self.property,
-                  'field_sequence': self.sequence,
-                  'field_default': self.default,
-                  'field_comment': self.comment,
-                  'field_value': self.value}
-        return json.dumps(l_dict, ensure_ascii=False)
+        return json.dumps(self.to_dict(), ensure_ascii=False)
 
 
 class Message:
     """
     pb消息
+    解析完成后不应再修改消息结构；serialize()、message_class_entry()等可在多个线程中同时调用，
+    编译得到的MessageClassEntry(描述符池、消息类及填充计划)不再修改，可在线程间共享
     """
-    # 动态构造PB消息的工厂实例
-    _factory = None
-    _file_proto = None
-    #_file_proto = FileDescriptorProto(name='dummy.proto', package='pkg')
 
-    def __init__(self, message_name=None, message_pkg=None, message_comment=None, message_fields=None, json_string=None):
+    __slots__ = ('__name', '__fields', '__pkg', '__comment', '__fingerprint', '__scope', '__nested', '__enums',
+                 '__descriptor_set')
+
+    def __init__(self, message_name=None, message_pkg=None, message_comment=None, message_fields=None, json_string=None, message_dict=None, message_scope=''):
         """
         :param message_name     消息名
         :param message_fields   消息的字段列表
         :param json_string      描述消息的json字符串，优先使用json字符串构造消息
+        :param message_dict     描述消息的字典，格式同json字符串解析后的结果
+        :param message_scope    外层消息名，以'.'分隔，顶层消息为''
         """
+        self.__scope = message_scope
+        self.__nested = []
+        self.__enums = []
+        self.__descriptor_set = None
         # 若json_string不为空，直接使用json字符串进行构造
         if json_string is not None:
-            self.__parse_from_json(json_string)
+            self.__parse_from_dict(json.loads(json_string))
+            return
+        if message_dict is not None:
+            self.__parse_from_dict(message_dict)
             return
 
         # 检查参数
@@ -193,7 +644,7 @@ class Message:
         self.__fields = [] if (message_fields == None) else message_fields
         self.__pkg = message_pkg
         self.__comment = message_comment
-
+        self.__fingerprint = None
 
     def __str__(self):
         """
@@ -206,93 +657,187 @@ class Message:
             string += (str(field) + '\n')
         return string
 
-    def __parse_from_json(self, json_string):
+    def __parse_from_dict(self, l_dict):
         """
-        解析json字符串，构造消息
+        根据字典构造消息
         """
-        # 若json_string不为空，直接使用json字符串进行构造
-        l_dict = json.loads(json_string)
         if 'message_name' not in l_dict or \
             'field_list' not in l_dict or \
             len(l_dict['field_list']) == 0:
-            raise format('Invlaid Json string for serialize to Messafe')
+            raise FormatError('Invlaid Json string for serialize to Messafe')
         self.__name = l_dict['message_name']
         self.__comment = None if ('message_comment' not in l_dict) else l_dict['message_comment']
         self.__pkg = None if ('message_pkg' not in l_dict) else l_dict['message_pkg']
+        self.__fingerprint = None
         self.__fields = []
         for field_dict in l_dict['field_list']:
-            self.__fields.append(Field(json_string=json.dumps(field_dict, ensure_ascii=False)))
+            self.__fields.append(Field(field_dict=field_dict))
 
     def __create_dynamic_message(self):
-        try:
-            # 找到直接返回
-            self._factory.pool.FindMessageTypeByName('%s.%s' % (str(self.__pkg), str(self.__name)))
-            return
-        except KeyError:
-            pass
-        # 未找到则创建
-        message_proto = self._file_proto.message_type.add(name=self.__name)
+        """
+        构造消息描述符及消息类，结果由descriptor_cache缓存
+        只用于未关联DescriptorSet的消息，此时消息不能引用其他消息或枚举
+        :return:
+        """
+        if self.references():
+            raise FormatError('message %s references %s, load it with FileFsm or SchemaRegistry'
+                              % (self.__name, ', '.join(self.references())))
+        pool = descriptor_pool.DescriptorPool()
+        # dummy.proto为虚拟文件，若未明确指定pkg，则pkg默认为'None'; package参数不能为空，否则后面找消息类时会出错
+        file_proto = FileDescriptorProto(name='dummy.proto', package=str(self.__pkg))
+        self.fill_file_proto(file_proto)
+        # 将构造好的虚拟PB文件添加到独立的描述符池中，不同结构的同名消息互不影响
+        pool.Add(file_proto)
+        descriptor = pool.FindMessageTypeByName('%s.%s' % (str(self.__pkg), str(self.__name)))
+        return MessageClassEntry(pool, descriptor, get_message_class(descriptor), compile_plan(descriptor))
+
+    def fill_file_proto(self, file_proto):
+        """
+        将消息描述添加到FileDescriptorProto中
+        :param file_proto:
+        :return:
+        """
+        self.fill_proto(file_proto.message_type)
+
+    def fill_proto(self, message_protos):
+        """
+        将消息描述(包括嵌套的消息及枚举)添加到FileDescriptorProto.message_type或DescriptorProto.nested_type中
+        :param message_protos:
+        :return:
+        """
+        message_proto = message_protos.add(name=self.__name)
         for field in self.__fields:
-            if field.type == 'enum':
-                print('not support yet')
-            elif field.type == 'message':
-                print('not support yet')
+            if field.type_name is not None:
+                message_proto.field.add(name=field.name,
+                                        type=FieldType2PbType[field.type],
+                                        type_name=field.type_name,
+                                        number=field.sequence,
+                                        label=FieldProperty2PbProperty[field.property])
+            elif field.type in {'enum', 'message'}:
+                # 引用的类型未知，无法构造字段描述
+                raise FormatError('field %s.%s: type %s without type name not support yet'
+                                  % (self.full_name(), field.name, field.type))
             else:
                 message_proto.field.add(name=field.name,
                                         type=FieldType2PbType[field.type],
                                         number=field.sequence,
                                         label=FieldProperty2PbProperty[field.property])
-        # 将构造好的虚拟PB文件添加到工厂实例中
-        self._factory.pool.Add(self._file_proto)
+        for nested in self.__nested:
+            nested.fill_proto(message_proto.nested_type)
+        for enum in self.__enums:
+            enum.fill_proto(message_proto.enum_type)
 
-    def __create_message_object(self):
-        try:
-            descriptor = self._factory.pool.FindMessageTypeByName('%s.%s' % (str(self.__pkg), str(self.__name)))
-            message = self._factory.GetPrototype(descriptor)
-            msg = message()
-            for field in self.__fields:
-                if field.type == 'message':
-
-                    print('not support')
-                elif field.type == 'bool':
-                    fd = descriptor.fields_by_name[field.name]
-                    msg._fields[fd] = (field.value == 'true')
-                else:
-                    fd = descriptor.fields_by_name[field.name]
-                    msg._fields[fd] = field.value
-            # 设置消息改动标记，在计算消息的长度是才会正确计算
-            msg._Modified()
-            return msg
-        except KeyError:
-            print('not found')
-            pass
+    def __create_message_object(self, entry):
+        """
+        按填充计划创建消息对象，只使用公开的赋值接口，兼容python/upb/cpp各实现
+        :param entry:
+        :return:
+        """
+        msg = entry.message_class()
+        fill_message(msg, dict((field.name, field.value) for field in self.__fields), entry.plan)
+        return msg
 
-    def to_json(self):
+    def fingerprint(self):
         """
-        将消息转换为json格式字符串
+        返回字段结构指纹，字段名、类型、属性、序号任一变化都会导致指纹变化
+        已关联DescriptorSet的消息，结构还包括其引用的消息及枚举，指纹为整组描述的哈希
+        :return:
+        """
+        if self.__descriptor_set is not None:
+            return self.__descriptor_set.digest()
+        if self.__fingerprint is None:
+            schema = ';'.join('%s:%s:%s:%d' % (field.name, field.type, field.property, field.sequence)
+                              for field in self.__fields)
+            self.__fingerprint = hashlib.sha1(schema.encode('utf-8')).hexdigest()
+        return self.__fingerprint
+
+    def cache_key(self):
+        """
+        返回描述符缓存使用的键
         :return:
         """
-        l_dict = {
+        name = '%s.%s' % (self.__scope, self.__name) if self.__scope else self.__name
+        if self.__descriptor_set is not None:
+            return str(self.__pkg), name, self.__descriptor_set.cache_token()
+        return str(self.__pkg), name, self.fingerprint()
+
+    def to_dict(self):
+        """
+        将消息转换为字典
+        :return:
+        """
+        message_dict = {
             'message_name': self.__name,
             'message_comment': self.__comment,
-            'message_fields': []
+            'message_fields': [field.to_dict() for field in self.__fields]
         }
-        for field in self.__fields:
-            l_dict['message_fields'].append(json.loads(field.to_json()))
-        return json.dumps(l_dict, ensure_ascii=False)
+        if self.__nested:
+            message_dict['message_nested'] = [nested.to_dict() for nested in self.__nested]
+        if self.__enums:
+            message_dict['message_enums'] = [enum.to_dict() for enum in self.__enums]
+        return message_dict
+
+    def to_json(self):
+        """
+        将消息转换为json格式字符串
+        :return:
+        """
+        return json.dumps(self.to_dict(), ensure_ascii=False)
 
     def serialize(self):
         """
         将消息按照PB规则序列化为二进制数据
         :return:
         """
-        self._factory = message_factory.MessageFactory()
-        # dummy.proto为虚拟文件，若未明确指定pkg，则pkg默认为'None'; package参数不能为空，否则后面找消息类时会出错
-        self._file_proto = FileDescriptorProto(name='dummy.proto', package=str(self.__pkg))
-        # 创建动态消息
-        self.__create_dynamic_message()
         # 创建消息对象
-        return self.__create_message_object()
+        hook = pb_metrics.hook
+        if hook is None:
+            return self.__create_message_object(self.message_class_entry())
+        start = time.perf_counter()
+        msg = self.__create_message_object(self.message_class_entry())
+        hook('serialize', time.perf_counter() - start, 1)
+        return msg
+
+    def message_class_entry(self):
+        """
+        获取动态消息类，相同结构的消息只在首次使用时构造
+        :return: MessageClassEntry
+        """
+        if self.__descriptor_set is None:
+            creator = self.__create_dynamic_message
+        else:
+            full_name = self.full_name()
+            descriptor_set = self.__descriptor_set
+            creator = lambda: descriptor_set.create_entry(full_name)
+        hook = pb_metrics.hook
+        if hook is not None:
+            creator = _timed('create_class', hook, creator)
+        return descriptor_cache.get_or_create(self.cache_key(), creator)
+
+    def set_descriptor_set(self, descriptor_set):
+        """
+        关联消息所在的DescriptorSet，之后消息类从整组描述构造的描述符池中获取
+        :param descriptor_set   DescriptorSet，为None时取消关联
+        :return:
+        """
+        self.__descriptor_set = descriptor_set
+
+    def descriptor_set(self):
+        """
+        返回关联的DescriptorSet，未关联时返回None
+        :return:
+        """
+        return self.__descriptor_set
+
+    def references(self):
+        """
+        返回消息字段引用的类型名列表，包括嵌套消息的字段
+        :return:
+        """
+        names = [field.type_name for field in self.__fields if field.type_name is not None]
+        for nested in self.__nested:
+            names.extend(nested.references())
+        return names
 
     def add_field(self, message_field):
         """
@@ -303,6 +848,7 @@ class Message:
         if not isinstance(message_field, Field):
             raise ParamError('Invalid Parameter message_field')
         self.__fields.append(message_field)
+        self.__fingerprint = None
 
     def add_comment(self, comment):
         """
@@ -322,134 +868,125 @@ class Message:
         """
         return self.__name
 
+    def package(self):
+        """
+        返回消息所在的pkg
+        :return:
+        """
+        return self.__pkg
 
-class LineFsm:
-    """
-    行解析状态机
-    :param line: 行内容
-    :param number: 行号
-    """
+    def comment(self):
+        """
+        返回消息注释
+        :return:
+        """
+        return self.__comment
 
-    words = []
-    line_number = 0
+    def fields(self):
+        """
+        返回消息的字段列表
+        :return:
+        """
+        return self.__fields
 
-    def __init__(self, line, number, line_status=LineStatus.line_status_undefine):
-        self.__line = line
-        self.__line_status = line_status
-        LineFsm.line_number = number
+    def scope(self):
+        """
+        返回外层消息名，以'.'分隔，顶层消息为''
+        :return:
+        """
+        return self.__scope
 
-    def __str__(self):
-        return self.__line
+    def full_name(self):
+        """
+        返回消息的全限定名
+        :return:
+        """
+        return '.'.join(part for part in (self.__pkg, self.__scope, self.__name) if part)
 
-    def parse(self):
+    def add_nested_message(self, message):
         """
-        解析行
+        增加嵌套消息
+        :param message:
         :return:
         """
-        # 对行做分割
-        LineFsm.words = self.__line.split()
-        # 空行不作处理
-        if 0 == len(LineFsm.words):
-            self.__line_status = LineStatus.line_status_empty
-            return
-        # 根据行第一个字符串判断行的性质
-        if LineFsm.words[0] in LineStatusMessage:
-            # 新消息头
-            self.__line_status = LineStatus.line_status_message
-        elif "import" == LineFsm.words[0]:
-            self.__line_status = LineStatus.line_status_import
-        elif "package" == LineFsm.words[0]:
-            self.__line_status = LineStatus.line_status_package
-        elif '//' == LineFsm.words[0][0:2]:
-            self.__line_status = LineStatus.line_status_comment
-        else:
-            self.__line_status = LineStatus.line_status_others
-
-    def parse_message_new(self):
-        # 确定行为新消息声明行时，做进一步解析
-        w = []
-        for word in LineFsm.words:
-            for i in word.split("{"):
-                if "" != i:
-                    w.append(i)
-        self.words = w
-
-    def parse_message_element(self):
-        """
-        确定行为消息字段是，做进一步解析
-        解析后的字段列表为["optional", "bool", "name", "1", "comment"]
-        :return:
-        """
-        w = []
-        word_pos_s = 0
-        word_pos_e = 0
-        pure_line = self.__line.replace('\t', ' ')
-        pure_line = pure_line.replace('=', ' ')
-        pure_line = pure_line.replace(';', ' ')
-        for ch in pure_line:
-            if "/" == ch:
-                w.append(pure_line[word_pos_s + 2:].strip('\n'))
-                break
-                # return
-            elif ch.isalnum() or '_' == ch:
-                word_pos_e += 1
-            elif ' ' == ch:
-                if word_pos_s == word_pos_e:
-                    word_pos_s += 1
-                    word_pos_e += 1
-                    continue
-                w.append(pure_line[word_pos_s:word_pos_e])
-                word_pos_s = word_pos_e = word_pos_e + 1
-        # 检查解析后的字符串列表
-        if (len(w) != 4 and len(w) != 5) or \
-            w[0] not in FieldProperty or \
-            w[1] not in FieldTypes or \
-            not w[3].isdigit():
-            raise FormatError('invalid syntax. line:%d' % self.line_number + ', Message element format invalid')
-        # 若无注释信息，需手动补齐空字符串
-        if len(w) == 4:
-            w.append("")
-        # 保存结果
-        LineFsm.words = w
+        if not isinstance(message, Message):
+            raise ParamError('Invalid Parameter message')
+        self.__nested.append(message)
+
+    def add_enum(self, enum):
+        """
+        增加嵌套枚举
+        :param enum:
+        :return:
+        """
+        if not isinstance(enum, EnumType):
+            raise ParamError('Invalid Parameter enum')
+        self.__enums.append(enum)
 
-    def line_status(self):
+    def nested_messages(self):
         """
-        获取行状态
+        返回嵌套消息列表
         :return:
         """
-        return self.__line_status
+        return self.__nested
 
-    def line_content(self):
+    def enums(self):
         """
-        返回行原内容
+        返回嵌套枚举列表
         :return:
         """
-        return self.__line
+        return self.__enums
 
 
 class FileFsm:
     """
     文件解析状态机
+    由词法分析器产生的词法单元直接驱动，文件内容只扫描一遍
+    全部状态保存在实例中，不同实例可在多个线程中同时解析；同一实例的parse()/reparse()不能与其他方法同时调用，
+    parse()完成后message()/messages()等可在多个线程中同时调用，延迟模式下消息的解析由实例内的锁串行执行
     """
 
-    # 缓存遇到行内容
-    line_cache = []
-    # 正在处理中的消息
-    message_cache = None
-
-    def __init__(self, path):
+    def __init__(self, path, schema_cache=None, incremental=False, lazy=False):
+        """
+        :param path             proto文件路径
+        :param schema_cache     磁盘缓存，见pb_schema_cache.SchemaCache；为None时不使用缓存
+        :param incremental      增量模式，保留文件内容及各消息的区域，reparse()时只重新解析变化的消息
+        :param lazy             延迟模式，parse()只预扫描消息的位置，消息在首次获取时才解析；
+                                消息体内的语法错误在获取该消息时才报告，缓存未命中时不写入磁盘缓存
+        """
+        if incremental and lazy:
+            raise ParamError('Invalid Parameter, incremental and lazy can not be used together')
         self.__path = path
         self.__pkg = ''
         self.__message = dict()
-        self.__line_rotine = {
-            LineStatus.line_status_undefine: self.__rt_undefine,
-            LineStatus.line_status_import: self.__rt_import,
-            LineStatus.line_status_package: self.__rt_package,
-            LineStatus.line_status_message: self.__rt_message,
-            LineStatus.line_status_comment: self.__rt_comment,
-            LineStatus.line_status_empty: self.__rt_empty,
-            LineStatus.line_status_others: self.__rt_other,
-            LineStatus.line_status_eof: self.__rt_eof
+        self.__enums = dict()
+        self.__imports = []
+        self.__file_proto = None
+        self.__schema_cache = schema_cache
+        self.__incremental = incremental
+        self.__lazy = lazy
+        # 延迟模式下尚未解析的消息: 消息名 -> (区域开始, 区域结束, 区域开始处的pkg)，及文件内容
+        self.__index = dict()
+        self.__index_names = dict()
+        self.__text = None
+        # 延迟模式下已解析的类型，增量模式下文件中的全部类型: 全限定名 -> 'message'/'enum'
+        self.__kinds = dict()
+        # 延迟模式下本轮解析的消息，全部解析完成后再关联DescriptorSet
+        self.__loading = None
+        # 延迟模式下解析消息时持有，解析过程中会递归解析引用的消息
+        self.__lock = threading.RLock()
+        # 增量模式下保存上次解析的文件内容及各消息的区域
+        self.__source = None
+        self.__spans = []
+        # 最后一个消息之后是否有package/import语句
+        self.__tail_header = False
+        # 词法单元迭代器
+        self.__tokens = None
+        # 缓存遇到的注释，作为下一个消息的注释
+        self.__comment_cache = []
+        self.__statement_rotine = {
+            'import': self.__rt_import,
+            'package': self.__rt_package
         }
 
     def __str__(self):
@@ -463,159 +1000,752 @@ class FileFsm:
         获取指定消息的json描述
         :return:
         """
-        return self.__message[message_name].to_json()
+        return self.message(message_name).to_json()
+
+    def message(self, message_name):
+        """
+        获取指定消息，嵌套消息以'外层消息名.消息名'表示
+        :return:
+        """
+        if self.__index:
+            # 延迟模式下消息在解析完成、关联DescriptorSet之前已放入self.__message，查找也需要持有锁
+            with self.__lock:
+                return self.__find(message_name)
+        return self.__find(message_name)
+
+    def __find(self, message_name):
+        try:
+            return self.__message[message_name]
+        except KeyError:
+            if message_name in self.__index:
+                return self.__load(message_name)
+            if '.' not in message_name:
+                raise
+        names = message_name.split('.')
+        message = self.__find(names[0])
+        for name in names[1:]:
+            for nested in message.nested_messages():
+                if nested.name() == name:
+                    message = nested
+                    break
+            else:
+                raise KeyError(message_name)
+        return message
+
+    def package(self):
+        """
+        返回文件的pkg
+        :return:
+        """
+        return self.__pkg
+
+    def messages(self):
+        """
+        返回文件中的全部消息，按声明顺序排列；延迟模式下会解析全部消息
+        :return:
+        """
+        if self.__index:
+            return [self.message(name) for name in self.__index]
+        return list(self.__message.values())
+
+    def enums(self):
+        """
+        返回文件中的顶层枚举，按声明顺序排列
+        :return:
+        """
+        return list(self.__enums.values())
+
+    def imports(self):
+        """
+        返回import语句导入的文件，按声明顺序排列
+        :return:
+        """
+        return list(self.__imports)
+
+    def to_file_proto(self):
+        """
+        返回描述整个文件的FileDescriptorProto
+        :return:
+        """
+        if self.__file_proto is None:
+            self.__file_proto = build_file_proto(os.path.basename(self.__path), self.__pkg, self.__imports,
+                                                 self.messages(), self.enums())
+        return self.__file_proto
 
     def parse(self):
         """
-        解析文件
+        解析文件，若指定了磁盘缓存且缓存有效，直接加载缓存内容
         :return:
         """
-        # 格式化文件内容
-        self.__format()
-        # 按行解析文件
-        line_number = 1
-        #for line_string in open(self.__path):
-        for line_string in self.__format().split('\n'):
-            line = LineFsm(line_string, line_number)
-            line.parse()
-            # 根据行属性分别处理
-            self.__line_rotine[line.line_status()](line)
-            line_number += 1
+        hook = pb_metrics.hook
+        if hook is None:
+            self.__parse(None)
+            return
+        start = time.perf_counter()
+        size = self.__parse(hook)
+        hook('parse', time.perf_counter() - start, len(self.__message) + len(self.__index), size)
 
-    def __format(self):
+    def __parse(self, hook):
+        """
+        :param hook     pb_metrics.hook，为None时不统计各阶段耗时
+        :return: 读取的字节数
+        """
+        if self.__schema_cache is not None:
+            start = time.perf_counter() if hook is not None else 0
+            cached = self.__schema_cache.load(self.__path)
+            if hook is not None:
+                hook('schema_cache_load', time.perf_counter() - start, 0 if cached is None else len(cached[1]))
+            if cached is not None:
+                self.__pkg, messages, enums, self.__imports, self.__file_proto = cached
+                self.__message = dict((message.name(), message) for message in messages)
+                self.__enums = dict((enum.name(), enum) for enum in enums)
+                self.__source = None
+                self.__index = dict()
+                self.__link()
+                return 0
+        with open(self.__path, 'rb') as f:
+            # 在读取之前获取文件状态，读取之后文件被修改时缓存中的mtime与内容不会对应
+            st = os.fstat(f.fileno())
+            data = f.read()
+        if self.__lazy:
+            self.__scan(data.decode('utf-8'))
+            return len(data)
+        if hook is None:
+            self.__parse_full(data.decode('utf-8'))
+            self.__link()
+        else:
+            start = time.perf_counter()
+            self.__parse_full(data.decode('utf-8'))
+            linked = time.perf_counter()
+            hook('parse_text', linked - start, len(self.__message), len(data))
+            self.__link()
+            hook('link', time.perf_counter() - linked, len(self.__message))
+        if self.__schema_cache is not None:
+            self.__schema_cache.store(self.__path, data, self.__pkg, self.messages(), self.enums(), self.__imports,
+                                      self.to_file_proto(), st)
+        return len(data)
+
+    def reparse(self):
+        """
+        重新解析文件，返回与上次解析结果的差异
+        增量模式下只重新解析内容发生变化的消息，无法增量处理时(如pkg变化)自动退回完整解析
+        :return: {'added': [消息名], 'removed': [消息名],
+                  'changed': {消息名: {'added_fields': [字段名], 'removed_fields': [字段名], 'changed_fields': [字段名]}}}
+        """
+        if self.__index:
+            # 延迟模式下先解析全部消息，以便与新内容比较
+            self.messages()
+        old_messages = self.__message
+        old_spans = dict((span.name, span.digest) for span in self.__spans)
+        with open(self.__path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        text = data.decode('utf-8')
+        replaced = None
+        if self.__incremental and self.__source is not None:
+            replaced = self.__parse_incremental(text)
+        if replaced is None:
+            self.__parse_full(text)
+        try:
+            self.__link(replaced)
+        except BaseException:
+            # 各消息的类型可能只解析了一部分，下次完整解析
+            self.__source = None
+            raise
+        if self.__schema_cache is not None:
+            self.__schema_cache.store(self.__path, data, self.__pkg, self.messages(), self.enums(), self.__imports,
+                                      self.to_file_proto(), st)
+        new_spans = dict((span.name, span.digest) for span in self.__spans)
+        return diff_messages(old_messages, self.__message, old_spans, new_spans)
+
+    def __parse_full(self, text):
         """
-        对文件内容做格式化处理
+        完整解析文件内容
+        :param text:
         :return:
         """
-        file_data = ''
-        for line_string in open(self.__path):
-            line_cur_s = line_cur_e = 0
-            new_line_flag = False
-            comment_flag = False
-            for ch in line_string:
-                # 若被标记为注释，则不判断内容
-                if True == comment_flag and '\n' != ch:
-                    line_cur_e += 1
-                    continue
+        self.__pkg = ''
+        self.__imports = []
+        self.__enums = dict()
+        self.__comment_cache = []
+        self.__index = dict()
+        self.__text = None
+        parsed = self.__parse_text(text, 0, len(text), 1, 0)
+        self.__message = dict((message.name(), message) for message, span in parsed)
+        if self.__incremental:
+            self.__source = text
+            self.__spans = [span for message, span in parsed]
+
+    def __scan(self, text):
+        """
+        延迟模式：预扫描文件内容，记录各顶层消息的区域；package、import及顶层枚举直接解析
+        消息的区域与完整解析时相同，从上一个消息或顶层枚举结束处开始，包含消息前的注释
+        :param text:
+        :return:
+        """
+        self.__pkg = ''
+        self.__imports = []
+        self.__enums = dict()
+        self.__message = dict()
+        self.__index = dict()
+        self.__index_names = dict()
+        self.__comment_cache = []
+        self.__text = text
+        # 已解析到的位置及其行号；消息之外的内容中出现了预扫描未识别的消息时为True
+        state = {'pos': 0, 'line': 1, 'missed': False}
+
+        def parse_to(end):
+            pos = state['pos']
+            if end > pos:
+                line_start = text.rfind('\n', 0, pos) + 1
+                if self.__parse_text(text, pos, end, state['line'], line_start):
+                    state['missed'] = True
+                self.__comment_cache.clear()
+                state['line'] += text.count('\n', pos, end)
+                state['pos'] = end
+
+        region_start = 0
+        for kind, name, start, end in scan_blocks(text):
+            if kind == 'enum':
+                parse_to(end)
+                region_start = end
+                continue
+            # 区域开始前的语句决定消息所在的pkg，区域内消息之前的package/import语句在解析消息时重复处理
+            parse_to(region_start)
+            self.__index[name] = (region_start, end, self.__pkg)
+            parse_to(start)
+            self.__index_names['.'.join(part for part in (self.__pkg, name) if part)] = name
+            state['pos'] = region_start = end
+            state['line'] += text.count('\n', start, end)
+        parse_to(len(text))
+        if state['missed']:
+            # 如消息名前有注释等预扫描无法识别的写法，退回完整解析
+            self.__parse_full(text)
+            self.__link()
+            return
+        self.__kinds = dict((full_name, kind) for full_name, kind, item in iter_types((), self.enums()))
 
-                if ch.isalnum() or ch in {'_', '='}:
-                    # 新行标志为真，若不是comment，且下一个为字符，需换行
-                    if new_line_flag == True:
-                        word = line_string[line_cur_s:line_cur_e]
-                        file_data += (word + '\n')
-                        # 重新开始计算位置
-                        line_cur_s = line_cur_e
-                        line_cur_e += 1
-                        new_line_flag = False
-                        comment_flag = False
-                    else:
-                        line_cur_e += 1
-
-                elif ch in  {' ', '\t'}:
-                    if new_line_flag == True:
-                        line_cur_e += 1
-                    elif line_cur_e == line_cur_s:
-                        line_cur_e += 1
-                        line_cur_s += 1
-                    else:
-                        word = line_string[line_cur_s:line_cur_e]
-                        file_data += (word + ' ')
-                        line_cur_s = line_cur_e = (line_cur_e + 1)
-
-                elif ch == '{':
-                    word = line_string[line_cur_s:line_cur_e]
-                    file_data += (word + '\n')
-                    file_data += (ch + '\n')
-                    line_cur_s = line_cur_e = (line_cur_e + 1)
-
-                elif ch == ';':
-                    new_line_flag = True
-                    line_cur_e += 1
-
-                elif ch == '\n':
-                    word = line_string[line_cur_s:line_cur_e]
-                    file_data += (word + '\n')
-
-                elif ch == '}':
-                    # 若已置换行，需要先把当前行的内容输出
-                    if new_line_flag == True:
-                        word = line_string[line_cur_s:line_cur_e]
-                        file_data += word
-                    file_data += ('\n' + ch)
-                    line_cur_s = line_cur_e = (line_cur_e + 1)
-
-                elif ch == '/':
-                    comment_flag = True
-                    line_cur_e += 1
-        return file_data
-
-    def __rt_import(self, line):
-        """
-        处理import行
-        :param line:
-        :return:
-        """
-        print('import not support')
-        sys.exit(-1)
-        path = line.words[1].split("\"")[1]
-        file_fms = FileFsm(path)
-        file_fms.parse()
-
-    def __rt_package(self, line):
-        self.__pkg = line.words[1]
-
-    def __rt_message(self, line):
-        # 消息开始
-        if "message" == line.words[0]:
-            # 判断是否正在解析上一个消息
-            if FileFsm.message_cache != None:
-                raise FormatError("invalid syntax. line: " + str(line) + ". Parsing message have not finish")
-            # 新建一个消息进行解析
-            line.parse_message_new()
-            FileFsm.message_cache = Message(message_name=line.words[1], message_pkg=self.__pkg, message_fields=[])
-            # 处理缓存行
-            for l in FileFsm.line_cache:
-                if self.is_comment(l):
-                    FileFsm.message_cache.add_comment(l[2:])
+    def __load(self, name):
+        """
+        延迟模式：解析预扫描时记录的消息，结果保存在self.__message中
+        :param name:
+        :return:
+        """
+        start, end, pkg = self.__index[name]
+        text = self.__text
+        pkg_saved, imports_saved = self.__pkg, self.__imports
+        self.__pkg = pkg
+        self.__imports = []
+        self.__comment_cache = []
+        try:
+            parsed = self.__parse_text(text, start, end, text.count('\n', 0, start) + 1, text.rfind('\n', 0, start) + 1)
+        finally:
+            self.__pkg, self.__imports = pkg_saved, imports_saved
+        message = parsed[-1][0]
+        self.__message[name] = message
+        for full_name, kind, item in iter_types([message]):
+            self.__kinds[full_name] = kind
+
+        outermost = self.__loading is None
+        if outermost:
+            self.__loading = []
+        self.__loading.append(message)
+        try:
+            # 解析引用的类型时可能解析其他消息
+            unresolved = resolve_types([message], self.__lookup)
+            if unresolved and not self.__imports:
+                scope, field_name, type_name = unresolved[0]
+                raise FormatError('%s: unknown type %s for field %s.%s' % (self.__path, type_name, scope, field_name))
+            if outermost and not self.__imports:
+                self.__link_loaded(self.__loading)
+        except BaseException:
+            del self.__message[name]
+            raise
+        finally:
+            if outermost:
+                self.__loading = None
+        if len(self.__message) == len(self.__index):
+            # 全部消息已解析，不再需要文件内容
+            self.__text = None
+        return message
+
+    def __lookup(self, full_name):
+        """
+        延迟模式下按全限定名查找类型，类型所在的顶层消息尚未解析时先解析该消息
+        :param full_name:
+        :return: 'message'/'enum'，不存在时返回None
+        """
+        kind = self.__kinds.get(full_name)
+        if kind is None:
+            parts = full_name.split('.')
+            for i in range(1, len(parts) + 1):
+                name = self.__index_names.get('.'.join(parts[:i]))
+                if name is not None and name not in self.__message:
+                    self.__load(name)
+                    return self.__kinds.get(full_name)
+        return kind
+
+    def __link_loaded(self, messages):
+        """
+        延迟模式：为本轮解析的、引用了其他类型的消息关联DescriptorSet
+        DescriptorSet只包含已解析的消息，其中包括这些消息引用的全部类型
+        :param messages:
+        :return:
+        """
+        descriptor_set = None
+        for full_name, kind, item in iter_types(messages):
+            if kind == 'message' and item.references():
+                if descriptor_set is None:
+                    file_proto = build_file_proto(os.path.basename(self.__path), self.__pkg, self.__imports,
+                                                  list(self.__message.values()), self.enums())
+                    descriptor_set = DescriptorSet([file_proto])
+                item.set_descriptor_set(descriptor_set)
+
+    def __link(self, replaced=None):
+        """
+        解析字段引用的消息/枚举类型
+        文件没有import时，引用了其他类型的消息关联整个文件的DescriptorSet；有import的文件由SchemaRegistry负责关联
+        :param replaced     增量解析时被替换的(旧消息列表, 新消息列表)，为None时关联全部消息
+        :return:
+        """
+        if replaced is not None and not self.__imports:
+            self.__link_replaced(*replaced)
+            return
+        kinds = dict((full_name, kind) for full_name, kind, item in iter_types(self.messages(), self.enums()))
+        if self.__incremental:
+            self.__kinds = kinds
+        unresolved = resolve_types(self.messages(), kinds.get)
+        if self.__imports:
+            return
+        if unresolved:
+            scope, field_name, type_name = unresolved[0]
+            raise FormatError('%s: unknown type %s for field %s.%s' % (self.__path, type_name, scope, field_name))
+        descriptor_set = None
+        for full_name, kind, item in iter_types(self.messages()):
+            if kind == 'message' and item.references():
+                if descriptor_set is None:
+                    # 字段类型在解析引用时可能发生变化，重新生成文件描述
+                    self.__file_proto = None
+                    descriptor_set = DescriptorSet([self.to_file_proto()])
+                item.set_descriptor_set(descriptor_set)
+
+    def __link_replaced(self, old_messages, new_messages):
+        """
+        增量模式：只为重新解析的消息及直接或间接引用了它们的消息解析类型、关联DescriptorSet
+        其他消息仍使用原来的DescriptorSet，其中包含它们引用的全部类型；新的DescriptorSet只包含需要关联的消息及其引用的消息
+        :param old_messages     被替换的顶层消息
+        :param new_messages     重新解析的顶层消息
+        :return:
+        """
+        kinds = self.__kinds
+        for full_name, kind, item in iter_types(old_messages):
+            kinds.pop(full_name, None)
+        for full_name, kind, item in iter_types(new_messages):
+            kinds[full_name] = kind
+        unresolved = resolve_types(new_messages, kinds.get)
+        if unresolved:
+            scope, field_name, type_name = unresolved[0]
+            raise FormatError('%s: unknown type %s for field %s.%s' % (self.__path, type_name, scope, field_name))
+
+        # 顶层消息名 -> 引用的顶层消息/枚举名，没有import时引用的类型都在本文件中
+        prefix = len(self.__pkg) + 2 if self.__pkg else 1
+        references = dict()
+        referrers = dict()
+        for name, message in self.__message.items():
+            references[name] = set(ref[prefix:].split('.', 1)[0] for ref in message.references())
+            for ref in references[name]:
+                referrers.setdefault(ref, []).append(name)
+        affected = _closure(set(message.name() for message in old_messages + new_messages), referrers)
+        # 被引用的类型可能已删除或变为其他类型，重新解析
+        linked = [message for name, message in self.__message.items() if name in affected]
+        unresolved = resolve_types(linked, kinds.get)
+        if unresolved:
+            scope, field_name, type_name = unresolved[0]
+            raise FormatError('%s: unknown type %s for field %s.%s' % (self.__path, type_name, scope, field_name))
+
+        descriptor_set = None
+        for full_name, kind, item in iter_types(linked):
+            if kind == 'message' and item.references():
+                if descriptor_set is None:
+                    needed = _closure(affected, references)
+                    file_proto = build_file_proto(os.path.basename(self.__path), self.__pkg, self.__imports,
+                                                  [message for name, message in self.__message.items() if name in needed],
+                                                  self.enums())
+                    descriptor_set = DescriptorSet([file_proto])
+                item.set_descriptor_set(descriptor_set)
+
+    def __parse_incremental(self, text):
+        """
+        增量解析：找出与上次内容不同的区域，只重新解析覆盖该区域的消息
+        消息区域之间的package/import语句及顶层枚举不属于任何消息，修改涉及这些语句时需要完整解析
+        :param text:
+        :return: (被替换的旧消息列表, 重新解析的消息列表)，返回None时需要完整解析
+        """
+        old = self.__source
+        spans = self.__spans
+        if text == old:
+            return [], []
+        if not spans:
+            return None
+        # 变化区域在旧内容中为[lo, old_hi)
+        lo = _common_prefix(old, text)
+        old_hi = len(old) - _common_suffix(old, text, min(len(old), len(text)) - lo)
+        hi = max(old_hi, lo + 1)
+        delta = len(text) - len(old)
+        ends = [span.end for span in spans]
+        # 受影响的消息为spans[first:last]，区域到达最后一个消息之后时还包括文件末尾
+        first = bisect.bisect_right(ends, lo)
+        last = bisect.bisect_left(ends, hi) + 1
+        to_tail = last > len(spans)
+        last = min(last, len(spans))
+        if first < len(spans):
+            start, start_line, pkg = spans[first].start, spans[first].start_line, spans[first].pkg
+        else:
+            start, start_line, pkg = spans[-1].end, spans[-1].end_line, spans[-1].pkg
+        old_end = len(old) if to_tail else spans[last - 1].end
+        end = old_end + delta
+
+        # 区域内有package/import语句时，其变化会影响区域外的消息，直接完整解析
+        if lo < start or not _contiguous(spans[first:last], start) or (to_tail and self.__tail_header):
+            return None
+        saved_pkg = self.__pkg
+        tail_header = self.__tail_header
+        self.__pkg = pkg
+        self.__comment_cache = []
+        try:
+            parsed = self.__parse_text(text, start, end, start_line, text.rfind('\n', 0, start) + 1)
+        except (FormatError, UndefineError):
+            parsed = None
+        window_pkg = self.__pkg
+        self.__pkg = saved_pkg
+        # 新内容中出现package/import语句；或注释未被消息使用，会归属于区域之外的消息
+        if parsed is None or not _contiguous([span for message, span in parsed], start) or \
+                (self.__tail_header if to_tail else (self.__comment_cache or not parsed or parsed[-1][1].end != end)):
+            return None
+        line_delta = text.count('\n', start, end) - old.count('\n', start, old_end)
+        new_spans = spans[:first] + [span for message, span in parsed]
+        if not to_tail:
+            new_spans += [span._replace(start=span.start + delta, end=span.end + delta,
+                                        start_line=span.start_line + line_delta, end_line=span.end_line + line_delta)
+                          for span in spans[last:]]
+        if len(set(span.name for span in new_spans)) != len(new_spans):
+            # 有同名消息时无法按消息名对应区域
+            return None
+        if to_tail:
+            self.__pkg = window_pkg
+        else:
+            self.__tail_header = tail_header
+
+        replaced = [self.__message[span.name] for span in spans[first:last]]
+        window = dict((message.name(), message) for message, span in parsed)
+        messages = dict()
+        for span in new_spans:
+            messages[span.name] = window[span.name] if span.name in window else self.__message[span.name]
+        self.__message = messages
+        self.__spans = new_spans
+        self.__source = text
+        self.__file_proto = None
+        return replaced, list(window.values())
+
+    def __parse_text(self, text, start, end, line, line_start):
+        """
+        解析文件内容的[start, end)区域
+        :return: (消息, 消息区域)列表
+        """
+        self.__file_proto = None
+        self.__tokens = tokenize(text, start, line, line_start, end)
+        parsed = []
+        span_start = start
+        span_line = line
+        # 当前区域内是否有package/import语句；最后一个消息之后是否有package/import语句
+        header = False
+        tail_header = False
+        for token in self.__tokens:
+            if token.type == TokenType.token_comment:
+                self.__comment_cache.append(token)
+            elif token.value == 'message':
+                message, end_token = self.__rt_message(token, '', self.__comment_cache)
+                span_end = end_token.offset + 1
+                digest = hashlib.sha1(text[span_start:span_end].encode('utf-8')).digest() if self.__incremental else None
+                parsed.append((message, MessageSpan(message.name(), span_start, span_end, span_line, end_token.line,
+                                                    digest, self.__pkg, header)))
+                span_start = span_end
+                span_line = end_token.line
+                header = tail_header = False
+            else:
+                if token.value == 'enum':
+                    # 顶层枚举按package/import语句处理，所在区域变化时退回完整解析
+                    enum, end_token = self.__rt_enum(token, '', self.__comment_cache)
+                    self.__enums[enum.name()] = enum
+                    self.__comment_cache.clear()
+                elif token.type == TokenType.token_identifier and token.value in self.__statement_rotine:
+                    # 根据语句首个单词分别处理
+                    end_token = self.__statement_rotine[token.value](token)
+                elif token.value == ';':
+                    # 空语句
+                    continue
+                else:
+                    raise UndefineError('unsupport format, line:%d, column:%d, %s'
+                                        % (token.line, token.column, token.value))
+                tail_header = True
+                if self.__comment_cache:
+                    header = True
                 else:
-                    raise FormatError("invalid syntax. line" + str(l.line_number))
-        # 消息结束
-        elif "}" == line.words[0][0:1]:
-            # 保存消息
-            self.__message[FileFsm.message_cache.name()] = FileFsm.message_cache
-            # 清空缓存
-            FileFsm.message_cache = None
-            FileFsm.line_cache.clear()
+                    # 下一个消息的区域从语句之后开始，消息内的修改不会因区域内有package/import语句而退回完整解析
+                    span_start = end_token.offset + 1
+                    span_line = end_token.line
+                    header = False
+        self.__tokens = None
+        self.__tail_header = tail_header
+        return parsed
+
+    def __next_token(self, start):
+        """
+        获取下一个词法单元
+        :param start: 当前语句的首个词法单元，用于报错
+        :return:
+        """
+        token = next(self.__tokens, None)
+        if token is None:
+            raise FormatError('invalid syntax. line:%d, unexpected end of file' % start.line)
+        return token
+
+    def __expect(self, start, token_type, value=None):
+        """
+        获取下一个非注释词法单元，并检查其类型及内容
+        :return:
+        """
+        token = self.__next_token(start)
+        while token.type == TokenType.token_comment:
+            token = self.__next_token(start)
+        if token.type != token_type or (value is not None and token.value != value):
+            raise FormatError('invalid syntax. line:%d, column:%d, unexpected %s'
+                              % (token.line, token.column, token.value))
+        return token
+
+    def __rt_import(self, token):
+        """
+        处理import语句，格式为: import [public|weak] "path";
+        只记录被导入的文件，由SchemaRegistry负责查找及解析
+        :param token:
+        :return: 语句结束的';'
+        """
+        path = self.__next_token(token)
+        while path.type == TokenType.token_comment:
+            path = self.__next_token(token)
+        if path.value in {'public', 'weak'}:
+            path = self.__expect(token, TokenType.token_string)
+        elif path.type != TokenType.token_string:
+            raise FormatError('invalid syntax. line:%d, column:%d, unexpected %s' % (path.line, path.column, path.value))
+        end = self.__expect(token, TokenType.token_punctuation, ';')
+        self.__imports.append(path.value[1:-1])
+        return end
+
+    def __rt_package(self, token):
+        self.__pkg = self.__expect(token, TokenType.token_identifier).value
+        return self.__expect(token, TokenType.token_punctuation, ';')
+
+    def __rt_message(self, token, scope, comments):
+        """
+        处理message语句，消息内可以嵌套定义消息及枚举
+        :param token:
+        :param scope:       外层消息名，以'.'分隔，顶层消息为''
+        :param comments:    消息前的注释
+        :return: 消息及消息结束的'}'
+        """
         # 消息开始
-        elif '{' == line.words[0]:
-            # do nothing
-            return
+        name = self.__expect(token, TokenType.token_identifier)
+        self.__expect(token, TokenType.token_punctuation, '{')
+        message = Message(message_name=name.value, message_pkg=self.__pkg, message_fields=[], message_scope=scope)
+        # 处理缓存的注释
+        for comment in comments:
+            message.add_comment(comment_text(comment))
+        nested_scope = '%s.%s' % (scope, name.value) if scope else name.value
         # 消息内容
-        else:
-            if line.words[0] not in FieldProperty:
-                raise FormatError("invalid syntax. line:" + str(line))
-            if None == FileFsm.message_cache:
-                raise FormatError("invalid syntax. line:" + str(line))
-            # 进一步解析行
-            line.parse_message_element()
-            # 向消息添加字段
-            FileFsm.message_cache.add_field(Field(line.words[2], line.words[1], line.words[0], int(line.words[3]), "", line.words[4]))
+        field = None
+        # 消息内未归属字段的注释，作为下一个嵌套消息或枚举的注释
+        pending = []
+        while True:
+            token = self.__next_token(name)
+            if token.type == TokenType.token_comment:
+                # 与字段同行的注释作为字段说明
+                if field is not None and field_line == token.line and field.comment == '':
+                    field.comment = comment_text(token)
+                else:
+                    pending.append(token)
+            elif token.value == '}':
+                break
+            elif token.value == 'message':
+                nested, end_token = self.__rt_message(token, nested_scope, pending)
+                message.add_nested_message(nested)
+                field = None
+                pending = []
+            elif token.value == 'enum':
+                enum, end_token = self.__rt_enum(token, nested_scope, pending)
+                message.add_enum(enum)
+                field = None
+                pending = []
+            elif token.value == ';':
+                # 空语句
+                continue
+            else:
+                field, field_line = self.__parse_message_element(token)
+                message.add_field(field)
+                pending = []
+        # 清空缓存
+        self.__comment_cache.clear()
+        return message, token
+
+    def __rt_enum(self, token, scope, comments):
+        """
+        处理enum语句，格式为: enum name { [option allow_alias = true;] NAME = number; ... }
+        :param token:
+        :param scope:       外层消息名，以'.'分隔，顶层枚举为''
+        :param comments:    枚举前的注释
+        :return: 枚举及枚举结束的'}'
+        """
+        name = self.__expect(token, TokenType.token_identifier)
+        self.__expect(token, TokenType.token_punctuation, '{')
+        enum = EnumType(name.value, self.__pkg, enum_scope=scope)
+        for comment in comments:
+            enum.add_comment(comment_text(comment))
+        while True:
+            token = self.__next_token(name)
+            if token.type == TokenType.token_comment or token.value == ';':
+                continue
+            if token.value == '}':
+                break
+            if token.value == 'option':
+                # 枚举选项不影响编码，跳过
+                while self.__next_token(token).value != ';':
+                    pass
+                continue
+            if token.type != TokenType.token_identifier:
+                raise FormatError('invalid syntax. line:%d, column:%d, unexpected %s'
+                                  % (token.line, token.column, token.value))
+            self.__expect(token, TokenType.token_punctuation, '=')
+            number = self.__expect(token, TokenType.token_number)
+            try:
+                value = int(number.value, 0)
+            except ValueError:
+                raise FormatError('invalid syntax. line:%d, Enum value format invalid' % number.line)
+            self.__expect(token, TokenType.token_punctuation, ';')
+            enum.add_value(token.value, value)
+        return enum, token
+
+    def __parse_message_element(self, token):
+        """
+        解析消息字段，格式为: property type name = sequence;
+        :param token: 字段的首个词法单元
+        :return: 字段及字段结束所在的行号
+        """
+        if token.value not in FieldProperty:
+            raise FormatError('invalid syntax. line:%d, Message element format invalid' % token.line)
+        field_type = self.__expect(token, TokenType.token_identifier)
+        # 非标量类型为消息或枚举的名称，先按消息处理，由__link解析实际类型
+        type_name = None if field_type.value in FieldTypes else field_type.value
+        field_name = self.__expect(token, TokenType.token_identifier)
+        self.__expect(token, TokenType.token_punctuation, '=')
+        field_sequence = self.__expect(token, TokenType.token_number)
+        if not field_sequence.value.isdigit():
+            raise FormatError('invalid syntax. line:%d, Message element format invalid' % token.line)
+        end = self.__expect(token, TokenType.token_punctuation, ';')
+        field = Field(field_name.value, 'message' if type_name else field_type.value, token.value,
+                      int(field_sequence.value), "", "", field_type_name=type_name)
+        return field, end.line
+
+
+def _closure(names, edges):
+    """
+    返回从names出发沿edges可以到达的全部名称，包括names本身
+    :param names    名称集合
+    :param edges    名称 -> 相邻名称的可迭代对象
+    :return: set
+    """
+    reached = set(names)
+    pending = list(reached)
+    while pending:
+        for name in edges.get(pending.pop(), ()):
+            if name not in reached:
+                reached.add(name)
+                pending.append(name)
+    return reached
 
-    def __rt_comment(self, line):
-        self.line_cache.append(line.words[0])
 
-    def __rt_undefine(self, line):
-        raise UndefineError('undefine line status: %s' % line)
+def _contiguous(spans, start):
+    """
+    检查消息区域是否从start开始首尾相接，且区域内没有package/import语句
+    :param spans    MessageSpan列表
+    :param start    第一个区域应有的开始位置
+    :return:
+    """
+    for span in spans:
+        if span.start != start or span.header:
+            return False
+        start = span.end
+    return True
 
-    def __rt_empty(self, line):
-        # do nothing
-        return
 
-    def __rt_other(self, line):
-        raise UndefineError('unsupport format, line:%s' % line)
+def _common_prefix(a, b):
+    """
+    返回两个字符串公共前缀的长度，以切片比较做二分查找
+    """
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix(a, b, limit):
+    """
+    返回两个字符串公共后缀的长度，不超过limit
+    """
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
 
-    def __rt_eof(self, line):
-        print('end of file')
 
-    def is_comment(self, line):
-        return "//" == line[0:2]
+def diff_messages(old_messages, new_messages, old_digests=None, new_digests=None):
+    """
+    比较两次解析结果
+    :param old_messages     消息名到消息的字典
+    :param new_messages     消息名到消息的字典
+    :param old_digests      消息名到消息区域哈希的字典，哈希及pkg相同的消息视为未变化
+    :param new_digests:
+    :return: 格式见FileFsm.reparse
+    """
+    old_digests = old_digests or {}
+    new_digests = new_digests or {}
+    diff = {
+        'added': [name for name in new_messages if name not in old_messages],
+        'removed': [name for name in old_messages if name not in new_messages],
+        'changed': dict()
+    }
+    for name, message in new_messages.items():
+        old = old_messages.get(name)
+        if old is None or old is message:
+            continue
+        # 消息区域不包含package语句，pkg变化时即使区域哈希相同也需要比较
+        if name in old_digests and old_digests.get(name) == new_digests.get(name) and \
+                old.package() == message.package():
+            continue
+        old_fields = dict((field.name, field.to_dict()) for field in old.fields())
+        new_fields = dict((field.name, field.to_dict()) for field in message.fields())
+        changed = {
+            'added_fields': [n for n in new_fields if n not in old_fields],
+            'removed_fields': [n for n in old_fields if n not in new_fields],
+            'changed_fields': [n for n in new_fields if n in old_fields and new_fields[n] != old_fields[n]]
+        }
+        # 嵌套消息及枚举的变化不体现在字段差异中，比较完整的字典
+        if any(changed.values()) or old.package() != message.package() or old.to_dict() != message.to_dict():
+            diff['changed'][name] = changed
+    return diff
@@ -0,0 +1,180 @@
+#! /usr/bin/env python3
+# coding=utf-8
+
+import os
+import sys
+import mmap
+import struct
+import tempfile
+from array import array
+from my_exception import ParamError, FormatError
+from pb_parser import Message
+from pb_decoder import decode_varint
+
+
+# 索引文件后缀
+INDEX_SUFFIX = '.idx'
+# 索引文件头：魔数、数据文件大小、数据文件mtime、记录数
+INDEX_HEADER = struct.Struct('<8sQQQ')
+INDEX_MAGIC = b'PB2JIDX1'
+
+
+class RecordReader:
+    """
+    以varint长度为前缀的PB记录文件的随机访问读取器
+    文件通过mmap映射，记录以memoryview切片直接交给protobuf解析，不复制为中间bytes
+    首次打开时扫描一遍建立记录偏移索引，并保存在数据文件旁，下次打开时直接加载
+    打开后只读，读取可在多个线程中同时进行；close()不能与读取同时调用
+    """
+
+    def __init__(self, path, message, persist_index=True):
+        """
+        :param path             数据文件路径
+        :param message          Message实例，如FileFsm.message()的返回值
+        :param persist_index    是否读写索引文件
+        """
+        if not isinstance(message, Message):
+            raise ParamError('Invalid Parameter message:[%s]' % str(message))
+        self.__path = path
+        self.__message_class = message.message_class_entry().message_class
+        self.__mmap = None
+        self.__view = memoryview(b'')
+        # 每条记录内容的起始偏移及长度
+        self.__offsets = array('Q')
+        self.__lengths = array('Q')
+
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_size > 0:
+                self.__mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.__view = memoryview(self.__mmap)
+        index_path = path + INDEX_SUFFIX
+        if not (persist_index and self.__load_index(index_path, st)):
+            self.__build_index()
+            if persist_index:
+                self.__save_index(index_path, st)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.__offsets)
+
+    def __getitem__(self, index):
+        """
+        reader[i]返回第i条记录解析后的PB消息对象，reader[i:j]返回消息对象列表
+        """
+        if isinstance(index, slice):
+            return [self.__parse(i) for i in range(*index.indices(len(self.__offsets)))]
+        if index < 0:
+            index += len(self.__offsets)
+        if not 0 <= index < len(self.__offsets):
+            raise IndexError('record index out of range')
+        return self.__parse(index)
+
+    def __iter__(self):
+        for i in range(len(self.__offsets)):
+            yield self.__parse(i)
+
+    def raw(self, index):
+        """
+        返回第i条记录的二进制内容，为mmap上的memoryview，不复制数据
+        :param index:
+        :return:
+        """
+        start = self.__offsets[index]
+        return self.__view[start:start + self.__lengths[index]]
+
+    def close(self):
+        """
+        释放mmap；仍有raw()返回的memoryview未释放时，由垃圾回收负责关闭
+        :return:
+        """
+        self.__view.release()
+        if self.__mmap is not None:
+            try:
+                self.__mmap.close()
+            except BufferError:
+                pass
+            self.__mmap = None
+
+    def __parse(self, index):
+        msg = self.__message_class()
+        with self.raw(index) as data:
+            msg.ParseFromString(data)
+        return msg
+
+    def __build_index(self):
+        """
+        扫描文件建立记录偏移索引
+        """
+        view = self.__view
+        size = len(view)
+        offsets = self.__offsets
+        lengths = self.__lengths
+        pos = 0
+        while pos < size:
+            header = decode_varint(view, pos)
+            if header is None:
+                raise FormatError('%s: truncated length prefix at offset %d' % (self.__path, pos))
+            length, start = header
+            if start + length > size:
+                raise FormatError('%s: truncated record at offset %d' % (self.__path, pos))
+            offsets.append(start)
+            lengths.append(length)
+            pos = start + length
+
+    def __load_index(self, index_path, st):
+        """
+        加载索引文件，索引不存在或与数据文件不匹配时返回False
+        """
+        try:
+            with open(index_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return False
+        if len(data) < INDEX_HEADER.size:
+            return False
+        magic, size, mtime, count = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or size != st.st_size or mtime != st.st_mtime_ns \
+                or len(data) != INDEX_HEADER.size + count * 16:
+            return False
+        offsets = array('Q')
+        lengths = array('Q')
+        body = INDEX_HEADER.size
+        offsets.frombytes(data[body:body + count * 8])
+        lengths.frombytes(data[body + count * 8:])
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+            lengths.byteswap()
+        self.__offsets = offsets
+        self.__lengths = lengths
+        return True
+
+    def __save_index(self, index_path, st):
+        """
+        保存索引文件，先写临时文件再原子重命名；写入失败时忽略
+        """
+        offsets = array('Q', self.__offsets)
+        lengths = array('Q', self.__lengths)
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+            lengths.byteswap()
+        try:
+            fd, temp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(os.path.abspath(index_path)))
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, st.st_size, st.st_mtime_ns, len(offsets)))
+                offsets.tofile(f)
+                lengths.tofile(f)
+            os.replace(temp_path, index_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
@@ -0,0 +1,367 @@
+#! /usr/bin/env python3
+# coding=utf-8
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from my_exception import ParamError, FormatError, UndefineError, ParseError
+from pb_parser import FileFsm, DescriptorSet, build_file_proto, iter_types, resolve_types
+
+
+class SchemaRegistry:
+    """
+    多个proto文件的消息注册表
+    按全限定名(pkg.消息名)及文件路径建立索引；import语句按include_paths查找，每个文件只解析一次
+    字段引用的消息/枚举在文件及其直接或间接import的文件中查找，每个文件与其依赖的文件按依赖顺序组成一个DescriptorSet
+    load()/add()/link()不能与其他方法同时调用；加载完成后的查找可在多个线程中同时进行
+    """
+
+    def __init__(self, include_paths=None):
+        """
+        :param include_paths    查找import文件的目录列表，未找到时再查找导入方文件所在目录
+        """
+        self.__include_paths = [os.path.abspath(p) for p in (include_paths or [])]
+        # 全限定名 -> 消息，包括嵌套消息
+        self.__messages = dict()
+        # 全限定名 -> 枚举，包括嵌套枚举
+        self.__enums = dict()
+        # 消息及枚举的全限定名 -> 文件绝对路径
+        self.__message_files = dict()
+        # 文件绝对路径 -> (pkg, 消息列表, 被导入文件的绝对路径列表, 枚举列表)
+        self.__files = dict()
+        # 文件绝对路径 -> FileDescriptorProto，文件名为绝对路径，只包含已完成类型解析的文件
+        self.__file_protos = dict()
+
+    def __len__(self):
+        return len(self.__messages)
+
+    def __contains__(self, full_name):
+        return full_name in self.__messages
+
+    def add(self, path, pkg, messages, imports=None, enums=None):
+        """
+        注册一个文件中的消息及枚举，同一全限定名不允许重复定义
+        注册后还需调用link()解析字段引用的类型
+        :param path         proto文件路径
+        :param pkg          文件的pkg
+        :param messages     消息列表
+        :param imports      被导入文件的绝对路径列表
+        :param enums        顶层枚举列表
+        :return:
+        """
+        path = os.path.abspath(path)
+        if path in self.__files:
+            raise ParamError('file already registered: %s' % path)
+        types = list(iter_types(messages, enums or []))
+        for full_name, kind, item in types:
+            if full_name in self.__message_files:
+                raise FormatError('%s: duplicate %s %s, already defined in %s'
+                                  % (path, kind, full_name, self.__message_files[full_name]))
+        for full_name, kind, item in types:
+            if kind == 'message':
+                self.__messages[full_name] = item
+            else:
+                self.__enums[full_name] = item
+            self.__message_files[full_name] = path
+        self.__files[path] = (pkg, list(messages), list(imports or []), list(enums or []))
+
+    def add_file_fsm(self, path, file_fsm):
+        """
+        注册已解析的FileFsm并解析字段引用的类型，其import的文件需事先注册
+        :param path:
+        :param file_fsm:
+        :return:
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        imports = [self.resolve_import(name, directory) for name in file_fsm.imports()]
+        self.add(path, file_fsm.package(), file_fsm.messages(), [p for p in imports if p is not None], file_fsm.enums())
+        errors = self.link([path])
+        if errors:
+            raise FormatError(errors[os.path.abspath(path)])
+
+    def link(self, paths):
+        """
+        按依赖顺序解析文件中字段引用的类型，并为引用了其他类型的消息关联DescriptorSet
+        每个文件只构造一次FileDescriptorProto，依赖相同的消息共用同一个描述符池
+        :param paths    已注册的文件路径列表
+        :return: 文件绝对路径到错误信息的字典
+        """
+        errors = dict()
+        for path in self.__link_order(_unique_paths(paths), errors):
+            if path in self.__file_protos:
+                continue
+            pkg, messages, imports, enums = self.__files[path]
+            closure = self.__closure(path)
+            failed = [p for p in closure if p != path and p not in self.__file_protos]
+            if failed:
+                errors[path] = 'import %s failed' % failed[0]
+                continue
+            visible = set(closure)
+            lookup = lambda full_name: (('message' if full_name in self.__messages else 'enum')
+                                        if self.__message_files.get(full_name) in visible else None)
+            unresolved = resolve_types(messages, lookup)
+            if unresolved:
+                scope, field_name, type_name = unresolved[0]
+                errors[path] = 'unknown type %s for field %s.%s' % (type_name, scope, field_name)
+                continue
+            self.__file_protos[path] = build_file_proto(path, pkg, imports, messages, enums)
+            descriptor_set = None
+            for full_name, kind, item in iter_types(messages):
+                if kind == 'message' and item.references():
+                    if descriptor_set is None:
+                        descriptor_set = DescriptorSet([self.__file_protos[p] for p in closure])
+                    item.set_descriptor_set(descriptor_set)
+        return errors
+
+    def __link_order(self, paths, errors):
+        """
+        返回paths及其依赖文件的依赖顺序，存在循环import的文件记入errors
+        """
+        order = []
+        seen = set()
+        for path in paths:
+            try:
+                for p in self.__closure(path):
+                    if p not in seen:
+                        seen.add(p)
+                        order.append(p)
+            except FormatError as e:
+                errors[path] = str(e)
+        return order
+
+    def __closure(self, path):
+        """
+        返回文件及其直接或间接import的文件，被导入的文件在前
+        """
+        order = []
+        done = set()
+        visiting = [path]
+        stack = [(path, iter(self.__files[path][2]))]
+        while stack:
+            current, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                visiting.pop()
+                done.add(current)
+                order.append(current)
+            elif child in visiting:
+                raise FormatError('%s: import cycle %s' % (path, ' -> '.join(visiting[visiting.index(child):] + [child])))
+            elif child not in done:
+                if child not in self.__files:
+                    raise FormatError('%s: import %s not registered' % (current, child))
+                visiting.append(child)
+                stack.append((child, iter(self.__files[child][2])))
+        return order
+
+    def load(self, paths, workers=1, cache_dir=None):
+        """
+        解析并注册proto文件及其直接或间接import的全部文件，已注册的文件不再解析
+        :param paths        proto文件路径列表
+        :param workers      进程数，为1时在当前进程中解析
+        :param cache_dir    磁盘缓存目录，见pb_schema_cache.SchemaCache
+        :return: 传入文件的绝对路径列表；任一文件解析失败时抛出ParseError，value为文件路径到错误信息的字典
+        """
+        requested = _unique_paths(paths)
+        # 按层解析：先解析传入的文件，再解析新发现的import文件，注册顺序与工作进程完成的先后无关
+        pending = [path for path in requested if path not in self.__files]
+        seen = set(pending)
+        errors = dict()
+        while pending:
+            results = _parse_files(pending, workers, cache_dir)
+            next_pending = []
+            for path, (pkg, messages, enums, import_names, error) in zip(pending, results):
+                if error is not None:
+                    errors[path] = error
+                    continue
+                imports = []
+                for name in import_names:
+                    import_path = self.resolve_import(name, os.path.dirname(path))
+                    if import_path is None:
+                        errors[path] = 'import "%s" not found' % name
+                        break
+                    imports.append(import_path)
+                    if import_path not in seen and import_path not in self.__files:
+                        seen.add(import_path)
+                        next_pending.append(import_path)
+                if path in errors:
+                    continue
+                try:
+                    self.add(path, pkg, messages, imports, enums)
+                except FormatError as e:
+                    errors[path] = str(e)
+            pending = next_pending
+        # 全部文件注册后再解析类型，被导入的文件先于导入方处理
+        linkable = [path for path in requested if path in self.__files and path not in errors]
+        for path, error in self.link(linkable).items():
+            errors.setdefault(path, error)
+        if errors:
+            raise ParseError(errors)
+        return requested
+
+    def resolve_import(self, name, directory):
+        """
+        查找import的文件
+        :param name         import语句中的文件名
+        :param directory    导入方文件所在目录
+        :return: 文件绝对路径，未找到时返回None
+        """
+        if os.path.isabs(name):
+            return name if os.path.isfile(name) else None
+        for include_path in self.__include_paths + [directory]:
+            path = os.path.join(include_path, name)
+            if os.path.isfile(path):
+                return os.path.abspath(path)
+        return None
+
+    def message(self, full_name):
+        """
+        按全限定名查找消息
+        :param full_name:
+        :return:
+        """
+        return self.__messages[full_name]
+
+    def message_to_json(self, full_name):
+        """
+        获取指定消息的json描述
+        :param full_name:
+        :return:
+        """
+        return self.__messages[full_name].to_json()
+
+    def message_file(self, full_name):
+        """
+        返回定义消息的文件绝对路径
+        :param full_name:
+        :return:
+        """
+        return self.__message_files[full_name]
+
+    def messages(self):
+        """
+        返回全部消息(包括嵌套消息)，按注册顺序排列
+        :return:
+        """
+        return list(self.__messages.values())
+
+    def enum(self, full_name):
+        """
+        按全限定名查找枚举
+        :param full_name:
+        :return:
+        """
+        return self.__enums[full_name]
+
+    def file_messages(self, path):
+        """
+        返回指定文件中的消息列表
+        :param path:
+        :return:
+        """
+        return self.__files[os.path.abspath(path)][1]
+
+    def file_package(self, path):
+        """
+        返回指定文件的pkg
+        :param path:
+        :return:
+        """
+        return self.__files[os.path.abspath(path)][0]
+
+    def file_imports(self, path):
+        """
+        返回指定文件import的文件绝对路径列表
+        :param path:
+        :return:
+        """
+        return self.__files[os.path.abspath(path)][2]
+
+    def file_enums(self, path):
+        """
+        返回指定文件中的顶层枚举列表
+        :param path:
+        :return:
+        """
+        return self.__files[os.path.abspath(path)][3]
+
+    def file_proto(self, path):
+        """
+        返回指定文件的FileDescriptorProto，文件名及dependency为绝对路径；类型解析失败的文件抛出KeyError
+        :param path:
+        :return:
+        """
+        return self.__file_protos[os.path.abspath(path)]
+
+    def files(self):
+        """
+        返回已注册的文件绝对路径，按注册顺序排列
+        :return:
+        """
+        return list(self.__files.keys())
+
+
+def full_message_name(pkg, message_name):
+    """
+    返回消息的全限定名
+    :param pkg:
+    :param message_name:
+    :return:
+    """
+    return '%s.%s' % (pkg, message_name) if pkg else message_name
+
+
+def _unique_paths(paths):
+    """
+    转换为绝对路径并去除重复，保持原有顺序
+    """
+    unique_paths = []
+    seen = set()
+    for path in paths:
+        path = os.path.abspath(path)
+        if path not in seen:
+            seen.add(path)
+            unique_paths.append(path)
+    return unique_paths
+
+
+def _parse_file(path, cache_dir):
+    """
+    在工作进程中解析一个文件
+    :return: (pkg, 消息列表, 枚举列表, import列表, 错误信息)
+    """
+    try:
+        schema_cache = None
+        if cache_dir is not None:
+            from pb_schema_cache import SchemaCache
+            schema_cache = SchemaCache(cache_dir)
+        file_fsm = FileFsm(path, schema_cache=schema_cache)
+        file_fsm.parse()
+        return file_fsm.package(), file_fsm.messages(), file_fsm.enums(), file_fsm.imports(), None
+    except (ParamError, FormatError, UndefineError, OSError, ValueError) as e:
+        return None, None, None, None, str(e)
+
+
+def _parse_files(paths, workers, cache_dir):
+    """
+    解析多个文件，结果与paths的顺序一致
+    """
+    cache_dirs = [cache_dir] * len(paths)
+    if workers == 1 or len(paths) <= 1:
+        return list(map(_parse_file, paths, cache_dirs))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_parse_file, paths, cache_dirs, chunksize=4))
+
+
+def parse_many(paths, workers=None, cache_dir=None, include_paths=None):
+    """
+    使用进程池并行解析多个proto文件及其import的文件，合并为一个注册表
+    结果按paths的顺序合并，与工作进程完成的先后无关
+    :param paths            proto文件路径列表
+    :param workers          进程数，默认为CPU核数；为1时在当前进程中解析
+    :param cache_dir        磁盘缓存目录，见pb_schema_cache.SchemaCache
+    :param include_paths    查找import文件的目录列表
+    :return: SchemaRegistry；任一文件解析失败时抛出ParseError，value为文件路径到错误信息的字典
+    """
+    registry = SchemaRegistry(include_paths)
+    registry.load(paths, workers, cache_dir)
+    return registry
@@ -0,0 +1,243 @@
+#! /usr/bin/env python3
+# coding=utf-8
+
+import os
+import sys
+import time
+import json
+import hashlib
+import argparse
+import tempfile
+from my_exception import ParamError
+from pb_parser import Field, Message, EnumType
+from google.protobuf.descriptor_pb2 import FileDescriptorProto
+from google.protobuf.message import DecodeError
+
+
+# 缓存格式版本号，缓存内容结构变化时需要修改
+CACHE_VERSION = 4
+# 缓存文件后缀
+CACHE_SUFFIX = '.pbc'
+# 临时文件前缀
+TEMP_PREFIX = '.tmp-'
+# 残留临时文件的最长保留时间，单位秒
+TEMP_EXPIRE = 3600
+
+
+class SchemaCache:
+    """
+    proto文件解析结果的磁盘缓存
+    以文件绝对路径确定缓存文件，缓存内容记录文件的mtime、大小及内容哈希，任一不匹配则缓存失效
+    写入时先写临时文件再原子重命名，多个进程可以同时使用同一个缓存目录
+    缓存文件为一行json描述加上序列化的FileDescriptorProto，不使用pickle，缓存目录被他人写入时也不会执行其中的代码
+    """
+
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir    缓存目录，不存在时自动创建
+        """
+        if not cache_dir:
+            raise ParamError('Invalid Parameter cache_dir:[%s]' % str(cache_dir))
+        self.__cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, path):
+        """
+        返回proto文件对应的缓存文件路径
+        :param path:
+        :return:
+        """
+        key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        return os.path.join(self.__cache_dir, key + CACHE_SUFFIX)
+
+    def load(self, path):
+        """
+        加载proto文件的缓存
+        :param path:
+        :return: (pkg, 消息列表, 枚举列表, import列表, FileDescriptorProto)，缓存不存在或已失效时返回None
+        """
+        blob = self.__read_blob(self.entry_path(path))
+        if blob is None or blob.get('source') != os.path.abspath(path) or not self.__is_fresh(blob):
+            return None
+        try:
+            pkg = blob['pkg']
+            messages = [_load_message(item, pkg, '') for item in blob['messages']]
+            enums = [_load_enum(item, pkg, '') for item in blob['enums']]
+            return pkg, messages, enums, list(blob['imports']), FileDescriptorProto.FromString(blob['file_proto'])
+        except (KeyError, ValueError, TypeError, DecodeError):
+            # 缓存内容与格式不符
+            return None
+
+    def store(self, path, data, pkg, messages, enums, imports, file_proto, st=None):
+        """
+        保存proto文件的解析结果，写入失败时忽略
+        :param path         proto文件路径
+        :param data         解析时读取的文件内容
+        :param pkg:
+        :param messages     消息列表
+        :param enums        顶层枚举列表
+        :param imports      import列表
+        :param file_proto   FileDescriptorProto
+        :param st           读取文件内容之前对同一文件句柄os.fstat()的结果；为None时不记录mtime，加载时总是比较内容哈希
+        :return:
+        """
+        if st is not None and st.st_size != len(data):
+            # 读取过程中文件被修改，mtime与内容不对应
+            return
+        blob = {
+            'version': CACHE_VERSION,
+            'source': os.path.abspath(path),
+            'mtime': None if st is None else st.st_mtime_ns,
+            'size': len(data),
+            'hash': hashlib.sha1(data).hexdigest(),
+            'pkg': pkg,
+            'messages': [_dump_message(message) for message in messages],
+            'enums': [_dump_enum(enum) for enum in enums],
+            'imports': list(imports)
+        }
+        fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self.__cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # json描述中不含换行符，以第一个换行符分隔json描述与FileDescriptorProto
+                f.write(json.dumps(blob, ensure_ascii=True).encode('ascii'))
+                f.write(b'\n')
+                f.write(file_proto.SerializeToString())
+            os.replace(temp_path, self.entry_path(path))
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def prune(self):
+        """
+        删除失效的缓存：源文件已删除或已修改、缓存版本不匹配、缓存文件损坏，以及残留的临时文件
+        :return: 删除的文件数
+        """
+        count = 0
+        now = time.time()
+        for name in os.listdir(self.__cache_dir):
+            entry_path = os.path.join(self.__cache_dir, name)
+            if name.startswith(TEMP_PREFIX):
+                # 临时文件可能正由其他进程写入，只删除过期的
+                stale = self.__mtime(entry_path) < now - TEMP_EXPIRE
+            elif name.endswith(CACHE_SUFFIX):
+                blob = self.__read_blob(entry_path)
+                stale = blob is None or not self.__is_fresh(blob)
+            else:
+                continue
+            if stale and self.__remove(entry_path):
+                count += 1
+        return count
+
+    def clear(self):
+        """
+        删除全部缓存
+        :return: 删除的文件数
+        """
+        count = 0
+        for name in os.listdir(self.__cache_dir):
+            if name.endswith(CACHE_SUFFIX) and self.__remove(os.path.join(self.__cache_dir, name)):
+                count += 1
+        return count
+
+    @staticmethod
+    def __read_blob(entry_path):
+        """
+        读取缓存文件，文件不存在、损坏或版本不匹配时返回None
+        返回json描述的字典，FileDescriptorProto的序列化结果放在'file_proto'中
+        """
+        try:
+            with open(entry_path, 'rb') as f:
+                header = f.readline()
+                file_proto = f.read()
+            blob = json.loads(header)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(blob, dict) or blob.get('version') != CACHE_VERSION or not header.endswith(b'\n'):
+            return None
+        blob['file_proto'] = file_proto
+        return blob
+
+    @staticmethod
+    def __is_fresh(blob):
+        """
+        检查缓存对应的源文件是否未被修改
+        mtime及大小一致时直接认为有效，否则比较文件内容哈希
+        """
+        try:
+            st = os.stat(blob['source'])
+            if st.st_mtime_ns == blob['mtime'] and st.st_size == blob['size']:
+                return True
+            if st.st_size != blob['size']:
+                return False
+            with open(blob['source'], 'rb') as f:
+                return hashlib.sha1(f.read()).hexdigest() == blob['hash']
+        except (OSError, KeyError, TypeError, ValueError):
+            # 源文件不可读，或缓存描述缺少字段、类型不符
+            return False
+
+    @staticmethod
+    def __mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return time.time()
+
+    @staticmethod
+    def __remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+def _dump_enum(enum):
+    return enum.name(), enum.comment(), list(enum.values())
+
+
+def _load_enum(item, pkg, scope):
+    name, comment, values = item
+    # json中的元组读回为列表
+    return EnumType(name, pkg, comment, [tuple(value) for value in values], scope)
+
+
+def _dump_message(message):
+    """
+    将消息转换为可写入json的元组，嵌套消息及枚举一并转换
+    """
+    fields = [(f.name, f.type, f.property, f.sequence, f.default, f.comment, f.type_name) for f in message.fields()]
+    return (message.name(), message.comment(), fields,
+            [_dump_message(nested) for nested in message.nested_messages()],
+            [_dump_enum(enum) for enum in message.enums()])
+
+
+def _load_message(item, pkg, scope):
+    name, comment, fields, nested_items, enum_items = item
+    message = Message(message_name=name, message_pkg=pkg, message_comment=comment, message_fields=[],
+                      message_scope=scope)
+    for field_name, field_type, field_property, sequence, default, field_comment, type_name in fields:
+        message.add_field(Field(field_name, field_type, field_property, sequence, default, field_comment,
+                                field_type_name=type_name))
+    nested_scope = '%s.%s' % (scope, name) if scope else name
+    for nested_item in nested_items:
+        message.add_nested_message(_load_message(nested_item, pkg, nested_scope))
+    for enum_item in enum_items:
+        message.add_enum(_load_enum(enum_item, pkg, nested_scope))
+    return message
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='manage pb2json schema cache directory')
+    parser.add_argument('command', choices=['prune', 'clear'], help='prune: remove stale entries; clear: remove all entries')
+    parser.add_argument('cache_dir', help='schema cache directory')
+    args = parser.parse_args(argv)
+    cache = SchemaCache(args.cache_dir)
+    count = cache.prune() if args.command == 'prune' else cache.clear()
+    print('%d cache file(s) removed' % count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,537 @@
+#! /usr/bin/env python3
+# coding=utf-8
+"""
+基于asyncio的编解码服务
+
+请求及响应均为以varint长度为前缀的帧:
+    请求: 操作码(1字节) + varint(消息名长度) + 消息全限定名 + 数据
+    响应: 状态(1字节) + 数据，状态为STATUS_ERROR时数据为utf-8编码的错误信息
+OP_ENCODE的数据为一条json记录，返回PB二进制数据；OP_DECODE的数据为PB二进制数据，返回json记录
+同一连接上可以连续发送多个请求而不等待响应，响应按请求顺序返回
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pb_metrics
+from my_exception import ParamError, FormatError, UndefineError, ParseError
+from pb_registry import SchemaRegistry
+from pb_encoder import MessageEncoder, encode_varint
+from pb_decoder import MessageDecoder, decode_varint, MAX_RECORD_SIZE
+
+
+OP_ENCODE = 1
+OP_DECODE = 2
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+# 单个连接上已读取但尚未返回响应的请求数上限
+MAX_PIPELINE = 64
+# 一次提交到进程池的请求数上限
+MAX_BATCH = 256
+# 写出统计文件的间隔，单位秒
+METRICS_INTERVAL = 15
+
+# 工作进程内的注册表及编解码器，由_init_worker初始化
+_registry = None
+_codecs = dict()
+
+
+def _init_worker(paths, include_paths):
+    """
+    初始化工作进程，每个进程只解析一次proto文件
+    """
+    global _registry
+    registry = SchemaRegistry(include_paths)
+    registry.load(paths)
+    _registry = registry
+    _codecs.clear()
+
+
+def _convert(op, name, payload):
+    """
+    在工作进程中执行一次转换，每种消息的编解码器只构造一次
+    :return: 转换结果
+    """
+    codec = _codecs.get(name)
+    if codec is None:
+        if name not in _registry:
+            raise ParamError('unknown message %s' % name)
+        message = _registry.message(name)
+        codec = _codecs[name] = (MessageEncoder(message), MessageDecoder(message))
+    if op == OP_ENCODE:
+        return codec[0].encode(payload)
+    if op == OP_DECODE:
+        return json.dumps(codec[1].decode(payload), ensure_ascii=False).encode('utf-8')
+    raise ParamError('unknown operation %d' % op)
+
+
+def _convert_batch(requests):
+    """
+    在工作进程中执行一批转换，单个请求的错误不影响其他请求
+    :param requests     (操作码, 消息全限定名, 数据)列表
+    :return: (状态, 数据)列表
+    """
+    results = []
+    for op, name, payload in requests:
+        try:
+            results.append((STATUS_OK, _convert(op, name, payload)))
+        except Exception as e:
+            results.append(_error_response(e))
+    return results
+
+
+def pack_frame(body):
+    """
+    为帧内容加上varint长度前缀
+    :param body:
+    :return:
+    """
+    return encode_varint(len(body)) + body
+
+
+def pack_request(op, name, payload):
+    """
+    构造请求帧
+    :param op       OP_ENCODE或OP_DECODE
+    :param name     消息全限定名
+    :param payload  json记录或PB二进制数据
+    :return:
+    """
+    name = name.encode('utf-8')
+    return pack_frame(bytes((op,)) + encode_varint(len(name)) + name + payload)
+
+
+def parse_request(body):
+    """
+    解析请求帧的内容
+    :param body:
+    :return: (操作码, 消息全限定名, 数据)
+    """
+    header = decode_varint(body, 1) if len(body) > 1 else None
+    if header is None or header[1] + header[0] > len(body):
+        raise FormatError('invalid request frame')
+    length, pos = header
+    return body[0], bytes(body[pos:pos + length]).decode('utf-8'), bytes(body[pos + length:])
+
+
+async def read_frame(reader, max_frame_size=MAX_RECORD_SIZE):
+    """
+    从连接中读取一帧
+    :param reader           asyncio.StreamReader
+    :param max_frame_size   单帧的最大长度
+    :return: 帧内容，连接在帧边界处关闭时返回None
+    """
+    length = 0
+    shift = 0
+    while True:
+        byte = await reader.read(1)
+        if not byte:
+            if shift == 0:
+                return None
+            raise FormatError('truncated frame header')
+        length |= (byte[0] & 0x7f) << shift
+        if byte[0] < 0x80:
+            break
+        shift += 7
+        if shift >= 64:
+            raise FormatError('invalid varint, too many bytes')
+    if length > max_frame_size:
+        raise FormatError('frame length %d exceeds limit %d' % (length, max_frame_size))
+    try:
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise FormatError('truncated frame')
+
+
+def _error_response(error):
+    """
+    生成错误响应
+    :return: (状态, 错误信息)
+    """
+    message = error.value if isinstance(error, (ParamError, FormatError, UndefineError)) else str(error)
+    return STATUS_ERROR, str(message).encode('utf-8')
+
+
+class ConversionServer:
+    """
+    编解码服务
+    转换在有上限的进程池中执行，同一轮事件循环中收到的请求合并为一批提交，减少进程间通信的次数；
+    每个连接已读取未响应的请求数达到max_pipeline时暂停读取该连接，全部连接提交到进程池的批次数不超过max_pending，
+    客户端发送过快时由TCP流控向客户端施加背压
+    """
+
+    def __init__(self, paths, include_paths=None, workers=None, max_pipeline=MAX_PIPELINE, max_pending=None,
+                 max_frame_size=MAX_RECORD_SIZE):
+        """
+        :param paths            proto文件路径列表，其import的文件一并加载
+        :param include_paths    查找import文件的目录列表
+        :param workers          进程数，默认为CPU核数；为0时在当前进程的单个线程中转换
+        :param max_pipeline     单个连接上已读取但尚未响应的请求数上限
+        :param max_pending      提交到进程池的批次数上限，默认为进程数的2倍
+        :param max_frame_size   单帧的最大长度
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 0 or max_pipeline < 1 or (max_pending is not None and max_pending < 1):
+            raise ParamError('Invalid Parameter workers/max_pipeline/max_pending')
+        self.__initargs = (list(paths), list(include_paths or []))
+        # 在当前进程中先加载一次，尽早报告proto文件错误，也用于检查请求中的消息名
+        _init_worker(*self.__initargs)
+        self.__registry = _registry
+        self.__workers = workers
+        self.__max_pipeline = max_pipeline
+        self.__max_pending = max_pending or max(workers, 1) * 2
+        self.__max_frame_size = max_frame_size
+        self.__executor = None
+        self.__pending = None
+        self.__servers = []
+        # 正在处理的连接
+        self.__connections = set()
+        # 等待提交的请求及对应的future
+        self.__batch = []
+        self.__batch_futures = []
+
+    def registry(self):
+        """
+        返回服务加载的注册表
+        :return:
+        """
+        return self.__registry
+
+    def __ensure_executor(self):
+        if self.__executor is None:
+            if self.__workers == 0:
+                self.__executor = ThreadPoolExecutor(max_workers=1)
+            else:
+                self.__executor = ProcessPoolExecutor(max_workers=self.__workers, initializer=_init_worker,
+                                                      initargs=self.__initargs)
+            self.__pending = asyncio.Semaphore(self.__max_pending)
+
+    async def start_tcp(self, host, port):
+        """
+        监听TCP端口
+        :param host:
+        :param port     为0时由系统分配
+        :return: 实际监听的(host, port)
+        """
+        self.__ensure_executor()
+        server = await asyncio.start_server(self.__handle, host, port)
+        self.__servers.append(server)
+        return server.sockets[0].getsockname()[:2]
+
+    async def start_unix(self, path):
+        """
+        监听Unix socket，已存在的socket文件会被删除
+        :param path:
+        :return:
+        """
+        self.__ensure_executor()
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.__handle, path)
+        self.__servers.append(server)
+        return path
+
+    async def serve_forever(self):
+        """
+        持续提供服务，直到任务被取消
+        :return:
+        """
+        await asyncio.gather(*(server.serve_forever() for server in self.__servers))
+
+    async def close(self):
+        """
+        停止监听，断开全部连接并关闭进程池
+        :return:
+        """
+        for server in self.__servers:
+            server.close()
+        connections = list(self.__connections)
+        for task in connections:
+            task.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+        for server in self.__servers:
+            await server.wait_closed()
+        self.__servers = []
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+            self.__executor = None
+
+    async def __handle(self, reader, writer):
+        """
+        处理一个连接：读取请求并提交转换，由另一个任务按顺序写回响应
+        """
+        task = asyncio.current_task()
+        self.__connections.add(task)
+        responses = asyncio.Queue(self.__max_pipeline)
+        write_task = asyncio.ensure_future(self.__write_responses(responses, writer))
+        # 写响应失败时读取方可能正阻塞在已满的队列上，直接结束整个连接
+        write_task.add_done_callback(lambda t: t.cancelled() or t.exception() is None or task.cancel())
+        try:
+            while True:
+                try:
+                    body = await read_frame(reader, self.__max_frame_size)
+                except FormatError as e:
+                    # 帧边界已无法确定，返回错误后关闭连接
+                    future = asyncio.get_running_loop().create_future()
+                    future.set_result(_error_response(e))
+                    await responses.put(future)
+                    break
+                if body is None:
+                    break
+                # 队列已满时在此等待，不再读取该连接的数据
+                await responses.put(asyncio.ensure_future(self.__process(body)))
+            await responses.put(None)
+            await write_task
+        except (ConnectionError, asyncio.CancelledError):
+            # 连接断开或服务关闭，连接任务正常结束
+            pass
+        finally:
+            write_task.cancel()
+            writer.close()
+            self.__connections.discard(task)
+
+    async def __write_responses(self, responses, writer):
+        while True:
+            future = await responses.get()
+            if future is None:
+                return
+            status, data = await future
+            writer.write(pack_frame(bytes((status,)) + data))
+            # 客户端读取过慢时在此等待，队列随之填满，进而暂停读取请求
+            await writer.drain()
+
+    async def __process(self, body):
+        """
+        执行一个请求
+        :return: (状态, 数据)
+        """
+        try:
+            op, name, payload = parse_request(body)
+            if name not in self.__registry:
+                raise ParamError('unknown message %s' % name)
+        except Exception as e:
+            # 单个请求的错误只影响该请求，连接继续处理后续请求
+            return _error_response(e)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.__batch:
+            # 本轮事件循环结束后提交收集到的全部请求
+            loop.call_soon(self.__flush)
+        self.__batch.append((op, name, payload))
+        self.__batch_futures.append(future)
+        return await future
+
+    def __flush(self):
+        batch, futures = self.__batch, self.__batch_futures
+        self.__batch, self.__batch_futures = [], []
+        for start in range(0, len(batch), MAX_BATCH):
+            asyncio.ensure_future(self.__dispatch(batch[start:start + MAX_BATCH], futures[start:start + MAX_BATCH]))
+
+    async def __dispatch(self, batch, futures):
+        """
+        将一批请求提交到进程池，进程池中的批次数达到上限时等待
+        """
+        hook = pb_metrics.hook
+        try:
+            async with self.__pending:
+                start = time.perf_counter() if hook is not None else 0
+                results = await asyncio.get_running_loop().run_in_executor(self.__executor, _convert_batch, batch)
+        except Exception as e:
+            results = [_error_response(e)] * len(batch)
+        else:
+            if hook is not None:
+                # 在服务进程中统计，包括进程间传递请求及结果的耗时
+                hook('request_batch', time.perf_counter() - start, len(batch),
+                     sum(len(payload) for op, name, payload in batch), sum(len(data) for status, data in results))
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class ConversionClient:
+    """
+    编解码服务的客户端
+    请求发送后立即返回等待响应的future，可以不等待响应连续发送多个请求
+    """
+
+    def __init__(self, reader, writer, max_frame_size=MAX_RECORD_SIZE):
+        self.__reader = reader
+        self.__writer = writer
+        self.__max_frame_size = max_frame_size
+        # 已发送、等待响应的请求，响应按发送顺序返回
+        self.__waiting = asyncio.Queue()
+        self.__read_task = asyncio.ensure_future(self.__read_responses())
+
+    @classmethod
+    async def connect_tcp(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return cls(reader, writer)
+
+    @classmethod
+    async def connect_unix(cls, path):
+        reader, writer = await asyncio.open_unix_connection(path)
+        return cls(reader, writer)
+
+    async def __read_responses(self):
+        error = None
+        try:
+            while True:
+                body = await read_frame(self.__reader, self.__max_frame_size)
+                if body is None:
+                    break
+                future = await self.__waiting.get()
+                if body[0] == STATUS_OK:
+                    future.set_result(bytes(body[1:]))
+                else:
+                    future.set_exception(FormatError(bytes(body[1:]).decode('utf-8', 'replace')))
+        except (FormatError, ConnectionError) as e:
+            error = e
+        # 连接已关闭，尚未收到响应的请求全部失败
+        while not self.__waiting.empty():
+            future = self.__waiting.get_nowait()
+            if not future.done():
+                future.set_exception(error or ConnectionError('connection closed'))
+
+    def send(self, op, name, payload):
+        """
+        发送请求，不等待响应
+        :return: 响应数据的future，服务端返回错误时抛出FormatError
+        """
+        if self.__read_task.done():
+            raise ConnectionError('connection closed')
+        future = asyncio.get_running_loop().create_future()
+        self.__waiting.put_nowait(future)
+        self.__writer.write(pack_request(op, name, payload))
+        return future
+
+    async def request(self, op, name, payload):
+        """
+        发送请求并等待响应
+        :return: 响应数据
+        """
+        future = self.send(op, name, payload)
+        try:
+            await self.__writer.drain()
+        except ConnectionError:
+            # 连接已断开，future由读取响应的任务以错误结束
+            pass
+        return await future
+
+    async def encode(self, name, record):
+        """
+        将一条记录编码为PB二进制数据
+        :param name     消息全限定名
+        :param record   字段名到字段值的字典或json字符串
+        :return:
+        """
+        if isinstance(record, dict):
+            record = json.dumps(record, ensure_ascii=False)
+        if isinstance(record, str):
+            record = record.encode('utf-8')
+        return await self.request(OP_ENCODE, name, record)
+
+    async def decode(self, name, data):
+        """
+        将PB二进制数据解码为字段名到字段值的字典
+        :return:
+        """
+        return json.loads(await self.request(OP_DECODE, name, data))
+
+    async def drain(self):
+        await self.__writer.drain()
+
+    async def close(self):
+        self.__writer.close()
+        try:
+            await self.__writer.wait_closed()
+        except ConnectionError:
+            pass
+        await self.__read_task
+
+
+async def _serve(args):
+    server = ConversionServer(args.proto, args.include, args.workers, args.max_pipeline, args.max_pending)
+    loop = asyncio.get_running_loop()
+    metrics_task = None
+    signals = []
+    try:
+        if args.unix:
+            address = await server.start_unix(args.unix)
+        else:
+            host, _, port = args.tcp.rpartition(':')
+            address = '%s:%d' % tuple(await server.start_tcp(host or '127.0.0.1', int(port)))
+        sys.stderr.write('pb_server: listening on %s\n' % address)
+        if args.metrics:
+            metrics_task = asyncio.ensure_future(_write_metrics(pb_metrics.enable(), args.metrics,
+                                                                args.metrics_interval))
+        serve_task = asyncio.ensure_future(server.serve_forever())
+        # SIGTERM/SIGINT取消服务任务，由finally关闭监听及进程池，工作进程不会遗留
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, serve_task.cancel)
+                signals.append(signum)
+            except (NotImplementedError, RuntimeError):
+                pass
+        try:
+            await serve_task
+        except asyncio.CancelledError:
+            if not serve_task.cancelled():
+                raise
+    finally:
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+        if metrics_task is not None:
+            metrics_task.cancel()
+        await server.close()
+
+
+async def _write_metrics(metrics, path, interval):
+    """
+    定期把统计写入文件，退出时再写一次
+    """
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            metrics.write_prometheus(path)
+    finally:
+        metrics.write_prometheus(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pb_server', description='serve JSON/protobuf conversion over a socket')
+    parser.add_argument('proto', nargs='+', help='.proto files')
+    parser.add_argument('-I', '--include', action='append', default=[], help='directory to search for imports')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--tcp', help='listen address, [host:]port')
+    group.add_argument('--unix', help='unix socket path')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='worker processes, 0 to convert in-process')
+    parser.add_argument('--max-pipeline', type=int, default=MAX_PIPELINE, help='in-flight requests per connection')
+    parser.add_argument('--max-pending', type=int, default=None, help='batches submitted to the worker pool across connections')
+    parser.add_argument('--metrics', help='write request metrics in Prometheus text format to this file')
+    parser.add_argument('--metrics-interval', type=float, default=METRICS_INTERVAL,
+                        help='seconds between metrics file updates')
+    args = parser.parse_args(argv)
+    if args.metrics_interval <= 0:
+        parser.error('--metrics-interval must be positive')
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+    except (ParamError, FormatError, UndefineError, ParseError, OSError) as e:
+        sys.stderr.write('pb_server: %s\n' % e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,427 @@
+#! /usr/bin/env python3
+# coding=utf-8
+"""
+批量记录的校验及值转换
+
+在编码之前按列检查一批记录：字段名、required字段、值的类型及整数范围，并把值转换为编码时使用的形式
+(bool字段的'true'、bytes字段的base64字符串、枚举值名称等)。每列先用map/set/min/max等整列操作检查，
+整列合法时不再逐个处理；只有整列检查失败时才逐个定位出错的值。嵌套消息字段的值合并为一批递归校验。
+
+校验通过的记录交给MessageEncoder编码时不会出错，且编码结果与直接编码原记录相同:
+
+    result = BatchValidator(file_fsm.message('Test')).validate(records)
+    data_list = encoder.encode_many(result.records())
+    for row, error in sorted(result.errors.items()):
+        print(row, error)
+"""
+
+import json
+import base64
+import bisect
+from my_exception import ParamError
+from pb_parser import Message, _to_bool, is_repeated, is_required
+from google.protobuf.descriptor import FieldDescriptor
+
+
+# 整数类型的取值范围，枚举按int32处理
+IntRanges = {
+    FieldDescriptor.TYPE_INT32: (-(1 << 31), (1 << 31) - 1),
+    FieldDescriptor.TYPE_SINT32: (-(1 << 31), (1 << 31) - 1),
+    FieldDescriptor.TYPE_SFIXED32: (-(1 << 31), (1 << 31) - 1),
+    FieldDescriptor.TYPE_ENUM: (-(1 << 31), (1 << 31) - 1),
+    FieldDescriptor.TYPE_INT64: (-(1 << 63), (1 << 63) - 1),
+    FieldDescriptor.TYPE_SINT64: (-(1 << 63), (1 << 63) - 1),
+    FieldDescriptor.TYPE_SFIXED64: (-(1 << 63), (1 << 63) - 1),
+    FieldDescriptor.TYPE_UINT32: (0, (1 << 32) - 1),
+    FieldDescriptor.TYPE_FIXED32: (0, (1 << 32) - 1),
+    FieldDescriptor.TYPE_UINT64: (0, (1 << 64) - 1),
+    FieldDescriptor.TYPE_FIXED64: (0, (1 << 64) - 1),
+}
+
+_FLOAT_TYPES = (FieldDescriptor.TYPE_DOUBLE, FieldDescriptor.TYPE_FLOAT)
+
+# repeated字段的值可以是list或tuple
+_SEQUENCE_TYPES = (list, tuple)
+
+
+def _type_name(value):
+    return type(value).__name__
+
+
+def _check_ints(values, low, high):
+    """
+    检查整数列
+    :param values   非None的值列表
+    :return: (转换后的值列表, 出错值的下标到错误信息的字典)
+    """
+    # bool是int的子类，但protobuf不接受bool作为整数
+    if set(map(type, values)) <= {int} and (not values or (low <= min(values) and max(values) <= high)):
+        return values, {}
+    errors = {}
+    for i, value in enumerate(values):
+        if not isinstance(value, int) or isinstance(value, bool):
+            errors[i] = 'expected int, got %s' % _type_name(value)
+        elif not low <= value <= high:
+            errors[i] = 'value %d out of range [%d, %d]' % (value, low, high)
+    return values, errors
+
+
+def _check_floats(values):
+    types = set(map(type, values))
+    if types <= {float}:
+        return values, {}
+    if types <= {float, int, bool}:
+        try:
+            return list(map(float, values)), {}
+        except OverflowError:
+            pass
+    coerced = list(values)
+    errors = {}
+    for i, value in enumerate(values):
+        if not isinstance(value, (int, float)):
+            errors[i] = 'expected number, got %s' % _type_name(value)
+            continue
+        try:
+            coerced[i] = float(value)
+        except OverflowError as e:
+            errors[i] = str(e)
+    return coerced, errors
+
+
+def _check_bools(values):
+    if set(map(type, values)) <= {bool}:
+        return values, {}
+    coerced = list(values)
+    errors = {}
+    for i, value in enumerate(values):
+        if isinstance(value, str) and value in ('true', 'false'):
+            coerced[i] = _to_bool(value)
+        elif not isinstance(value, bool):
+            errors[i] = "expected bool or 'true'/'false', got %s" \
+                        % (repr(value) if isinstance(value, str) else _type_name(value))
+    return coerced, errors
+
+
+def _check_strings(values):
+    if set(map(type, values)) <= {str}:
+        try:
+            # 整列一次编码，只有出现无法编码的字符(如单独的代理对)时才逐个检查
+            '\n'.join(values).encode('utf-8')
+            return values, {}
+        except UnicodeEncodeError:
+            pass
+    coerced = list(values)
+    errors = {}
+    for i, value in enumerate(values):
+        try:
+            if isinstance(value, str):
+                value.encode('utf-8')
+            elif isinstance(value, bytes):
+                coerced[i] = value.decode('utf-8')
+            else:
+                errors[i] = 'expected str, got %s' % _type_name(value)
+        except UnicodeError as e:
+            errors[i] = 'invalid utf-8 string, %s' % e
+    return coerced, errors
+
+
+def _check_bytes(values):
+    types = set(map(type, values))
+    if types <= {bytes}:
+        return values, {}
+    if types <= {str}:
+        try:
+            return [base64.b64decode(value, validate=True) for value in values], {}
+        except ValueError:
+            pass
+    coerced = list(values)
+    errors = {}
+    for i, value in enumerate(values):
+        if isinstance(value, str):
+            try:
+                coerced[i] = base64.b64decode(value, validate=True)
+            except ValueError as e:
+                errors[i] = 'invalid base64 string, %s' % e
+        elif not isinstance(value, bytes):
+            errors[i] = 'expected base64 str or bytes, got %s' % _type_name(value)
+    return coerced, errors
+
+
+def _enum_checker(enum_descriptor):
+    """
+    生成枚举列的检查函数，值可以是枚举值名称或整数；封闭枚举(proto2)只接受已定义的值
+    """
+    numbers = dict((value.name, value.number) for value in enum_descriptor.values)
+    defined = frozenset(numbers.values())
+    closed = getattr(enum_descriptor, 'is_closed', True)
+    low, high = IntRanges[FieldDescriptor.TYPE_ENUM]
+
+    def check(values):
+        types = set(map(type, values))
+        if types <= {str} and set(values) <= numbers.keys():
+            return list(map(numbers.__getitem__, values)), {}
+        if types <= {int} and (set(values) <= defined if closed else True):
+            return _check_ints(values, low, high)
+        coerced = list(values)
+        errors = {}
+        for i, value in enumerate(values):
+            if isinstance(value, str):
+                if value in numbers:
+                    coerced[i] = numbers[value]
+                else:
+                    errors[i] = 'invalid value %s for enum %s' % (value, enum_descriptor.full_name)
+            elif not isinstance(value, int) or isinstance(value, bool):
+                errors[i] = 'expected enum name or int, got %s' % _type_name(value)
+            elif (closed and value not in defined) or not low <= value <= high:
+                errors[i] = 'invalid value %d for enum %s' % (value, enum_descriptor.full_name)
+        return coerced, errors
+    return check
+
+
+def _message_checker(validator):
+    """
+    生成消息列的检查函数，同一列的子消息合并为一批交给子消息的校验器
+    """
+    def check(values):
+        if not values:
+            # 递归引用的消息在没有值时不再向下校验
+            return values, {}
+        errors = {}
+        index = []
+        for i, value in enumerate(values):
+            if isinstance(value, dict):
+                index.append(i)
+            else:
+                errors[i] = 'expected object, got %s' % _type_name(value)
+        result = validator.validate([values[i] for i in index])
+        coerced = [None] * len(values)
+        for sub_row, record in zip(index, result.iter_records()):
+            if record is not None:
+                coerced[sub_row] = record
+        for sub_row, error in result.errors.items():
+            errors[index[sub_row]] = error
+        return coerced, errors
+    return check
+
+
+class ValidationResult:
+    """
+    一批记录的校验结果
+        mask    每条记录1字节，1表示记录有错误
+        errors  出错记录的序号到错误信息的字典，每条记录只保留第一个错误
+        columns 字段名到转换后的值列表的字典，缺失或出错的值为None；repeated字段的值为列表
+    """
+
+    __slots__ = ('mask', 'errors', 'columns', '__source')
+
+    def __init__(self, mask, errors, columns, source=None):
+        """
+        :param source   值都不需要转换时为原记录列表，校验通过的记录直接使用原记录
+        """
+        self.mask = mask
+        self.errors = errors
+        self.columns = columns
+        self.__source = source
+
+    def __len__(self):
+        return len(self.mask)
+
+    def valid_rows(self):
+        """
+        返回校验通过的记录序号
+        :return:
+        """
+        return [row for row, bad in enumerate(self.mask) if not bad]
+
+    def iter_records(self):
+        """
+        按记录顺序返回转换后的记录，出错的记录为None
+        :return:
+        """
+        if self.__source is not None:
+            for row, bad in enumerate(self.mask):
+                yield None if bad else self.__source[row]
+            return
+        items = list(self.columns.items())
+        for row, bad in enumerate(self.mask):
+            if bad:
+                yield None
+                continue
+            record = {}
+            for name, column in items:
+                value = column[row]
+                if value is not None:
+                    record[name] = value
+            yield record
+
+    def records(self):
+        """
+        返回校验通过的记录，值已转换，可直接交给MessageEncoder.encode_many/write_delimited
+        :return:
+        """
+        if self.__source is not None:
+            if not self.errors:
+                return list(self.__source)
+            return [record for record, bad in zip(self.__source, self.mask) if not bad]
+        return [record for record in self.iter_records() if record is not None]
+
+
+class _FieldCheck:
+    """
+    单个字段的检查
+    """
+
+    __slots__ = ('name', 'repeated', 'required', 'check')
+
+    def __init__(self, name, repeated, required, check):
+        self.name = name
+        self.repeated = repeated
+        self.required = required
+        self.check = check
+
+
+class BatchValidator:
+    """
+    批量记录校验器
+    消息结构只编译一次，嵌套消息的校验器按消息全名共享；校验器不保存状态，可在多个线程中同时使用
+    """
+
+    def __init__(self, message=None, json_string=None, descriptor=None, validators=None):
+        """
+        :param message      Message实例，如FileFsm.message()的返回值
+        :param json_string  描述消息的json字符串，格式同Message
+        :param descriptor   消息描述符，用于嵌套消息，此时忽略message及json_string
+        :param validators   消息全名到校验器的字典，同一描述符池中的嵌套消息共用
+        """
+        if descriptor is None:
+            if message is None:
+                if json_string is None:
+                    raise ParamError('Invalid Parameter, message or json_string is required')
+                message = Message(json_string=json_string)
+            if not isinstance(message, Message):
+                raise ParamError('Invalid Parameter message:[%s]' % str(message))
+            descriptor = message.message_class_entry().descriptor
+        if validators is None:
+            validators = dict()
+        # 先登记再编译字段，递归引用的消息直接使用同一个校验器
+        validators[descriptor.full_name] = self
+        self.__full_name = descriptor.full_name
+        self.__checks = []
+        for fd in descriptor.fields:
+            if fd.type == FieldDescriptor.TYPE_MESSAGE:
+                validator = validators.get(fd.message_type.full_name)
+                if validator is None:
+                    validator = BatchValidator(descriptor=fd.message_type, validators=validators)
+                check = _message_checker(validator)
+            elif fd.type == FieldDescriptor.TYPE_ENUM:
+                check = _enum_checker(fd.enum_type)
+            elif fd.type in IntRanges:
+                low, high = IntRanges[fd.type]
+                check = lambda values, low=low, high=high: _check_ints(values, low, high)
+            elif fd.type in _FLOAT_TYPES:
+                check = _check_floats
+            elif fd.type == FieldDescriptor.TYPE_BOOL:
+                check = _check_bools
+            elif fd.type == FieldDescriptor.TYPE_STRING:
+                check = _check_strings
+            elif fd.type == FieldDescriptor.TYPE_BYTES:
+                check = _check_bytes
+            else:
+                raise ParamError('field %s: type %d not support yet' % (fd.name, fd.type))
+            self.__checks.append(_FieldCheck(fd.name, is_repeated(fd), is_required(fd), check))
+        self.__names = frozenset(check.name for check in self.__checks)
+
+    def validate(self, records):
+        """
+        校验一批记录
+        :param records  字段名到字段值的字典或json字符串的列表
+        :return: ValidationResult
+        """
+        records = list(records)
+        num_rows = len(records)
+        mask = bytearray(num_rows)
+        errors = dict()
+
+        def fail(row, error):
+            if not mask[row]:
+                mask[row] = 1
+                errors[row] = error
+
+        names = self.__names
+        if not (set(map(type, records)) <= {dict} and all(map(names.issuperset, records))):
+            for row, record in enumerate(records):
+                if isinstance(record, (str, bytes)):
+                    try:
+                        record = records[row] = json.loads(record)
+                    except ValueError as e:
+                        fail(row, 'invalid json, %s' % e)
+                        records[row] = {}
+                        continue
+                if not isinstance(record, dict):
+                    fail(row, 'expected object, got %s' % _type_name(record))
+                    records[row] = {}
+                elif not record.keys() <= names:
+                    unknown = sorted(set(record) - names)
+                    fail(row, 'unknown field %s for message %s' % (unknown[0], self.__full_name))
+
+        columns = dict()
+        # 全部字段的值都不需要转换时，校验通过的记录直接使用原记录
+        unchanged = True
+        for field in self.__checks:
+            name = field.name
+            column = [record.get(name) for record in records]
+            if None in column:
+                rows = [row for row, value in enumerate(column) if value is not None]
+                if field.required:
+                    present = set(rows)
+                    for row in range(num_rows):
+                        if row not in present:
+                            fail(row, 'required field %s is not set for message %s' % (name, self.__full_name))
+            else:
+                rows = range(num_rows)
+            if field.repeated:
+                # 全部记录的元素展开为一列检查，再按记录重新分组
+                owners = []
+                items = []
+                for row in rows:
+                    value = column[row]
+                    if not isinstance(value, _SEQUENCE_TYPES):
+                        fail(row, 'field %s: expected list, got %s' % (name, _type_name(value)))
+                        continue
+                    owners.append((row, len(items)))
+                    items.extend(value)
+                values, item_errors = field.check(items)
+                bad = set()
+                if item_errors:
+                    starts = [start for row, start in owners]
+                    for i in sorted(item_errors):
+                        # 元素所属的记录：起始下标不大于i的最后一个
+                        row, start = owners[bisect.bisect_right(starts, i) - 1]
+                        if row not in bad:
+                            bad.add(row)
+                            fail(row, 'field %s[%d]: %s' % (name, i - start, item_errors[i]))
+                coerced = [None] * num_rows
+                ends = [start for row, start in owners[1:]] + [len(items)]
+                for (row, start), end in zip(owners, ends):
+                    if row not in bad:
+                        coerced[row] = values[start:end]
+                if values is not items:
+                    unchanged = False
+            else:
+                present = column if len(rows) == num_rows else [column[row] for row in rows]
+                values, value_errors = field.check(present)
+                if values is present:
+                    # 值没有转换，直接使用原来的列
+                    coerced = list(column) if value_errors else column
+                else:
+                    unchanged = False
+                    coerced = [None] * num_rows
+                    for row, value in zip(rows, values):
+                        coerced[row] = value
+                for i, error in value_errors.items():
+                    row = rows[i]
+                    coerced[row] = None
+                    fail(row, 'field %s: %s' % (name, error))
+            columns[name] = coerced
+        return ValidationResult(mask, errors, columns, records if unchanged else None)
+
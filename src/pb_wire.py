@@ -0,0 +1,347 @@
+#! /usr/bin/env python3
+# coding=utf-8
+"""
+标量消息的直接编码
+
+字段全部为标量类型时，按Field列表(sequence、type、property)预先生成每个字段的tag字节，并为消息生成一个
+逐字段展开的编码函数，把varint、zigzag、定长及长度前缀的值直接写入复用的bytearray，不经过描述符池及动态消息类。
+输出与protobuf的SerializeToString()逐字节一致，差分检查见benchmark/wire_diff.py。
+"""
+
+import json
+import math
+import time
+import struct
+import pb_metrics
+from collections import namedtuple
+from my_exception import ParamError, FormatError
+from pb_parser import Message, _to_bool, _to_bytes
+from pb_encoder import encode_varint, write_varint
+
+
+# 线上格式
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH = 2
+WIRE_FIXED32 = 5
+
+_UINT64_MASK = (1 << 64) - 1
+
+# 值的编码方式，_FIXED_INT为定长整数，与protobuf相同不接受bool
+_VARINT, _ZIGZAG, _BOOL, _FIXED, _FIXED_INT, _STRING, _BYTES = range(7)
+
+
+def _string_data(value):
+    """
+    返回string字段的utf-8编码，bytes须为合法的utf-8，与protobuf相同不接受其他类型
+    """
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    if isinstance(value, bytes):
+        value.decode('utf-8')
+        return value
+    raise TypeError('expected str or bytes, got %s' % type(value).__name__)
+
+
+def _bytes_data(value):
+    """
+    返回bytes字段的内容，str按base64解码
+    """
+    data = _to_bytes(value)
+    if not isinstance(data, bytes):
+        raise TypeError('expected base64 str or bytes, got %s' % type(value).__name__)
+    return data
+
+
+def _write_value(out, kind, low, high, pack, value):
+    """
+    写入一个值，不含tag
+    """
+    if kind == _VARINT:
+        if value.__class__ is bool:
+            raise TypeError('expected int, got bool')
+        if not low <= value <= high:
+            raise ValueError('value out of range')
+        # int32/int64的负数按64位补码编码为10字节的varint
+        write_varint(out, value & _UINT64_MASK if value < 0 else value)
+    elif kind == _FIXED:
+        out += pack(value)
+    elif kind == _FIXED_INT:
+        if value.__class__ is bool:
+            raise TypeError('expected int, got bool')
+        out += pack(value)
+    elif kind == _ZIGZAG:
+        if value.__class__ is bool:
+            raise TypeError('expected int, got bool')
+        if not low <= value <= high:
+            raise ValueError('value out of range')
+        write_varint(out, (value << 1) ^ (value >> 63))
+    elif kind == _BOOL:
+        out.append(1 if _to_bool(value) else 0)
+    else:
+        data = _bytes_data(value) if kind == _BYTES else _string_data(value)
+        write_varint(out, len(data))
+        out += data
+
+
+_pack_f = struct.Struct('<f').pack
+
+
+def _pack_float(value):
+    """
+    打包float值，超出float范围的值与protobuf相同，按同号的无穷大编码
+    """
+    try:
+        return _pack_f(value)
+    except (OverflowError, struct.error):
+        if not isinstance(value, (int, float)):
+            raise
+        # 无法转换为double的整数由float()抛出OverflowError
+        return _pack_f(math.copysign(math.inf, float(value)))
+
+
+# 定长值的打包函数，未列出的格式使用struct.Struct(fmt).pack
+_PACKERS = {'<f': _pack_float}
+
+# 字段类型 -> (线上格式, 编码方式, 最小值, 最大值, 定长值的struct格式)
+WireTypes = {
+    'int32': (WIRE_VARINT, _VARINT, -(1 << 31), (1 << 31) - 1, None),
+    'int64': (WIRE_VARINT, _VARINT, -(1 << 63), (1 << 63) - 1, None),
+    'uint32': (WIRE_VARINT, _VARINT, 0, (1 << 32) - 1, None),
+    'uint64': (WIRE_VARINT, _VARINT, 0, (1 << 64) - 1, None),
+    'sint32': (WIRE_VARINT, _ZIGZAG, -(1 << 31), (1 << 31) - 1, None),
+    'sint64': (WIRE_VARINT, _ZIGZAG, -(1 << 63), (1 << 63) - 1, None),
+    'bool': (WIRE_VARINT, _BOOL, None, None, None),
+    'fixed32': (WIRE_FIXED32, _FIXED_INT, None, None, '<I'),
+    'sfixed32': (WIRE_FIXED32, _FIXED_INT, None, None, '<i'),
+    'float': (WIRE_FIXED32, _FIXED, None, None, '<f'),
+    'fixed64': (WIRE_FIXED64, _FIXED_INT, None, None, '<Q'),
+    'sfixed64': (WIRE_FIXED64, _FIXED_INT, None, None, '<q'),
+    'double': (WIRE_FIXED64, _FIXED, None, None, '<d'),
+    'string': (WIRE_LENGTH, _STRING, None, None, None),
+    'bytes': (WIRE_LENGTH, _BYTES, None, None, None),
+}
+
+# 编译后的字段，按字段编号排列，编码时直接解包
+WireField = namedtuple('WireField', ['name', 'tag', 'kind', 'low', 'high', 'pack', 'required', 'repeated', 'packed'])
+
+
+def compile_wire_fields(fields, packed=False):
+    """
+    根据字段列表生成编码计划
+    :param fields   Field列表
+    :param packed   repeated数值字段是否使用packed编码
+    :return: 按字段编号排列的WireField列表
+    """
+    wire_fields = []
+    for field in sorted(fields, key=lambda f: f.sequence):
+        if field.type not in WireTypes:
+            raise FormatError('field %s: type %s not support for wire encode' % (field.name, field.type))
+        wire, kind, low, high, fmt = WireTypes[field.type]
+        repeated = field.property == 'repeated'
+        # 只有数值类型的repeated字段可以packed
+        field_packed = packed and repeated and wire != WIRE_LENGTH
+        tag = encode_varint(field.sequence << 3 | (WIRE_LENGTH if field_packed else wire))
+        pack = (_PACKERS.get(fmt) or struct.Struct(fmt).pack) if fmt else None
+        wire_fields.append(WireField(field.name, tag, kind, low, high, pack, field.property == 'required', repeated,
+                                     field_packed))
+    return wire_fields
+
+
+def _generate_encoder(wire_fields, full_name):
+    """
+    根据编码计划生成编码函数encode(record, out, payload)，每个字段展开为一段直接写入的代码，
+    tag及bool值的字节预先生成为常量
+    :param wire_fields  compile_wire_fields的返回值
+    :param full_name    消息全名，用于错误信息
+    :return:
+    """
+    namespace = {'write_varint': write_varint, '_write_value': _write_value, '_to_bool': _to_bool,
+                 '_string_data': _string_data, 'FormatError': FormatError,
+                 'ValueErrors': (TypeError, ValueError, OverflowError, struct.error)}
+    lines = ['def encode(record, out, payload):',
+             '    get = record.get',
+             '    name = None',
+             '    try:']
+    for i, field in enumerate(wire_fields):
+        args = '%d, L%d, H%d, P%d' % (field.kind, i, i, i)
+        namespace.update({'T%d' % i: field.tag, 'L%d' % i: field.low, 'H%d' % i: field.high, 'P%d' % i: field.pack})
+        lines.append('        name = %r' % field.name)
+        lines.append('        v = get(name)')
+        lines.append('        if v is not None:')
+        if field.packed:
+            lines += ['            if v:',
+                      '                del payload[:]',
+                      '                for item in v:',
+                      '                    _write_value(payload, %s, item)' % args,
+                      '                out += T%d' % i,
+                      '                write_varint(out, len(payload))',
+                      '                out += payload']
+        elif field.repeated:
+            lines += ['            for item in v:',
+                      '                out += T%d' % i,
+                      '                _write_value(out, %s, item)' % args]
+        elif field.kind == _VARINT:
+            lines += ['            out += T%d' % i,
+                      '            if v.__class__ is not int or not L%d <= v <= H%d:' % (i, i),
+                      '                _write_value(out, %s, v)' % args,
+                      '            elif 0 <= v < 0x80:',
+                      '                out.append(v)',
+                      '            elif 0 <= v < 0x4000:',
+                      '                out.append(v & 0x7f | 0x80)',
+                      '                out.append(v >> 7)',
+                      '            else:',
+                      '                write_varint(out, v & %d)' % _UINT64_MASK]
+        elif field.kind == _FIXED:
+            lines.append('            out += T%d + P%d(v)' % (i, i))
+        elif field.kind == _FIXED_INT:
+            lines += ['            if v.__class__ is bool:',
+                      '                raise TypeError("expected int, got bool")',
+                      '            out += T%d + P%d(v)' % (i, i)]
+        elif field.kind == _BOOL:
+            namespace.update({'B%d' % i: field.tag + b'\x00', 'C%d' % i: field.tag + b'\x01'})
+            lines.append('            out += C%d if (v is True or (v is not False and _to_bool(v))) else B%d' % (i, i))
+        elif field.kind == _STRING:
+            lines += ['            out += T%d' % i,
+                      '            v = v.encode("utf-8") if v.__class__ is str else _string_data(v)',
+                      '            if len(v) < 0x80:',
+                      '                out.append(len(v))',
+                      '            else:',
+                      '                write_varint(out, len(v))',
+                      '            out += v']
+        else:
+            lines += ['            out += T%d' % i,
+                      '            _write_value(out, %s, v)' % args]
+        if field.required:
+            lines += ['        else:',
+                      '            raise FormatError(%r)' % ('required field %s is not set for message %s'
+                                                          % (field.name, full_name))]
+    lines += ['        pass',
+              '    except ValueErrors as e:',
+              '        raise FormatError("field %s: invalid value %s, %s" % (name, repr(get(name)), e))']
+    exec(compile('\n'.join(lines), '<wire encoder %s>' % full_name, 'exec'), namespace)
+    return namespace['encode']
+
+
+class WireEncoder:
+    """
+    标量消息的直接编码器，接口与MessageEncoder相同
+    编码使用的bytearray从池中取用，可在多个线程中同时使用
+    """
+
+    def __init__(self, message=None, json_string=None, packed=False):
+        """
+        :param message      Message实例，如FileFsm.message()的返回值
+        :param json_string  描述消息的json字符串，格式同Message
+        :param packed       repeated数值字段是否使用packed编码，应与proto中的[packed=true]一致
+        """
+        if message is None:
+            if json_string is None:
+                raise ParamError('Invalid Parameter, message or json_string is required')
+            message = Message(json_string=json_string)
+        if not isinstance(message, Message):
+            raise ParamError('Invalid Parameter message:[%s]' % str(message))
+        self.__message = message
+        # SerializeToString按字段编号顺序输出
+        self.__fields = compile_wire_fields(message.fields(), packed)
+        self.__names = frozenset(field.name for field in self.__fields)
+        self.__encode = _generate_encoder(self.__fields, message.full_name())
+        # 空闲的输出缓冲区及packed字段的缓冲区，list的append/pop是原子操作，多个线程可同时取用
+        self.__buffers = []
+        self.__payloads = [] if any(field.packed for field in self.__fields) else None
+
+    def message(self):
+        """
+        返回编码器使用的消息结构
+        :return:
+        """
+        return self.__message
+
+    def encode_into(self, record, out):
+        """
+        将一条记录编码后追加到out中
+        :param record   字段名到字段值的字典或json字符串，值为None的字段不设置
+        :param out      bytearray
+        :return: 写入的字节数
+        """
+        if isinstance(record, (str, bytes)):
+            record = json.loads(record)
+        if not record.keys() <= self.__names:
+            unknown = sorted(set(record) - self.__names)
+            raise FormatError('unknown field %s for message %s' % (unknown[0], self.__message.full_name()))
+        hook = pb_metrics.hook
+        begin = time.perf_counter() if hook is not None else 0
+        start = len(out)
+        payloads = self.__payloads
+        payload = None if payloads is None else self.__take(payloads)
+        try:
+            self.__encode(record, out, payload)
+        except FormatError:
+            del out[start:]
+            raise
+        finally:
+            if payload is not None:
+                payloads.append(payload)
+        if hook is not None:
+            hook('encode_wire', time.perf_counter() - begin, 1, 0, len(out) - start)
+        return len(out) - start
+
+    def encode(self, record):
+        """
+        将一条记录编码为PB二进制数据
+        :param record:
+        :return:
+        """
+        buffer = self.__take(self.__buffers)
+        try:
+            del buffer[:]
+            self.encode_into(record, buffer)
+            return bytes(buffer)
+        finally:
+            self.__buffers.append(buffer)
+
+    def encode_many(self, records):
+        """
+        批量编码
+        :param records  记录的可迭代对象
+        :return: 二进制数据列表
+        """
+        return [self.encode(record) for record in records]
+
+    def write_delimited(self, records, stream):
+        """
+        批量编码，每条数据以varint长度为前缀写入stream
+        :param records  记录的可迭代对象
+        :param stream   可写的二进制流
+        :return: 写入的记录数
+        """
+        buffer = self.__take(self.__buffers)
+        count = 0
+        try:
+            for record in records:
+                del buffer[:]
+                # 预留1字节的长度前缀，长度超过127时再插入多余的字节
+                buffer.append(0)
+                length = self.encode_into(record, buffer)
+                if length < 0x80:
+                    buffer[0] = length
+                    stream.write(buffer)
+                else:
+                    stream.write(encode_varint(length))
+                    stream.write(buffer[1:])
+                count += 1
+        finally:
+            self.__buffers.append(buffer)
+        return count
+
+    @staticmethod
+    def __take(buffers):
+        """
+        从空闲列表中取出一个缓冲区，没有时新建；用完后应放回原列表
+        :param buffers:
+        :return: bytearray
+        """
+        try:
+            return buffers.pop()
+        except IndexError:
+            return bytearray()